@@ -0,0 +1,323 @@
+import os
+import sys
+import asyncio
+import hashlib
+import argparse
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+import db
+
+# bot.py, imported by load_game() once --token-file has been read
+game = None
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------
+# asyncio runtime
+# Same commands as bot.py, on pyTelegramBotAPI's AsyncTeleBot:
+#
+#   python bot.py          # threaded TeleBot, as before
+#   python async_bot.py    # this
+#
+# The handlers are the ones bot.py registers; nothing is rewritten. What
+# changes is where they run and where their Telegram calls go:
+#
+# - Every command gets an Outbox. bot.bot is swapped for a router that hands
+#   reply_to / send_message / send_photo_cached etc. to the current command's
+#   outbox, which queues them for the event loop and returns at once. The
+#   loop sends them in order while the handler carries on, so no thread
+#   waits on Telegram (a /accept battle no longer holds a worker through
+#   every round's message).
+# - Every handler's database work runs on the one DB thread (AsyncDB), in
+#   its own unit of work, so the event loop never waits on SQLite. The
+#   handlers only queue their messages, so a /accept battle is its rounds'
+#   SQL and nothing more.
+# - /roll and /instantroll are split: play_roll() / play_instantroll() on
+#   the DB thread, the pictures drawn on the render executor, then the
+#   results go out. /fishing start is split the same way: play_fishing()
+#   casts, the loop waits out the rod with asyncio.sleep, land_fishing()
+#   reels in on the DB thread and the catch is drawn on the render executor.
+#
+# Sends are fire-and-forget from the handler's point of view. As in bot.py,
+# messages queued after the command's first write wait for its commit and a
+# failure is only logged. Unlike bot.py, a send that fails before any write
+# is only logged too: the handler carries on instead of stopping with the
+# error. That, and messages arriving while the command is still working,
+# are the only differences.
+#
+# Both modes keep in-process caches (users, effects, counters), so for an
+# A/B run give each its own database (--db) and bot token (--token-file)
+# rather than pointing both at one isopods.db.
+# ---------------------------------------------------------------------------
+
+RENDER_WORKERS = 2
+
+# Handlers whose drawing happens after the commit: name -> bot.py's DB part
+ROLL_HANDLERS = {'roll': 'play_roll', 'instantroll': 'play_instantroll'}
+
+_local = threading.local()
+
+def load_game():
+    """Import bot.py on first use. It reads its token at import, so
+    main() sets ISOPOD_TOKEN from --token-file before calling this."""
+    global game
+    if game is None:
+        import bot
+        game = bot
+    return game
+
+class AsyncDB:
+    """All database work on one dedicated thread, each call in its own unit
+    of work: handlers, the DB halves of /roll and /fishing, and the photo
+    file_id cache. SQLite takes one writer at a time anyway; this way the
+    event loop never blocks on it."""
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+    async def call(self, func, *args, outbox=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._run, func, args, outbox)
+
+    def _run(self, func, args, outbox):
+        _local.outbox = outbox
+        try:
+            with db.unit_of_work():
+                return func(*args)
+        finally:
+            _local.outbox = None
+
+class Outbox:
+    """Telegram calls made during one command, sent in order by drain()."""
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self._loop = runtime.loop
+        self._queue = asyncio.Queue()
+
+    def _put(self, item):
+        # As in bot.py: once the command has written something, its messages
+        # wait for the commit (and are dropped if it rolls back)
+        if db.has_pending_writes():
+            db.after_commit(lambda: self._enqueue(item))
+        else:
+            self._enqueue(item)
+
+    def _enqueue(self, item):
+        if threading.get_ident() == self.runtime.loop_thread:
+            self._queue.put_nowait(item)
+        else:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def reply_to(self, message, text, **kwargs):
+        self._put((self.runtime.client.reply_to, (message, text), kwargs))
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._put((self.runtime.client.send_message, (chat_id, text), kwargs))
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        self._put((self.runtime.client.send_photo, (chat_id, photo), kwargs))
+
+    def send_media_group(self, chat_id, media, **kwargs):
+        self._put((self.runtime.client.send_media_group, (chat_id, media), kwargs))
+
+    def send_photo_cached(self, chat_id, data, caption=None):
+        self._put((self.runtime.send_photo_cached, (chat_id, data, caption), {}))
+
+    def send_album_cached(self, chat_id, images, caption=None):
+        self._put((self.runtime.send_album_cached, (chat_id, images, caption), {}))
+
+    def close(self):
+        self._put(None)
+
+    async def drain(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            func, args, kwargs = item
+            try:
+                await func(*args, **kwargs)
+            except Exception:
+                logger.exception(f"Telegram call {getattr(func, '__name__', func)} failed")
+
+class _Router:
+    """Stands in for bot.bot (and bot.py's photo helpers): every Telegram
+    call goes to the calling thread's outbox, or the runtime's own one when
+    it comes from outside a command (scheduler jobs)."""
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def _outbox(self):
+        return getattr(_local, 'outbox', None) or self.runtime.detached
+
+    def __getattr__(self, name):
+        return getattr(self._outbox(), name)
+
+    def send_photo_cached(self, chat_id, data, caption=None):
+        return self._outbox().send_photo_cached(chat_id, data, caption)
+
+    def send_album_cached(self, chat_id, images, caption=None):
+        return self._outbox().send_album_cached(chat_id, images, caption)
+
+class AsyncRuntime:
+    def __init__(self, token):
+        self.client = AsyncTeleBot(token)
+        self.db = AsyncDB()
+        self.render = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='render')
+        self.loop = None
+        self.loop_thread = None
+        self.detached = None
+
+    def install(self):
+        """Register bot.py's handlers on the async client and route their
+        Telegram calls through outboxes. Call from inside the event loop."""
+        load_game()
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.detached = Outbox(self)
+        self.loop.create_task(self._drain_detached())
+        sync_handlers = list(game.bot.message_handlers)
+        router = _Router(self)
+        game.bot = router
+        game.send_photo_cached = router.send_photo_cached
+        game.send_album_cached = router.send_album_cached
+        for handler in sync_handlers:
+            filters = handler['filters']
+            func = handler['function']
+            if func.__name__ in ROLL_HANDLERS:
+                callback = self._roll(getattr(game, ROLL_HANDLERS[func.__name__]))
+            elif func.__name__ == 'fishing':
+                callback = self._fishing
+            else:
+                callback = self._on_db_thread(func)
+            self.client.register_message_handler(
+                callback, commands=filters.get('commands'), content_types=filters.get('content_types')
+            )
+        logger.info(f"Registered {len(sync_handlers)} handlers on the async client")
+
+    async def _drain_detached(self):
+        while True:
+            await self.detached.drain()
+
+    async def _command(self, message, work):
+        """Run work(outbox) with a fresh outbox and wait for its messages."""
+        outbox = Outbox(self)
+        drain = asyncio.ensure_future(outbox.drain())
+        try:
+            await work(outbox)
+        except Exception:
+            logger.exception(f"Handler failed for {message.text!r}")
+        finally:
+            outbox.close()
+            await drain
+
+    def _on_db_thread(self, func):
+        async def callback(message):
+            await self._command(message, lambda outbox: self.db.call(func, message, outbox=outbox))
+        return callback
+
+    def _roll(self, play):
+        async def callback(message):
+            async def work(outbox):
+                results, status = await self.db.call(play, message, outbox=outbox)
+                if results is None:
+                    outbox.reply_to(message, status)
+                    return
+                await self.loop.run_in_executor(self.render, game.render_roll_images, results)
+                self._queue(outbox, game.send_roll_results, message, results, status)
+            await self._command(message, work)
+        return callback
+
+    async def _fishing(self, message):
+        async def work(outbox):
+            cast = await self.db.call(game.play_fishing, message, outbox=outbox)
+            if cast is None:
+                return
+            await asyncio.sleep(cast['speed_sec'])
+            catch = await self.db.call(game.land_fishing, message, cast, outbox=outbox)
+            if catch is None:
+                return
+            await self.loop.run_in_executor(self.render, game.render_fishing_image, catch)
+            self._queue(outbox, game.send_fishing_catch, message, catch)
+        await self._command(message, work)
+
+    def _queue(self, outbox, send, *args):
+        # bot.py's send helpers only queue on the outbox, so fine on the loop thread
+        _local.outbox = outbox
+        try:
+            send(*args)
+        finally:
+            _local.outbox = None
+
+    # -- photos: bot.py's file_id cache, awaited -----------------------------
+
+    async def send_photo_cached(self, chat_id, data, caption=None):
+        content_hash = hashlib.sha256(data).hexdigest()
+        file_id = await self.db.call(game.get_photo_file_id, content_hash)
+        if file_id:
+            try:
+                sent = await self.client.send_photo(chat_id, file_id, caption=caption)
+                game.count_photo('reused')
+                return sent
+            except asyncio_helper.ApiTelegramException as e:
+                if not game.is_stale_file_id_error(e):
+                    raise
+                logger.info(f"Stale photo file_id for {content_hash[:12]}: {e.description}")
+                game.count_photo('stale')
+                await self.db.call(game.forget_photo_file_id, content_hash)
+        sent = await self.client.send_photo(chat_id, data, caption=caption)
+        game._count_upload(data)
+        if sent is not None and getattr(sent, 'photo', None):
+            await self.db.call(game.save_photo_file_id, content_hash, sent.photo[-1].file_id)
+        return sent
+
+    async def send_album_cached(self, chat_id, images, caption=None):
+        for start in range(0, len(images), game.ALBUM_MAX):
+            chunk = images[start:start + game.ALBUM_MAX]
+            hashes = [hashlib.sha256(data).hexdigest() for data in chunk]
+            file_ids = [await self.db.call(game.get_photo_file_id, h) for h in hashes]
+            chunk_caption = caption if start == 0 else None
+            try:
+                sent = await self.client.send_media_group(chat_id, game._album_media(chunk, file_ids, chunk_caption))
+            except asyncio_helper.ApiTelegramException as e:
+                if not any(file_ids) or not game.is_stale_file_id_error(e):
+                    raise
+                logger.info(f"Album with cached file_ids rejected, re-uploading: {e.description}")
+                game.count_photo('stale')
+                for content_hash, file_id in zip(hashes, file_ids):
+                    if file_id:
+                        await self.db.call(game.forget_photo_file_id, content_hash)
+                file_ids = [None] * len(chunk)
+                sent = await self.client.send_media_group(chat_id, game._album_media(chunk, file_ids, chunk_caption))
+            for content_hash, file_id, message in zip(hashes, file_ids, sent or []):
+                if not file_id and getattr(message, 'photo', None):
+                    await self.db.call(game.save_photo_file_id, content_hash, message.photo[-1].file_id)
+
+    async def run(self):
+        self.install()
+        print("Bot running (asyncio)...")
+        await self.client.infinity_polling()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the isopod bot on the asyncio runtime')
+    parser.add_argument('--db', default=db.DB_PATH, help='database file (default: %(default)s)')
+    parser.add_argument('--token-file', help='bot token file (default: the one bot.py reads)')
+    args = parser.parse_args(argv)
+    db.DB_PATH = args.db
+    if args.token_file:
+        with open(args.token_file, 'r') as f:
+            os.environ['ISOPOD_TOKEN'] = f.read().strip()
+    load_game()
+    game.start_services()
+    asyncio.run(AsyncRuntime(game.TOKEN).run())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
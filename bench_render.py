@@ -0,0 +1,78 @@
+import sys
+import time
+import argparse
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageOps
+
+import compositor
+
+# ---------------------------------------------------------------------------
+# Compositor microbenchmark
+# Old per-row draw.line gradient + paste vs the array versions in
+# compositor.py, at a few canvas sizes. The sprite is synthetic so this runs
+# without the Assets folder.
+#
+#   python bench_render.py --sizes 256 512 1024 2048 --repeat 20
+# ---------------------------------------------------------------------------
+
+def _gradient_rowloop(size, start_rgb, end_rgb):
+    width, height = size
+    gradient = Image.new('RGBA', size)
+    draw = ImageDraw.Draw(gradient)
+    for y in range(height):
+        ratio = y / height
+        r = int(start_rgb[0] * (1 - ratio) + end_rgb[0] * ratio)
+        g = int(start_rgb[1] * (1 - ratio) + end_rgb[1] * ratio)
+        b = int(start_rgb[2] * (1 - ratio) + end_rgb[2] * ratio)
+        draw.line((0, y, width, y), fill=(r, g, b, 255))
+    return gradient
+
+def _sprite(side):
+    yy, xx = np.mgrid[0:side, 0:side]
+    gray = ((xx + yy) * 255 // (2 * side)).astype(np.uint8)
+    dist = np.hypot(xx - side / 2, yy - side / 2)
+    alpha = np.clip((side / 2 - dist) * 16, 0, 255).astype(np.uint8)
+    return gray, alpha
+
+def _render_old(side, gray, alpha, rgb):
+    canvas = _gradient_rowloop((side, side), tuple(c // 4 for c in rgb), rgb)
+    gray_img = Image.fromarray(gray, 'L')
+    tinted_rgb = ImageOps.colorize(gray_img, '#000000', '#%02x%02x%02x' % rgb)
+    tinted = Image.merge('RGBA', tinted_rgb.split()[:3] + (Image.fromarray(alpha, 'L'),))
+    offset = (side - gray.shape[1]) // 2
+    canvas.paste(tinted, (offset, offset), tinted)
+    return canvas
+
+def _render_new(side, gray, alpha, rgb):
+    canvas = compositor.to_image(compositor.linear_gradient((side, side), tuple(c // 4 for c in rgb), rgb))
+    offset = (side - gray.shape[1]) // 2
+    return compositor.composite(canvas, compositor.tint(gray, rgb, alpha), (offset, offset))
+
+def _time(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the array compositor against the row loop')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024, 2048])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args(argv)
+    rgb = (0, 160, 0)
+    print(f"{'canvas':>8} {'gradient old':>13} {'new':>9} {'x':>6} {'render old':>11} {'new':>9} {'x':>6}")
+    for side in args.sizes:
+        gray, alpha = _sprite(side // 2)
+        g_old = _time(lambda: _gradient_rowloop((side, side), (0, 40, 0), rgb), args.repeat)
+        g_new = _time(lambda: compositor.linear_gradient((side, side), (0, 40, 0), rgb), args.repeat)
+        r_old = _time(lambda: _render_old(side, gray, alpha, rgb), args.repeat)
+        r_new = _time(lambda: _render_new(side, gray, alpha, rgb), args.repeat)
+        print(f"{side:>8} {g_old * 1000:>11.2f}ms {g_new * 1000:>7.2f}ms {g_old / g_new:>5.1f}x "
+              f"{r_old * 1000:>9.2f}ms {r_new * 1000:>7.2f}ms {r_old / r_new:>5.1f}x")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
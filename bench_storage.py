@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import argparse
+
+import db
+
+# ---------------------------------------------------------------------------
+# Storage engine benchmark
+# Runs the same command mix against the sqlite and memory engines on a
+# throwaway database and prints ops/s for each. The mix is read-heavy like
+# the real bot: most commands only look at money/charges/items/effects.
+#
+#   python bench_storage.py --users 2000 --ops 50000
+# ---------------------------------------------------------------------------
+
+ITEMS = ('energy_drink', 'overcharge', 'lucky_charm', 'regen_market')
+EFFECTS = ('item_drop_boost', 'roll_boost', 'shield')
+
+def _populate(users):
+    for uid in range(1, users + 1):
+        with db.unit_of_work():
+            db.get_or_create_user(uid, f'user{uid}')
+            db.update_user_money(uid, random.randint(0, 5000))
+            db.add_item(uid, random.choice(ITEMS), random.randint(1, 3))
+            db.put_effect(uid, random.choice(EFFECTS), '0.2', time.time() + 3600)
+    db.flush_counters()
+
+def _command(uid, read_ratio):
+    with db.unit_of_work():
+        if random.random() < read_ratio:
+            db.get_user_money(uid)
+            db.get_user_charges(uid)
+            db.get_item_qty(uid, ITEMS[0])
+            db.get_effect_row(uid, EFFECTS[0])
+        else:
+            db.update_user_money(uid, 1)
+            db.set_user_charges(uid, 3, time.time())
+            if db.consume_item(uid, ITEMS[0]):
+                db.add_item(uid, ITEMS[0])
+
+def run(engine, path, users, ops, read_ratio):
+    db.DB_PATH = path
+    db.init_db()
+    db.init_storage(engine)
+    _populate(users)
+    rng_ids = [random.randint(1, users) for _ in range(ops)]
+    start = time.perf_counter()
+    for uid in rng_ids:
+        _command(uid, read_ratio)
+    elapsed = time.perf_counter() - start
+    snap = 0.0
+    if engine == 'memory':
+        t0 = time.perf_counter()
+        db.snapshot_store()
+        snap = time.perf_counter() - t0
+    db.flush_counters()
+    db.init_storage('sqlite')
+    return elapsed, snap
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the sqlite and memory storage engines')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--ops', type=int, default=20000)
+    parser.add_argument('--read-ratio', type=float, default=0.9)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='isopod-bench-')
+    try:
+        results = {}
+        for engine in ('sqlite', 'memory'):
+            random.seed(args.seed)
+            path = os.path.join(workdir, f'{engine}.db')
+            results[engine] = run(engine, path, args.users, args.ops, args.read_ratio)
+        for engine, (elapsed, snap) in results.items():
+            line = f"{engine:>7}: {args.ops / elapsed:10.0f} commands/s ({elapsed:.2f}s)"
+            if snap:
+                line += f", snapshot {snap * 1000:.0f} ms"
+            print(line)
+        print(f"speedup: {results['sqlite'][0] / results['memory'][0]:.1f}x")
+    finally:
+        db.get_pool().close_all()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
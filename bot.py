@@ -1,10 +1,21 @@
 import telebot
 import os
 import time
-import random
 import json
-from db import init_db, get_or_create_user, update_user_last_roll, update_user_money, set_legendary, get_conn
-from utils import needs_regen, generate_marketplace, generate_isopod_image, generate_isofish_image, cleanup_temp, get_txt_path, get_graphics_path, load_lists
+import hashlib
+import functools
+import threading
+from db import init_db, get_or_create_user, update_user_last_roll, update_user_money, set_legendary, get_conn, transactional, unit_of_work, after_commit, has_pending_writes, set_user_charges, get_user_money, get_user_charges, get_user_id_by_username, open_standalone_conn
+from db import get_photo_file_id, save_photo_file_id, forget_photo_file_id, flush_photo_uses, PHOTO_USES_FLUSH_INTERVAL
+from db import init_storage, snapshot_store, SNAPSHOT_INTERVAL, get_username, top_users, legendary_usernames, all_user_ids
+from db import get_item_qty, add_item, consume_item, list_items, get_effect_row, put_effect, delete_effect, pop_expired_effects
+from db import sweep_expired_effects, next_effect_expiry, EFFECT_SWEEP_INTERVAL
+import utils
+from utils import last_market_regen, generate_marketplace, sample_market, sample_market_many, market_price_views, discount_market, generate_isopod_image, generate_isofish_image, rainbow_image, variant_pool, get_txt_path, load_lists
+
+from scheduler import scheduler
+from sampling import AliasTable
+from rng import get_stream
 
 import logging
 logging.basicConfig(
@@ -13,7 +24,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__file__)
 
-TOKEN = open(get_txt_path('telegramapikey.txt')).read().strip()
+# ISOPOD_TOKEN overrides the key file (tests, or a second bot for an A/B run)
+TOKEN = os.environ.get('ISOPOD_TOKEN') or open(get_txt_path('telegramapikey.txt')).read().strip()
 
 COOLDOWN = 300
 MAX_CHARGES = 5
@@ -28,6 +40,9 @@ RAINBOW_CHANCE = 0.005
 HEAL_CHANCE = 0.1
 NERF_CHANCE = 0.05
 ITEM_DROP_CHANCE = 0.05
+ALBUM_MAX = 10
+ALBUM_CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
 BROADCAST_PASSWORD_FILE = get_txt_path('broadcast_password.txt')
 
 ITEM_DEFS = {
@@ -166,6 +181,17 @@ ITEM_DEFS = {
     }
 }
 
+# Every item is equally likely to drop
+ITEM_DROP_TABLE = AliasTable(list(ITEM_DEFS.keys()), [1] * len(ITEM_DEFS))
+
+# One stream per subsystem (see rng.py); ISOPOD_SEED makes them reproducible
+roll_rng = get_stream('roll')
+battle_rng = get_stream('battle')
+race_rng = get_stream('race')
+fishing_rng = get_stream('fishing')
+shop_rng = get_stream('shop')
+items_rng = get_stream('items')
+
 def ensure_broadcast_password_file():
     if not os.path.exists(BROADCAST_PASSWORD_FILE):
         with open(BROADCAST_PASSWORD_FILE, 'w') as f:
@@ -224,6 +250,18 @@ def resolve_item_id(conn, token):
 # witchcraft. Tread carefully unless you want surprising fish economics.
 # --------------------------------------------------------------------------------
 
+FISH_TIERS = ['common', 'rare', 'epic', 'legendary']
+# Catch odds by rod tier; the catalog itself is rolled with tier 1's
+FISH_TIER_WEIGHTS = {
+    1: [70, 20, 8, 2],
+    2: [60, 25, 12, 3],
+    3: [50, 28, 16, 6]
+}
+FISH_TIER_TABLES = {tier: AliasTable(FISH_TIERS, w) for tier, w in FISH_TIER_WEIGHTS.items()}
+
+def fish_tier_table(rod_tier):
+    return FISH_TIER_TABLES[3 if rod_tier >= 3 else 2 if rod_tier >= 2 else 1]
+
 def seed_fishing_rods(conn):
     c = conn.cursor()
     rods = [
@@ -247,19 +285,18 @@ def ensure_fish_catalog(conn):
     if c.fetchone()[0] > 0:
         return
     colors, words = load_lists()
-    tiers = ['common', 'rare', 'epic', 'legendary']
-    weights = [70, 20, 8, 2]
     tier_ranges = {
         'common': (20, 60),
         'rare': (80, 160),
         'epic': (200, 400),
         'legendary': (600, 1200)
     }
+    tiers = iter(FISH_TIER_TABLES[1].draw_many(len(colors) * len(words), fishing_rng.gen))
     for color in colors:
         for word in words:
-            tier = random.choices(tiers, weights=weights)[0]
+            tier = next(tiers)
             min_p, max_p = tier_ranges[tier]
-            price = random.randint(min_p, max_p)
+            price = fishing_rng.randint(min_p, max_p)
             name = f"{tier.capitalize()} {color.capitalize()} {word} isofish"
             c.execute('INSERT INTO fish_catalog (color, word, name, tier, price) VALUES (?, ?, ?, ?, ?)',
                       (color, word, name, tier, price))
@@ -293,35 +330,29 @@ def add_user_fish(conn, user_id, fish_id, qty=1):
 # cause more bugs than wins.
 # --------------------------------------------------------------------------------
 
-def get_shop_rotation(conn, now):
+def rotate_shop(conn, now):
     seed_shop_items(conn)
+    c = conn.cursor()
+    c.execute('SELECT item_id FROM shop_items')
+    item_ids = [r[0] for r in c.fetchall()]
+    picks = shop_rng.sample(item_ids, k=min(3, len(item_ids)))
+    c.execute('DELETE FROM shop_rotation')
+    for idx, item_id in enumerate(picks, 1):
+        c.execute('INSERT INTO shop_rotation (slot, item_id, refresh_at) VALUES (?, ?, ?)', (idx, item_id, now))
+    conn.commit()
+
+def get_shop_rotation(conn):
     c = conn.cursor()
     c.execute('SELECT slot, item_id, refresh_at FROM shop_rotation ORDER BY slot')
-    rows = c.fetchall()
-    refreshed = False
-    if not rows or any(r[2] is None for r in rows) or now - rows[0][2] >= SHOP_REFRESH:
-        c.execute('SELECT item_id FROM shop_items')
-        item_ids = [r[0] for r in c.fetchall()]
-        picks = random.sample(item_ids, k=min(3, len(item_ids)))
-        c.execute('DELETE FROM shop_rotation')
-        for idx, item_id in enumerate(picks, 1):
-            c.execute('INSERT INTO shop_rotation (slot, item_id, refresh_at) VALUES (?, ?, ?)', (idx, item_id, now))
-        conn.commit()
-        c.execute('SELECT slot, item_id, refresh_at FROM shop_rotation ORDER BY slot')
-        rows = c.fetchall()
-        refreshed = True
-    return rows, refreshed
+    return c.fetchall()
 
 def get_effect(conn, user_id, effect_type, now):
-    c = conn.cursor()
-    c.execute('SELECT effect_value, expires_at FROM user_effects WHERE user_id = ? AND effect_type = ?', (user_id, effect_type))
-    row = c.fetchone()
+    row = get_effect_row(user_id, effect_type)
     if not row:
         return None
     value, expires_at = row
     if expires_at and now > expires_at:
-        c.execute('DELETE FROM user_effects WHERE user_id = ? AND effect_type = ?', (user_id, effect_type))
-        conn.commit()
+        # Left for the sweeper, which deletes it and queues the expiry notice
         return None
     try:
         return json.loads(value)
@@ -333,76 +364,44 @@ def set_effect(conn, user_id, effect_type, value, duration=None):
     expires_at = now + duration if duration else None
     if not isinstance(value, str):
         value = json.dumps(value)
-    c = conn.cursor()
-    c.execute(
-        'INSERT OR REPLACE INTO user_effects (user_id, effect_type, effect_value, expires_at) VALUES (?, ?, ?, ?)',
-        (user_id, effect_type, value, expires_at)
-    )
-    conn.commit()
+    put_effect(user_id, effect_type, value, expires_at)
+    if expires_at:
+        # The index has it once we commit; have the sweeper come by then
+        after_commit(lambda: scheduler.wake_at('effects', expires_at))
 
 def consume_effect(conn, user_id, effect_type):
-    c = conn.cursor()
-    c.execute('DELETE FROM user_effects WHERE user_id = ? AND effect_type = ?', (user_id, effect_type))
-    conn.commit()
+    delete_effect(user_id, effect_type)
 
 def add_user_item(conn, user_id, item_id, qty=1):
-    c = conn.cursor()
-    c.execute('SELECT qty FROM user_items WHERE user_id = ? AND item_id = ?', (user_id, item_id))
-    row = c.fetchone()
-    if row:
-        c.execute('UPDATE user_items SET qty = qty + ? WHERE user_id = ? AND item_id = ?', (qty, user_id, item_id))
-    else:
-        c.execute('INSERT INTO user_items (user_id, item_id, qty) VALUES (?, ?, ?)', (user_id, item_id, qty))
-    conn.commit()
+    add_item(user_id, item_id, qty)
 
 def consume_user_item(conn, user_id, item_id, qty=1):
-    c = conn.cursor()
-    c.execute('SELECT qty FROM user_items WHERE user_id = ? AND item_id = ?', (user_id, item_id))
-    row = c.fetchone()
-    if not row or row[0] < qty:
-        return False
-    c.execute('UPDATE user_items SET qty = qty - ? WHERE user_id = ? AND item_id = ?', (qty, user_id, item_id))
-    c.execute('DELETE FROM user_items WHERE user_id = ? AND item_id = ? AND qty <= 0', (user_id, item_id))
-    conn.commit()
-    return True
+    return consume_item(user_id, item_id, qty)
 
 def get_user_item_qty(conn, user_id, item_id):
-    c = conn.cursor()
-    c.execute('SELECT qty FROM user_items WHERE user_id = ? AND item_id = ?', (user_id, item_id))
-    row = c.fetchone()
-    return row[0] if row else 0
+    return get_item_qty(user_id, item_id)
 
 # --------------------------------------------------------------------------------
 # Charge syncing + helper text
-# Handles the timed charge regen mechanic. This is pure game logic with a
-# couple of DB writes. Messing with timing constants will change pacing.
+# Handles the timed charge regen mechanic. Messing with timing constants
+# will change pacing.
+#
+# The stored (roll_charges, last_charge_at) pair is only a starting point:
+# sync_charges() derives the current count from it and now, and writes
+# nothing. Only spending or granting charges writes, and such a write must
+# store the clock the new count was derived at. Otherwise the regen since the
+# last write would be counted again, so update_user_charges() derives it
+# itself when the caller doesn't pass one.
 # --------------------------------------------------------------------------------
 
-def update_user_charges(conn, user_id, charges, last_charge_at=None):
+def derive_charges(charges, last_charge_at, now):
+    """(charges, last_charge_at) as of now, given the stored pair."""
     if charges is None:
         charges = 0
     if charges < 0:
         charges = 0
     if charges > OVERCHARGE_MAX:
         charges = OVERCHARGE_MAX
-    c = conn.cursor()
-    if last_charge_at is None:
-        c.execute('UPDATE users SET roll_charges = ? WHERE user_id = ?', (charges, user_id))
-    else:
-        c.execute('UPDATE users SET roll_charges = ?, last_charge_at = ? WHERE user_id = ?', (charges, last_charge_at, user_id))
-    conn.commit()
-
-def sync_charges(conn, user_id, now):
-    c = conn.cursor()
-    c.execute('SELECT roll_charges, last_charge_at FROM users WHERE user_id = ?', (user_id,))
-    row = c.fetchone()
-    if not row:
-        return 1, now
-    charges, last_charge_at = row
-    if charges is None:
-        charges = 0
-    if charges < 0:
-        charges = 0
     if not last_charge_at:
         last_charge_at = now
     if last_charge_at > now:
@@ -412,11 +411,25 @@ def sync_charges(conn, user_id, now):
         if charges < MAX_CHARGES:
             charges = min(MAX_CHARGES, charges + gained)
         last_charge_at = last_charge_at + gained * COOLDOWN
-        update_user_charges(conn, user_id, charges, last_charge_at)
-    else:
-        update_user_charges(conn, user_id, charges, last_charge_at)
     return charges, last_charge_at
 
+def update_user_charges(conn, user_id, charges, last_charge_at=None):
+    if charges is None:
+        charges = 0
+    if charges < 0:
+        charges = 0
+    if charges > OVERCHARGE_MAX:
+        charges = OVERCHARGE_MAX
+    if last_charge_at is None:
+        last_charge_at = sync_charges(conn, user_id, time.time())[1]
+    set_user_charges(user_id, charges, last_charge_at)
+
+def sync_charges(conn, user_id, now):
+    row = get_user_charges(user_id)
+    if not row:
+        return 1, now
+    return derive_charges(row[0], row[1], now)
+
 def charge_status_text(charges, last_charge_at, now):
     if charges is None:
         charges = 0
@@ -440,12 +453,6 @@ def charge_status_text(charges, last_charge_at, now):
 # queries that otherwise appear in multiple command handlers.
 # --------------------------------------------------------------------------------
 
-def get_user_id_by_username(conn, username):
-    c = conn.cursor()
-    c.execute('SELECT user_id FROM users WHERE username = ?', (username,))
-    row = c.fetchone()
-    return row[0] if row else None
-
 def get_isopod_record(conn, inv_id, user_id):
     c = conn.cursor()
     # SQL grab: inventory joined to marketplace and stats. This merges user
@@ -500,62 +507,52 @@ def get_isopod_record(conn, inv_id, user_id):
 # inserts it into a player's inventory. It includes image generation calls,
 # special-case rainbow handling, charge adjustments, and potential item drops.
 # It's one of the more complex command flows. Read it slowly if you change it.
+#
+# roll_once() does the game side of one roll and returns what happened;
+# send_roll_result() / send_roll_album() turn results into messages, so
+# /roll all can answer with one album instead of a message per roll.
+# roll_many() is the same game for n rolls at once: every random outcome is
+# drawn up front, the market is sampled in one go and the inventory rows
+# go in with one executemany, so /roll all costs about the same as /roll.
+# Pictures are drawn afterwards by render_roll_images(), outside the game
+# logic, and play_roll() is the whole /roll command minus the sending.
 # --------------------------------------------------------------------------------
 
-def roll_isopod(conn, uid, msg, now, guarantee=None):
-    if needs_regen():
-        generate_marketplace()
-    cid = msg.chat.id
-    if guarantee is None and random.random() < RAINBOW_CHANCE:
+def roll_once(conn, uid, now, guarantee=None):
+    """One roll. Returns {'caption', 'image', 'render', 'notes' [str]}: image
+    stays None until render_roll_images() calls render (None: no picture)."""
+    result = {'caption': None, 'image': None, 'render': None, 'notes': []}
+    if guarantee is None and roll_rng.random() < RAINBOW_CHANCE:
         logger.info(f"Rainbow rolled by {uid}")
         set_legendary(uid, True)
-        caption = "🌈 RAINBOW PILLBUG! Legendary status!"
-        rainbow_path = get_graphics_path('rainbowpillbug.png')
-        if os.path.exists(rainbow_path):
-            with open(rainbow_path, 'rb') as f:
-                bot.send_photo(cid, f, caption=caption)
-        else:
-            bot.reply_to(msg, caption)
+        result['caption'] = "🌈 RAINBOW PILLBUG! Legendary status!"
+        result['render'] = rainbow_image
         update_user_last_roll(uid, now)
-        return
+        return result
     c = conn.cursor()
-    if guarantee == 'legendary':
-        c.execute("SELECT id, full_name, status, price, color FROM marketplace WHERE status = 'legendary' ORDER BY RANDOM() LIMIT 1")
-    elif guarantee == 'rare':
-        c.execute("SELECT id, full_name, status, price, color FROM marketplace WHERE status IN ('rare','epic','legendary') ORDER BY RANDOM() LIMIT 1")
-    else:
-        c.execute('SELECT id, full_name, status, price, color FROM marketplace ORDER BY RANDOM() LIMIT 1')
-    row = c.fetchone()
+    row = sample_market(guarantee)
     if not row:
-        bot.reply_to(msg, "No market entries found.")
-        return
-    market_id, full_name, status, price, color = row
-    c.execute('SELECT hp, attack, moves_json FROM isopod_stats WHERE market_id = ?', (market_id,))
-    stats = c.fetchone()
-    hp, attack, moves_json = stats if stats else (20, 5, '[]')
-    img_path = generate_isopod_image(color)
-    caption = f"{full_name}\n💰 {price} iso$\n❤️ {hp} | ⚔️ {attack}"
-    with open(img_path, 'rb') as f:
-        bot.send_photo(cid, f, caption=caption)
-    cleanup_temp()
+        result['caption'] = "No market entries found."
+        return result
+    market_id, full_name, status, price, color, hp, attack, moves_json = row
+    result['caption'] = f"{full_name}\n💰 {price} iso$\n❤️ {hp} | ⚔️ {attack}"
+    result['render'] = functools.partial(generate_isopod_image, color)
     c.execute('''
         INSERT INTO inventory (user_id, market_id, name, status, price, color, hp, attack, moves_json, level, xp)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     ''', (uid, market_id, full_name, status, price, color, hp, attack, moves_json, 1, 0))
     conn.commit()
     logger.info(f"Rolled '{full_name}' (price {price}, market_id {market_id}) for {uid}")
-    if random.random() < HEAL_CHANCE:
-        c.execute('SELECT roll_charges FROM users WHERE user_id = ?', (uid,))
-        charges = c.fetchone()[0]
+    if roll_rng.random() < HEAL_CHANCE:
+        charges = get_user_charges(uid)[0]
         charges = min(MAX_CHARGES, charges + 1)
         update_user_charges(conn, uid, charges)
-        bot.reply_to(msg, "💚 Healing pill bug! +1 charge")
-    elif random.random() < NERF_CHANCE:
+        result['notes'].append("💚 Healing pill bug! +1 charge")
+    elif roll_rng.random() < NERF_CHANCE:
         extra = 600
-        c.execute('SELECT roll_charges FROM users WHERE user_id = ?', (uid,))
-        charges = c.fetchone()[0]
+        charges = get_user_charges(uid)[0]
         update_user_charges(conn, uid, charges, now + extra)
-        bot.reply_to(msg, "😵 Bit you! Next charge delayed by 10 minutes!")
+        result['notes'].append("😵 Bit you! Next charge delayed by 10 minutes!")
     update_user_last_roll(uid, now)
     drop_chance = ITEM_DROP_CHANCE
     boost = get_effect(conn, uid, 'item_drop_boost', now)
@@ -564,10 +561,149 @@ def roll_isopod(conn, uid, msg, now, guarantee=None):
             drop_chance *= float(boost)
         except Exception:
             pass
-    if random.random() < drop_chance:
-        item_id = random.choice(list(ITEM_DEFS.keys()))
+    if roll_rng.random() < drop_chance:
+        item_id = ITEM_DROP_TABLE.draw(roll_rng)
         add_user_item(conn, uid, item_id, 1)
-        bot.reply_to(msg, f"🎁 {ITEM_DEFS[item_id]['name']}!")
+        result['notes'].append(f"🎁 {ITEM_DEFS[item_id]['name']}!")
+    return result
+
+def send_roll_result(msg, result):
+    if result['image']:
+        send_photo_cached(msg.chat.id, result['image'], caption=result['caption'])
+    else:
+        bot.reply_to(msg, result['caption'])
+    for note in result['notes']:
+        bot.reply_to(msg, note)
+
+def send_roll_album(msg, results, footer):
+    """Every result in one album with a single summary caption, instead of a
+    photo plus notes per roll. Numbers match the pictures' order; a result
+    with no picture gets a bullet. Whatever doesn't fit in the caption
+    follows as text replies."""
+    lines = []
+    number = 0
+    for result in results:
+        if result['image']:
+            number += 1
+            prefix = f"{number}. "
+        else:
+            prefix = "• "
+        lines.append(prefix + result['caption'].replace("\n", " | "))
+        lines.extend(f"   {note}" for note in result['notes'])
+    lines.append(footer)
+    images = [r['image'] for r in results if r['image']]
+    chunks = pack_lines(lines, ALBUM_CAPTION_LIMIT if images else MESSAGE_LIMIT)
+    caption = chunks[0]
+    if not images:
+        bot.reply_to(msg, caption)
+    elif len(images) == 1:
+        send_photo_cached(msg.chat.id, images[0], caption=caption)
+    else:
+        send_album_cached(msg.chat.id, images, caption)
+    for text in chunks[1:]:
+        bot.reply_to(msg, text)
+
+def pack_lines(lines, first_limit, limit=MESSAGE_LIMIT):
+    """Join lines into as few texts as fit: the first at most first_limit
+    characters, the rest at most limit. A line longer than that is split."""
+    chunks = []
+    current = ''
+    cap = first_limit
+    for line in lines:
+        while line:
+            sep = "\n" if current else ''
+            if len(current) + len(sep) + len(line) <= cap:
+                current += sep + line
+                line = ''
+                continue
+            if not current:
+                current, line = line[:cap], line[cap:]
+            chunks.append(current)
+            current = ''
+            cap = limit
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+def render_roll_images(results):
+    """Draw every result's picture. Kept apart from the game logic so the
+    async bot can do it on its render executor."""
+    for result in results:
+        if result['render'] is not None and result['image'] is None:
+            result['image'] = result['render']()
+    return results
+
+def send_roll_results(msg, results, status):
+    if len(results) == 1:
+        send_roll_result(msg, results[0])
+        bot.reply_to(msg, status)
+    else:
+        send_roll_album(msg, results, status)
+
+def roll_many(conn, uid, n, now, guarantee=None):
+    """n rolls, same odds and effects as n roll_once() calls. Returns a list
+    of results shaped like roll_once()'s."""
+    # Columns: rainbow, heal, nerf, item drop
+    u = roll_rng.uniforms((n, 4)).tolist()
+    # guarantee only covers the first roll, and a guaranteed roll is never a rainbow
+    rainbows = [not (i == 0 and guarantee) and u[i][0] < RAINBOW_CHANCE for i in range(n)]
+    rows = iter(sample_market_many(rainbows.count(False), guarantee))
+    drops = iter(ITEM_DROP_TABLE.draw_many(n, roll_rng.gen))
+    drop_chance = ITEM_DROP_CHANCE
+    boost = get_effect(conn, uid, 'item_drop_boost', now)
+    if boost:
+        try:
+            drop_chance *= float(boost)
+        except Exception:
+            pass
+    charges = None
+    nerfed_until = None
+    results = []
+    inserts = []
+    for rainbow, (_, heal_u, nerf_u, drop_u) in zip(rainbows, u):
+        result = {'caption': None, 'image': None, 'render': None, 'notes': []}
+        results.append(result)
+        if rainbow:
+            result['caption'] = "🌈 RAINBOW PILLBUG! Legendary status!"
+            result['render'] = rainbow_image
+            continue
+        row = next(rows)
+        if not row:
+            result['caption'] = "No market entries found."
+            continue
+        market_id, full_name, status, price, color, hp, attack, moves_json = row
+        result['caption'] = f"{full_name}\n💰 {price} iso$\n❤️ {hp} | ⚔️ {attack}"
+        result['render'] = functools.partial(generate_isopod_image, color)
+        inserts.append((uid, market_id, full_name, status, price, color, hp, attack, moves_json, 1, 0))
+        if heal_u < HEAL_CHANCE:
+            if charges is None:
+                charges = get_user_charges(uid)[0]
+            charges = min(MAX_CHARGES, charges + 1)
+            result['notes'].append("💚 Healing pill bug! +1 charge")
+        elif nerf_u < NERF_CHANCE:
+            if charges is None:
+                charges = get_user_charges(uid)[0]
+            nerfed_until = now + 600
+            result['notes'].append("😵 Bit you! Next charge delayed by 10 minutes!")
+        if drop_u < drop_chance:
+            item_id = next(drops)
+            add_user_item(conn, uid, item_id, 1)
+            result['notes'].append(f"🎁 {ITEM_DEFS[item_id]['name']}!")
+    if inserts:
+        conn.cursor().executemany('''
+            INSERT INTO inventory (user_id, market_id, name, status, price, color, hp, attack, moves_json, level, xp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', inserts)
+    if any(rainbows):
+        logger.info(f"Rainbow rolled by {uid}")
+        set_legendary(uid, True)
+    if charges is not None:
+        update_user_charges(conn, uid, charges, nerfed_until)
+    if inserts or any(rainbows):
+        update_user_last_roll(uid, now)
+    conn.commit()
+    logger.info(f"Rolled {len(inserts)} isopods in one batch for {uid}")
+    return results
 
 # --------------------------------------------------------------------------------
 # Short utility view / formatting helpers
@@ -600,6 +736,49 @@ def send_to_users(user_ids, text):
             continue
     return sent
 
+# --------------------------------------------------------------------------------
+# Outgoing messages
+# Handlers run in a unit of work (@transactional). Once one has written
+# anything, SQLite's write lock is held until the command commits, so every
+# Telegram call made after that held the other writers up for as long as
+# Telegram took. Those sends are now queued on the unit of work and go out
+# once it has committed; sends before the first write (like "🎣 Casting..."
+# ahead of the wait) still go straight out.
+#
+# A queued send that fails is logged; the purchase or transfer it reports
+# stays committed. If the command rolls back, its queued messages are
+# dropped with it.
+# --------------------------------------------------------------------------------
+
+SEND_METHODS = ('reply_to', 'send_message', 'send_photo', 'send_media_group')
+
+def deferred_send(func):
+    """func as is, or queued until commit once the command has written something."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not has_pending_writes():
+            return func(*args, **kwargs)
+        def send():
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception(f"Sending {func.__name__} after commit failed")
+        after_commit(send)
+        return None
+    return wrapper
+
+class Messenger:
+    """The TeleBot as handlers see it (bot.bot): the send methods go through
+    deferred_send, everything else is the client's own."""
+
+    def __init__(self, client):
+        self.client = client
+        for name in SEND_METHODS:
+            setattr(self, name, deferred_send(getattr(client, name)))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
 def send_to_chat(chat_id, text):
     try:
         bot.send_message(chat_id, text)
@@ -614,15 +793,102 @@ def send_silent_to_chat(chat_id, text):
     except Exception:
         return False
 
+# Photos go out by file_id once Telegram has seen the bytes. If it rejects an
+# old id (bot token changed, file expired) we forget it and upload again;
+# any other error is raised as usual. Upload bytes are also counted per
+# output profile, to compare profiles.
+photo_stats = {'uploads': 0, 'reused': 0, 'stale': 0, 'bytes_uploaded': 0, 'bytes_by_profile': {}}
+_photo_stats_lock = threading.Lock()
+
+# Bits of the 400 descriptions Telegram gives for a file_id it won't take
+STALE_FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'file_id', 'file reference')
+
+def is_stale_file_id_error(e):
+    description = (getattr(e, 'description', None) or '').lower()
+    return e.error_code == 400 and any(s in description for s in STALE_FILE_ID_ERRORS)
+
+def count_photo(stat, n=1):
+    with _photo_stats_lock:
+        photo_stats[stat] += n
+
+def photo_stats_snapshot():
+    with _photo_stats_lock:
+        data = dict(photo_stats)
+        data['bytes_by_profile'] = dict(photo_stats['bytes_by_profile'])
+    return data
+
+@deferred_send
+def send_photo_cached(chat_id, data, caption=None):
+    content_hash = hashlib.sha256(data).hexdigest()
+    file_id = get_photo_file_id(content_hash)
+    if file_id:
+        try:
+            sent = bot.send_photo(chat_id, file_id, caption=caption)
+            count_photo('reused')
+            return sent
+        except telebot.apihelper.ApiTelegramException as e:
+            if not is_stale_file_id_error(e):
+                raise
+            logger.info(f"Stale photo file_id for {content_hash[:12]}: {e.description}")
+            count_photo('stale')
+            forget_photo_file_id(content_hash)
+    sent = bot.send_photo(chat_id, data, caption=caption)
+    _count_upload(data)
+    if sent is not None and getattr(sent, 'photo', None):
+        save_photo_file_id(content_hash, sent.photo[-1].file_id)
+    return sent
+
+@deferred_send
+def send_album_cached(chat_id, images, caption=None):
+    """send_media_group for up to ALBUM_MAX images per album, using cached
+    file_ids where we have them. caption goes on the first photo."""
+    for start in range(0, len(images), ALBUM_MAX):
+        chunk = images[start:start + ALBUM_MAX]
+        hashes = [hashlib.sha256(data).hexdigest() for data in chunk]
+        file_ids = [get_photo_file_id(h) for h in hashes]
+        chunk_caption = caption if start == 0 else None
+        try:
+            sent = _send_album(chat_id, chunk, file_ids, chunk_caption)
+        except telebot.apihelper.ApiTelegramException as e:
+            if not any(file_ids) or not is_stale_file_id_error(e):
+                raise
+            logger.info(f"Album with cached file_ids rejected, re-uploading: {e.description}")
+            count_photo('stale')
+            for content_hash, file_id in zip(hashes, file_ids):
+                if file_id:
+                    forget_photo_file_id(content_hash)
+            file_ids = [None] * len(chunk)
+            sent = _send_album(chat_id, chunk, file_ids, chunk_caption)
+        for content_hash, file_id, message in zip(hashes, file_ids, sent or []):
+            if not file_id and getattr(message, 'photo', None):
+                save_photo_file_id(content_hash, message.photo[-1].file_id)
+
+def _send_album(chat_id, images, file_ids, caption):
+    return bot.send_media_group(chat_id, _album_media(images, file_ids, caption))
+
+def _album_media(images, file_ids, caption):
+    media = []
+    for i, (data, file_id) in enumerate(zip(images, file_ids)):
+        media.append(telebot.types.InputMediaPhoto(file_id or data, caption=caption if i == 0 else None))
+        if file_id:
+            count_photo('reused')
+        else:
+            _count_upload(data)
+    return media
+
+def _count_upload(data):
+    # Looked up here, not imported: the profile can be switched at runtime
+    profile = utils.OUTPUT_PROFILE
+    with _photo_stats_lock:
+        photo_stats['uploads'] += 1
+        photo_stats['bytes_uploaded'] += len(data)
+        by_profile = photo_stats['bytes_by_profile']
+        by_profile[profile] = by_profile.get(profile, 0) + len(data)
+
 def notify_expired_effects(conn, user_id, chat_id, now):
-    c = conn.cursor()
-    c.execute('SELECT effect_type FROM user_effects WHERE user_id = ? AND expires_at IS NOT NULL AND expires_at <= ?', (user_id, now))
-    rows = c.fetchall()
-    if not rows:
+    expired = pop_expired_effects(user_id, now)
+    if not expired:
         return
-    expired = [r[0] for r in rows]
-    c.execute('DELETE FROM user_effects WHERE user_id = ? AND expires_at IS NOT NULL AND expires_at <= ?', (user_id, now))
-    conn.commit()
     names = {
         'item_drop_boost': 'Item drop boost'
     }
@@ -650,10 +916,8 @@ def run_battle(conn, challenger_id, target_id, challenger_inv_id, target_inv_id,
         target_boost = float(target_boost) if target_boost else 0.0
     except Exception:
         target_boost = 0.2
-    c.execute('SELECT username FROM users WHERE user_id = ?', (challenger_id,))
-    challenger_name = c.fetchone()[0] or 'challenger'
-    c.execute('SELECT username FROM users WHERE user_id = ?', (target_id,))
-    target_name = c.fetchone()[0] or 'target'
+    challenger_name = get_username(challenger_id) or 'challenger'
+    target_name = get_username(target_id) or 'target'
     hp1 = challenger['hp']
     hp2 = target['hp']
     moves1 = challenger['moves'] or [{'name': 'Tackle', 'power': challenger['attack']}]
@@ -661,10 +925,10 @@ def run_battle(conn, challenger_id, target_id, challenger_inv_id, target_inv_id,
     rounds = 0
     while hp1 > 0 and hp2 > 0 and rounds < 20:
         rounds += 1
-        move1 = random.choice(moves1)
-        move2 = random.choice(moves2)
-        dmg1 = max(1, int(move1['power']) + random.randint(-2, 2))
-        dmg2 = max(1, int(move2['power']) + random.randint(-2, 2))
+        move1 = battle_rng.choice(moves1)
+        move2 = battle_rng.choice(moves2)
+        dmg1 = max(1, int(move1['power']) + battle_rng.randint(-2, 2))
+        dmg2 = max(1, int(move2['power']) + battle_rng.randint(-2, 2))
         if target_boost:
             dmg1 = max(1, int(dmg1 * (1 - target_boost)))
         if challenger_boost:
@@ -677,13 +941,13 @@ def run_battle(conn, challenger_id, target_id, challenger_inv_id, target_inv_id,
         )
         send_to_chat(chat_id, text)
     if hp1 <= 0 and hp2 <= 0:
-        winner_id = challenger_id if random.random() < 0.5 else target_id
+        winner_id = challenger_id if battle_rng.random() < 0.5 else target_id
     elif hp1 > hp2:
         winner_id = challenger_id
     else:
         winner_id = target_id
     loser_id = target_id if winner_id == challenger_id else challenger_id
-    reward = random.randint(50, 120) + int((challenger['price'] + target['price']) / 15)
+    reward = battle_rng.randint(50, 120) + int((challenger['price'] + target['price']) / 15)
     update_user_money(winner_id, reward)
     safety = get_effect(conn, loser_id, 'safety_net', time.time())
     if safety:
@@ -721,10 +985,10 @@ def run_race(conn, challenger_id, target_id, challenger_inv_id, target_inv_id, c
         target_boost = float(target_boost) if target_boost else 0.0
     except Exception:
         target_boost = 0.2
-    speed1 = random.uniform(1.0, 10.0) * (1 + challenger_boost)
-    speed2 = random.uniform(1.0, 10.0) * (1 + target_boost)
+    speed1 = race_rng.uniform(1.0, 10.0) * (1 + challenger_boost)
+    speed2 = race_rng.uniform(1.0, 10.0) * (1 + target_boost)
     if speed1 == speed2:
-        winner_id = challenger_id if random.random() < 0.5 else target_id
+        winner_id = challenger_id if race_rng.random() < 0.5 else target_id
     elif speed1 > speed2:
         winner_id = challenger_id
     else:
@@ -732,10 +996,8 @@ def run_race(conn, challenger_id, target_id, challenger_inv_id, target_inv_id, c
     loser_id = target_id if winner_id == challenger_id else challenger_id
     update_user_money(winner_id, bet)
     update_user_money(loser_id, -bet)
-    c.execute('SELECT username FROM users WHERE user_id = ?', (challenger_id,))
-    challenger_name = c.fetchone()[0] or 'challenger'
-    c.execute('SELECT username FROM users WHERE user_id = ?', (target_id,))
-    target_name = c.fetchone()[0] or 'target'
+    challenger_name = get_username(challenger_id) or 'challenger'
+    target_name = get_username(target_id) or 'target'
     winner_name = challenger_name if winner_id == challenger_id else target_name
     loser_name = target_name if winner_id == challenger_id else challenger_name
     text = (
@@ -746,18 +1008,72 @@ def run_race(conn, challenger_id, target_id, challenger_inv_id, target_inv_id, c
     send_to_chat(chat_id, text)
     return True, "Race completed"
 
-init_db()
-ensure_broadcast_password_file()
-conn = get_conn()
-seed_fishing_rods(conn)
-ensure_fish_catalog(conn)
-conn.close()
-if needs_regen():
+# --------------------------------------------------------------------------------
+# Background jobs
+# Market regen and shop rotation run on the scheduler thread. Deadlines are
+# read from the DB once here; after that they only live in the scheduler, so
+# /market and /shop just ask scheduler.next_run(). Expired effects are swept
+# there too, and notify_expired_effects() only reads what the sweep queued.
+# --------------------------------------------------------------------------------
+
+def regenerate_market_job():
     generate_marketplace()
 
-bot = telebot.TeleBot(TOKEN)
+def rotate_shop_job():
+    conn = open_standalone_conn()
+    try:
+        rotate_shop(conn, time.time())
+    finally:
+        conn.close()
+
+def sweep_effects_job():
+    """Sweep what has expired, then sleep until the next effect does."""
+    sweep_expired_effects()
+    expiry = next_effect_expiry()
+    if expiry is not None:
+        scheduler.wake_at('effects', expiry)
+
+def schedule_background_jobs():
+    last_regen = last_market_regen()
+    scheduler.add_job('market', MARKET_REFRESH, regenerate_market_job,
+                      next_run=(last_regen + MARKET_REFRESH) if last_regen else None)
+    conn = get_conn()
+    rows = get_shop_rotation(conn)
+    conn.close()
+    shop_next = None
+    if rows and all(r[2] is not None for r in rows):
+        shop_next = rows[0][2] + SHOP_REFRESH
+    scheduler.add_job('shop', SHOP_REFRESH, rotate_shop_job, next_run=shop_next)
+    if init_storage() is not None:
+        scheduler.add_job('snapshot', SNAPSHOT_INTERVAL, snapshot_store, next_run=time.time() + SNAPSHOT_INTERVAL)
+    scheduler.add_job('effects', EFFECT_SWEEP_INTERVAL, sweep_effects_job)
+    scheduler.add_job('photo_uses', PHOTO_USES_FLUSH_INTERVAL, flush_photo_uses, next_run=time.time() + PHOTO_USES_FLUSH_INTERVAL)
+    # Catch up on anything overdue before we start answering commands
+    scheduler.run_pending()
+    scheduler.start()
+
+def seconds_until(job_name, now):
+    next_run = scheduler.next_run(job_name)
+    if next_run is None:
+        return None
+    return max(0, int(next_run - now))
+
+def start_services():
+    """Schema, seed data and background threads; both entry points call this
+    before polling (bot.py here, async_bot.py for the asyncio runtime)."""
+    init_db()
+    ensure_broadcast_password_file()
+    conn = get_conn()
+    seed_fishing_rods(conn)
+    ensure_fish_catalog(conn)
+    conn.close()
+    schedule_background_jobs()
+    variant_pool.start()
+
+bot = Messenger(telebot.TeleBot(TOKEN))
 
 @bot.message_handler(commands=['start'])
+@transactional
 def start(msg):
     logger.info(f"Start/help by user {msg.from_user.id}")
     uid = msg.from_user.id
@@ -768,6 +1084,7 @@ Use /help to see all commands."""
     bot.reply_to(msg, text)
 
 @bot.message_handler(commands=['help'])
+@transactional
 def help_command(msg):
     text = """📜 Commands
 
@@ -802,6 +1119,18 @@ def help_command(msg):
 
 @bot.message_handler(commands=['roll', 'r'])
 def roll(msg):
+    # Commit the roll first; drawing and sending happen without the write lock
+    with unit_of_work():
+        results, status = play_roll(msg)
+    if results is None:
+        bot.reply_to(msg, status)
+        return
+    render_roll_images(results)
+    send_roll_results(msg, results, status)
+
+def play_roll(msg):
+    """Spend charges and roll for /roll (or /roll all). Returns (results,
+    status line), or (None, reply) when there was nothing to roll."""
     uid = msg.from_user.id
     logger.info(f"Roll attempt by {uid}")
     get_or_create_user(uid, msg.from_user.username or 'unknown')
@@ -818,11 +1147,10 @@ def roll(msg):
         count = charges
     if count <= 0:
         status = charge_status_text(charges, last_charge_at, now)
-        bot.reply_to(msg, f"⏳ No charges. {status}")
         conn.close()
-        return
+        return None, f"⏳ No charges. {status}"
     charges -= count
-    update_user_charges(conn, uid, charges)
+    update_user_charges(conn, uid, charges, last_charge_at)
     guarantee = get_effect(conn, uid, 'guarantee_legendary', now)
     if guarantee:
         consume_effect(conn, uid, 'guarantee_legendary')
@@ -832,30 +1160,43 @@ def roll(msg):
         if guarantee:
             consume_effect(conn, uid, 'guarantee_rare')
             guarantee = 'rare'
-    for _ in range(count):
-        roll_isopod(conn, uid, msg, now, guarantee)
-        guarantee = None
+    if count == 1:
+        results = [roll_once(conn, uid, now, guarantee)]
+    else:
+        results = roll_many(conn, uid, count, now, guarantee)
     charges, last_charge_at = sync_charges(conn, uid, time.time())
-    bot.reply_to(msg, charge_status_text(charges, last_charge_at, time.time()))
+    status = charge_status_text(charges, last_charge_at, time.time())
     conn.close()
+    return results, status
 
 @bot.message_handler(commands=['instantroll', 'instaroll'])
 def instantroll(msg):
+    # Pay, top up and roll in one commit; then draw and send as /roll does
+    with unit_of_work():
+        results, status = play_instantroll(msg)
+    if results is None:
+        bot.reply_to(msg, status)
+        return
+    render_roll_images(results)
+    send_roll_results(msg, results, status)
+
+def play_instantroll(msg):
+    """play_roll() after paying for a charge. Same return as play_roll()."""
     uid = msg.from_user.id
     user = get_or_create_user(uid, msg.from_user.username or 'unknown')
     if user['money'] < INSTANTROLL_PRICE:
-        bot.reply_to(msg, f"💸 Need {INSTANTROLL_PRICE} iso$")
-        return
+        return None, f"💸 Need {INSTANTROLL_PRICE} iso$"
     update_user_money(uid, -INSTANTROLL_PRICE)
     conn = get_conn()
     now = time.time()
     charges, last_charge_at = sync_charges(conn, uid, now)
     if charges < 1:
-        update_user_charges(conn, uid, 1)
+        update_user_charges(conn, uid, 1, last_charge_at)
     conn.close()
-    roll(msg)
+    return play_roll(msg)
 
 @bot.message_handler(commands=['inventory'])
+@transactional
 def inventory(msg):
     uid = msg.from_user.id
     logger.info(f"Inventory request by {uid}")
@@ -892,6 +1233,7 @@ def inventory(msg):
     conn.close()
 
 @bot.message_handler(commands=['charges'])
+@transactional
 def charges(msg):
     uid = msg.from_user.id
     get_or_create_user(uid, msg.from_user.username or 'unknown')
@@ -903,6 +1245,7 @@ def charges(msg):
     conn.close()
 
 @bot.message_handler(commands=['items', 'item'])
+@transactional
 def items(msg):
     uid = msg.from_user.id
     conn = get_conn()
@@ -954,17 +1297,14 @@ def items(msg):
         bot.reply_to(msg, f"✅ Sold {qty}x {item_id} for {sell_price * qty} iso$")
         conn.close()
         return
-    c.execute('''
-        SELECT ui.item_id, ui.qty, si.name, si.description
-        FROM user_items ui LEFT JOIN shop_items si ON ui.item_id = si.item_id
-        WHERE ui.user_id = ? AND ui.qty > 0
-        ORDER BY ui.qty DESC
-    ''', (uid,))
-    rows = c.fetchall()
-    if not rows:
+    owned = list_items(uid)
+    if not owned:
         bot.reply_to(msg, "🧰 No items")
         conn.close()
         return
+    c.execute('SELECT item_id, name, description FROM shop_items')
+    catalog = {item_id: (name, desc) for item_id, name, desc in c.fetchall()}
+    rows = [(item_id, qty) + catalog.get(item_id, (None, None)) for item_id, qty in owned]
     short_map = get_item_short_map(conn)
     item_id_to_short = {v: k for k, v in short_map.items()}
     lines = ["🧰 Items:"]
@@ -981,21 +1321,18 @@ def items(msg):
     conn.close()
 
 @bot.message_handler(commands=['shop'])
+@transactional
 def shop(msg):
     conn = get_conn()
     now = time.time()
     notify_expired_effects(conn, msg.from_user.id, msg.chat.id, now)
-    rows, refreshed = get_shop_rotation(conn, now)
-    if refreshed:
-        send_silent_to_chat(msg.chat.id, "🛒 Shop refreshed")
+    rows = get_shop_rotation(conn)
     c = conn.cursor()
     short_map = get_item_short_map(conn)
     item_id_to_short = {v: k for k, v in short_map.items()}
     lines = ["🛒 Shop (rotates hourly):"]
-    if rows and rows[0][2]:
-        next_refresh = int(rows[0][2] + SHOP_REFRESH - now)
-        if next_refresh < 0:
-            next_refresh = 0
+    next_refresh = seconds_until('shop', now)
+    if rows and next_refresh is not None:
         m, s = divmod(next_refresh, 60)
         lines.append(f"Next refresh in {m}m {s:02d}s")
     for slot, item_id, refresh_at in rows:
@@ -1012,10 +1349,27 @@ def shop(msg):
 
 @bot.message_handler(commands=['fishing'])
 def fishing(msg):
+    # /fishing start waits for a bite between two commits, so nothing holds
+    # the write lock through the sleep; the catch is drawn after the second
+    with unit_of_work():
+        cast = play_fishing(msg)
+    if cast is None:
+        return
+    time.sleep(cast['speed_sec'])
+    with unit_of_work():
+        catch = land_fishing(msg, cast)
+    if catch is None:
+        return
+    render_fishing_image(catch)
+    send_fishing_catch(msg, catch)
+
+def play_fishing(msg):
+    """Everything /fishing does up to the cast. Returns the cast for
+    land_fishing() after /fishing start, None when the command is done."""
     parts = msg.text.split()
     if len(parts) < 2:
         bot.reply_to(msg, "Use: /fishing shop | /fishing buy <rod_id> | /fishing start <rod_id> <isopod_id> | /fishing inventory")
-        return
+        return None
     action = parts[1].lower()
     uid = msg.from_user.id
     conn = get_conn()
@@ -1046,8 +1400,7 @@ def fishing(msg):
             conn.close()
             return
         name, price = row
-        c.execute('SELECT money FROM users WHERE user_id = ?', (uid,))
-        money = c.fetchone()[0]
+        money = get_user_money(uid)
         if money < price:
             bot.reply_to(msg, f"💸 Need {price} iso$")
             conn.close()
@@ -1110,60 +1463,87 @@ def fishing(msg):
             bot.reply_to(msg, "Unlock that isopod before using it as bait")
             conn.close()
             return
-        name, price, tier, bite_chance, save_bait_chance, multi_catch_max, speed_sec, bonus_item_chance = rod
         bot.reply_to(msg, "🎣 Casting...")
-        time.sleep(float(speed_sec))
-        bait_saved = random.random() < float(save_bait_chance)
-        bite = random.random() < float(bite_chance)
-        if not bite:
-            if not bait_saved:
-                c.execute('DELETE FROM inventory WHERE id = ? AND user_id = ?', (bait_id, uid))
-                conn.commit()
-                bot.reply_to(msg, "No bites. Bait consumed.")
-            else:
-                bot.reply_to(msg, "No bites. Bait saved.")
-            conn.close()
-            return
-        weights = [70, 20, 8, 2]
-        if tier >= 2:
-            weights = [60, 25, 12, 3]
-        if tier >= 3:
-            weights = [50, 28, 16, 6]
-        tiers = ['common', 'rare', 'epic', 'legendary']
-        fish_tier = random.choices(tiers, weights=weights)[0]
-        c.execute('SELECT id, name, price, color FROM fish_catalog WHERE tier = ? ORDER BY RANDOM() LIMIT 1', (fish_tier,))
-        fish = c.fetchone()
-        if not fish:
-            bot.reply_to(msg, "No fish available. Try again.")
-            conn.close()
-            return
-        fish_id, fish_name, fish_price, fish_color = fish
-        count = 1
-        if multi_catch_max and multi_catch_max > 1:
-            count = random.randint(1, int(multi_catch_max))
-        add_user_fish(conn, uid, fish_id, count)
+        conn.close()
+        return {'rod': rod, 'bait_id': bait_id, 'speed_sec': float(rod[6])}
+    bot.reply_to(msg, "Unknown fishing command")
+    conn.close()
+    return None
+
+def land_fishing(msg, cast):
+    """The catch for a cast from play_fishing(). The bait is checked again,
+    since it could have been sold or locked while the line was out. Returns
+    the catch for render_fishing_image() and send_fishing_catch(), or None."""
+    uid = msg.from_user.id
+    bait_id = cast['bait_id']
+    name, price, tier, bite_chance, save_bait_chance, multi_catch_max, speed_sec, bonus_item_chance = cast['rod']
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT locked FROM inventory WHERE id = ? AND user_id = ?', (bait_id, uid))
+    bait = c.fetchone()
+    if not bait or bait[0]:
+        bot.reply_to(msg, "Bait isopod is gone, reel in")
+        conn.close()
+        return None
+    bait_saved = fishing_rng.random() < float(save_bait_chance)
+    bite = fishing_rng.random() < float(bite_chance)
+    if not bite:
         if not bait_saved:
             c.execute('DELETE FROM inventory WHERE id = ? AND user_id = ?', (bait_id, uid))
-        conn.commit()
-        bonus_text = ""
-        if random.random() < float(bonus_item_chance):
-            item_id = random.choice(list(ITEM_DEFS.keys()))
-            add_user_item(conn, uid, item_id, 1)
-            bonus_text = f" + Bonus item: {ITEM_DEFS[item_id]['name']}"
-        caption = f"🐟 Caught {count}x {fish_name} ({fish_tier}) 💰{fish_price} each.{bonus_text}"
-        try:
-            img_path = generate_isofish_image(fish_color or 'blue')
-            with open(img_path, 'rb') as f:
-                bot.send_photo(msg.chat.id, f, caption=caption)
-            cleanup_temp()
-        except Exception:
-            bot.reply_to(msg, caption)
+            conn.commit()
+            bot.reply_to(msg, "No bites. Bait consumed.")
+        else:
+            bot.reply_to(msg, "No bites. Bait saved.")
         conn.close()
-        return
-    bot.reply_to(msg, "Unknown fishing command")
+        return None
+    fish_tier = fish_tier_table(tier).draw(fishing_rng)
+    # Picked by offset from fishing_rng rather than ORDER BY RANDOM(), which can't be seeded
+    c.execute('SELECT COUNT(*) FROM fish_catalog WHERE tier = ?', (fish_tier,))
+    available = c.fetchone()[0]
+    fish = None
+    if available:
+        c.execute('SELECT id, name, price, color FROM fish_catalog WHERE tier = ? ORDER BY id LIMIT 1 OFFSET ?',
+                  (fish_tier, fishing_rng.randrange(available)))
+        fish = c.fetchone()
+    if not fish:
+        bot.reply_to(msg, "No fish available. Try again.")
+        conn.close()
+        return None
+    fish_id, fish_name, fish_price, fish_color = fish
+    count = 1
+    if multi_catch_max and multi_catch_max > 1:
+        count = fishing_rng.randint(1, int(multi_catch_max))
+    add_user_fish(conn, uid, fish_id, count)
+    if not bait_saved:
+        c.execute('DELETE FROM inventory WHERE id = ? AND user_id = ?', (bait_id, uid))
+    conn.commit()
+    bonus_text = ""
+    if fishing_rng.random() < float(bonus_item_chance):
+        item_id = ITEM_DROP_TABLE.draw(fishing_rng)
+        add_user_item(conn, uid, item_id, 1)
+        bonus_text = f" + Bonus item: {ITEM_DEFS[item_id]['name']}"
+    caption = f"🐟 Caught {count}x {fish_name} ({fish_tier}) 💰{fish_price} each.{bonus_text}"
     conn.close()
+    return {'caption': caption, 'color': fish_color or 'blue', 'image': None}
+
+def render_fishing_image(catch):
+    """Draw the catch's picture (CPU only, no database)."""
+    try:
+        catch['image'] = generate_isofish_image(catch['color'])
+    except Exception:
+        logger.exception("Isofish render failed")
+
+def send_fishing_catch(msg, catch):
+    if catch['image'] is not None:
+        try:
+            send_photo_cached(msg.chat.id, catch['image'], caption=catch['caption'])
+            return
+        except Exception:
+            logger.exception("Sending the catch picture failed")
+    bot.reply_to(msg, catch['caption'])
 
 @bot.message_handler(commands=['buy'])
+@transactional
 def buy(msg):
     parts = msg.text.split()
     if len(parts) < 2:
@@ -1178,9 +1558,7 @@ def buy(msg):
     uid = msg.from_user.id
     now = time.time()
     notify_expired_effects(conn, uid, msg.chat.id, now)
-    rows, refreshed = get_shop_rotation(conn, now)
-    if refreshed:
-        send_silent_to_chat(msg.chat.id, "🛒 Shop refreshed")
+    rows = get_shop_rotation(conn)
     shop_ids = [r[1] for r in rows]
     if item_id not in shop_ids:
         bot.reply_to(msg, "Item not in current shop")
@@ -1205,8 +1583,7 @@ def buy(msg):
                 consume_effect(conn, uid, 'shop_discount')
             else:
                 set_effect(conn, uid, 'shop_discount', {'percent': percent, 'uses': uses})
-    c.execute('SELECT money FROM users WHERE user_id = ?', (uid,))
-    money = c.fetchone()[0]
+    money = get_user_money(uid)
     if money < price:
         bot.reply_to(msg, f"💸 Need {price} iso$")
         conn.close()
@@ -1217,6 +1594,7 @@ def buy(msg):
     conn.close()
 
 @bot.message_handler(commands=['sell', 's', 'sellall', 'sall'])
+@transactional
 def sell(msg):
     text = msg.text.split()
     if text and text[0] in ['/sellall', '/sall']:
@@ -1294,6 +1672,7 @@ def sell(msg):
     conn.close()
 
 @bot.message_handler(commands=['lock', 'unlock'])
+@transactional
 def lock_isopod(msg):
     parts = msg.text.split()
     if len(parts) < 2:
@@ -1323,6 +1702,7 @@ def lock_isopod(msg):
         bot.reply_to(msg, f"🔓 Unlocked isopod {inv_id}")
 
 @bot.message_handler(commands=['breed'])
+@transactional
 def breed_isopods(msg):
     parts = msg.text.split()
     if len(parts) < 3:
@@ -1402,7 +1782,7 @@ def breed_isopods(msg):
     if not unique:
         unique = [{'name': 'Tackle', 'power': new_atk}]
     if len(unique) > 4:
-        unique = random.sample(unique, k=4)
+        unique = items_rng.sample(unique, k=4)
     new_name = f"Fusion {name1} + {name2}"
     c.execute('DELETE FROM inventory WHERE user_id = ? AND id IN (?, ?)', (uid, id1, id2))
     c.execute('''
@@ -1414,6 +1794,7 @@ def breed_isopods(msg):
     bot.reply_to(msg, f"🧬 Bred {new_name} ({new_status})")
 
 @bot.message_handler(commands=['rainbowfusion'])
+@transactional
 def rainbow_fusion(msg):
     parts = msg.text.split()
     if len(parts) < 2:
@@ -1484,7 +1865,7 @@ def rainbow_fusion(msg):
     if not unique:
         unique = [{'name': 'Tackle', 'power': new_atk}]
     if len(unique) > 4:
-        unique = random.sample(unique, k=4)
+        unique = items_rng.sample(unique, k=4)
     c.execute(f"DELETE FROM inventory WHERE user_id = ? AND id IN ({','.join(['?']*len(ids))})", [uid] + ids)
     c.execute('''
         INSERT INTO inventory (user_id, market_id, name, status, price, color, hp, attack, moves_json, level, xp, locked)
@@ -1495,35 +1876,26 @@ def rainbow_fusion(msg):
     bot.reply_to(msg, "🌈 Rainbow fusion complete!")
 
 @bot.message_handler(commands=['market'])
+@transactional
 def market(msg):
     logger.info(f"Market request by {msg.from_user.id}")
     conn = get_conn()
     now = time.time()
     notify_expired_effects(conn, msg.from_user.id, msg.chat.id, now)
-    if needs_regen():
-        generate_marketplace()
-        send_silent_to_chat(msg.chat.id, "📈 Market refreshed")
-    c = conn.cursor()
-    c.execute('SELECT full_name, price, status FROM marketplace ORDER BY price DESC LIMIT 10')
-    high = c.fetchall()
-    c.execute('SELECT full_name, price, status FROM marketplace ORDER BY price ASC LIMIT 10')
-    low = c.fetchall()
-    c.execute('SELECT value FROM global_state WHERE key = ?', ('last_regen',))
-    last_regen_row = c.fetchone()
+    high, low = market_price_views(conn)
     conn.close()
     high_lines = [f"{name} {p}$" for name, p, s in high]
     low_lines = [f"{name} {p}$" for name, p, s in low]
     refresh_text = ""
-    if last_regen_row and last_regen_row[0]:
-        next_refresh = int(last_regen_row[0] + MARKET_REFRESH - now)
-        if next_refresh < 0:
-            next_refresh = 0
+    next_refresh = seconds_until('market', now)
+    if next_refresh is not None:
         m, s = divmod(next_refresh, 60)
         refresh_text = f"\n\nNext refresh in {m}m {s:02d}s"
     text = "📈 High:\n" + "\n".join(high_lines) + "\n\n📉 Low:\n" + "\n".join(low_lines) + refresh_text
     bot.reply_to(msg, text)
 
 @bot.message_handler(commands=['auction'])
+@transactional
 def auction(msg):
     parts = msg.text.split()
     if len(parts) < 2:
@@ -1536,10 +1908,10 @@ def auction(msg):
     c = conn.cursor()
     if action == 'list':
         c.execute('''
-            SELECT a.auction_id, a.name, a.status, a.price, u.username
-            FROM auctions a LEFT JOIN users u ON a.seller_id = u.user_id
-            WHERE a.state = 'active'
-            ORDER BY a.created_at DESC LIMIT 20
+            SELECT auction_id, name, status, price, seller_id
+            FROM auctions
+            WHERE state = 'active'
+            ORDER BY created_at DESC LIMIT 20
         ''')
         rows = c.fetchall()
         if not rows:
@@ -1547,8 +1919,8 @@ def auction(msg):
             conn.close()
             return
         lines = ["🏷️ Auctions:"]
-        for auction_id, name, status, price, username in rows:
-            seller = username or 'unknown'
+        for auction_id, name, status, price, seller_id in rows:
+            seller = get_username(seller_id) or 'unknown'
             lines.append(f"{auction_id}: {name} ({status}) 💰{price} | @{seller}")
         bot.reply_to(msg, "\n".join(lines))
         conn.close()
@@ -1621,8 +1993,7 @@ def auction(msg):
             bot.reply_to(msg, "You cannot buy your own auction")
             conn.close()
             return
-        c.execute('SELECT money FROM users WHERE user_id = ?', (uid,))
-        money = c.fetchone()[0]
+        money = get_user_money(uid)
         if money < price:
             bot.reply_to(msg, f"💸 Need {price} iso$")
             conn.close()
@@ -1692,28 +2063,22 @@ def auction(msg):
     conn.close()
 
 @bot.message_handler(commands=['top'])
+@transactional
 def top(msg):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute('SELECT username, money FROM users ORDER BY money DESC LIMIT 10')
-    rows = c.fetchall()
-    conn.close()
+    rows = top_users(10)
     lines = [f"{i}. {u}: {m}$" for i, (u, m) in enumerate(rows, 1)]
     text = "💰 Richest:\n" + "\n".join(lines) if lines else "None"
     bot.reply_to(msg, text)
 
 @bot.message_handler(commands=['legendary'])
+@transactional
 def legendary(msg):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute('SELECT username FROM users WHERE legendary = 1')
-    rows = c.fetchall()
-    conn.close()
-    lines = [f"• {r[0]}" for r in rows]
+    lines = [f"• {name}" for name in legendary_usernames()]
     text = "🏆 Legendaries:\n" + "\n".join(lines) if lines else "None"
     bot.reply_to(msg, text)
 
 @bot.message_handler(commands=['use'])
+@transactional
 def use_item(msg):
     parts = msg.text.split()
     if len(parts) < 2:
@@ -1738,9 +2103,7 @@ def use_item(msg):
         conn.close()
         return
     c = conn.cursor()
-    c.execute('SELECT qty FROM user_items WHERE user_id = ? AND item_id = ?', (uid, item_id))
-    row = c.fetchone()
-    if not row or row[0] <= 0:
+    if get_item_qty(uid, item_id) <= 0:
         bot.reply_to(msg, "No item")
         conn.close()
         return
@@ -1759,7 +2122,7 @@ def use_item(msg):
     if effect_type == 'add_charge':
         charges, last_charge_at = sync_charges(conn, uid, now)
         charges = min(OVERCHARGE_MAX, charges + int(effect_value))
-        update_user_charges(conn, uid, charges)
+        update_user_charges(conn, uid, charges, last_charge_at)
         res = f"⚡ +{effect_value} charge(s)"
     elif effect_type == 'guarantee_rare':
         set_effect(conn, uid, 'guarantee_rare', '1')
@@ -1770,10 +2133,11 @@ def use_item(msg):
     elif effect_type == 'double_roll':
         charges, last_charge_at = sync_charges(conn, uid, now)
         new_charges = min(OVERCHARGE_MAX, charges * 2)
-        update_user_charges(conn, uid, new_charges)
+        update_user_charges(conn, uid, new_charges, last_charge_at)
         res = f"🎲 Charges doubled to {new_charges}/{MAX_CHARGES}"
     elif effect_type == 'regen_market':
         generate_marketplace()
+        scheduler.reschedule('market', time.time() + MARKET_REFRESH)
         res = "🔄 Market regenerated"
         send_silent_to_chat(msg.chat.id, "📈 Market refreshed")
     elif effect_type == 'item_drop_boost':
@@ -1827,15 +2191,14 @@ def use_item(msg):
             bot.reply_to(msg, "Target required: /use <item_id> @user")
             conn.close()
             return
-        target_id = get_user_id_by_username(conn, target_username)
+        target_id = get_user_id_by_username(target_username)
         if not target_id:
             bot.reply_to(msg, "Target not found")
             conn.close()
             return
         if effect_type == 'bite_bug':
-            c.execute('SELECT money FROM users WHERE user_id = ?', (target_id,))
-            target_money = c.fetchone()[0]
-            percent = random.randint(5, 15)
+            target_money = get_user_money(target_id)
+            percent = items_rng.randint(5, 15)
             steal = max(5, int(target_money * percent / 100))
             steal = min(100, steal)
             steal = min(steal, target_money)
@@ -1856,7 +2219,7 @@ def use_item(msg):
             if t_charges <= 0:
                 res = f"🎟️ @{target_username} has no charges"
             else:
-                update_user_charges(conn, target_id, t_charges - 1)
+                update_user_charges(conn, target_id, t_charges - 1, t_last)
                 res = f"🎟️ @{target_username} lost 1 charge (no roll)"
         elif effect_type == 'swap_token':
             c.execute('SELECT id FROM inventory WHERE user_id = ? ORDER BY RANDOM() LIMIT 1', (uid,))
@@ -1872,21 +2235,21 @@ def use_item(msg):
                 res = f"🔁 Swapped a random isopod with @{target_username}"
     elif effect_type == 'market_sabotage':
         generate_marketplace()
-        c.execute('UPDATE marketplace SET price = MAX(1, CAST(price * 0.8 AS INT))')
-        conn.commit()
+        scheduler.reschedule('market', time.time() + MARKET_REFRESH)
+        discount_market(conn, 0.8)
         res = "💥 Market sabotaged (prices lowered)"
         send_silent_to_chat(msg.chat.id, "📈 Market refreshed")
     else:
         res = "Unknown item"
     if not res:
         res = "Done"
-    c.execute('UPDATE user_items SET qty = qty - 1 WHERE user_id = ? AND item_id = ?', (uid, item_id))
-    c.execute('DELETE FROM user_items WHERE user_id = ? AND item_id = ? AND qty <= 0', (uid, item_id))
+    consume_item(uid, item_id)
     conn.commit()
     conn.close()
     bot.reply_to(msg, res)
 
 @bot.message_handler(commands=['broadcast'])
+@transactional
 def broadcast(msg):
     parts = msg.text.split(maxsplit=2)
     if len(parts) < 3:
@@ -1902,15 +2265,12 @@ def broadcast(msg):
     if password != stored:
         bot.reply_to(msg, "Wrong password")
         return
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute('SELECT user_id FROM users')
-    user_ids = [r[0] for r in c.fetchall()]
-    conn.close()
+    user_ids = all_user_ids()
     sent = send_to_users(user_ids, f"📣 Broadcast: {message}")
     bot.reply_to(msg, f"Broadcast sent to {sent} users")
 
 @bot.message_handler(commands=['battle'])
+@transactional
 def battle(msg):
     if msg.chat.type == 'private':
         bot.reply_to(msg, "Battles only work in group chats")
@@ -1927,7 +2287,7 @@ def battle(msg):
         return
     challenger_id = msg.from_user.id
     conn = get_conn()
-    target_id = get_user_id_by_username(conn, target_username)
+    target_id = get_user_id_by_username(target_username)
     if not target_id:
         bot.reply_to(msg, "Target not found")
         conn.close()
@@ -1949,6 +2309,7 @@ def battle(msg):
     send_to_chat(msg.chat.id, f"⚔️ @{target_username}, you were challenged by @{msg.from_user.username or 'unknown'}\nYour inventory:\n{inv_list}\nUse /accept <isopod_id> or /decline")
 
 @bot.message_handler(commands=['race'])
+@transactional
 def race(msg):
     if msg.chat.type == 'private':
         bot.reply_to(msg, "Races only work in group chats")
@@ -1969,14 +2330,13 @@ def race(msg):
         return
     challenger_id = msg.from_user.id
     conn = get_conn()
-    target_id = get_user_id_by_username(conn, target_username)
+    target_id = get_user_id_by_username(target_username)
     if not target_id:
         bot.reply_to(msg, "Target not found")
         conn.close()
         return
     c = conn.cursor()
-    c.execute('SELECT money FROM users WHERE user_id = ?', (challenger_id,))
-    money = c.fetchone()[0]
+    money = get_user_money(challenger_id)
     if money < bet:
         bot.reply_to(msg, f"💸 Need {bet} iso$ to race")
         conn.close()
@@ -1997,6 +2357,7 @@ def race(msg):
     send_to_chat(msg.chat.id, f"🏁 @{target_username}, you were challenged by @{msg.from_user.username or 'unknown'} for {bet} iso$\nYour inventory:\n{inv_list}\nUse /raceaccept <isopod_id> or /racedecline")
 
 @bot.message_handler(commands=['accept'])
+@transactional
 def accept(msg):
     if msg.chat.type == 'private':
         bot.reply_to(msg, "Accept battles in the original group chat")
@@ -2039,6 +2400,7 @@ def accept(msg):
         bot.reply_to(msg, result)
 
 @bot.message_handler(commands=['decline'])
+@transactional
 def decline(msg):
     if msg.chat.type == 'private':
         bot.reply_to(msg, "Decline battles in the original group chat")
@@ -2069,6 +2431,7 @@ def decline(msg):
     send_to_chat(msg.chat.id, f"@{msg.from_user.username or 'unknown'} declined the battle")
 
 @bot.message_handler(commands=['raceaccept'])
+@transactional
 def race_accept(msg):
     if msg.chat.type == 'private':
         bot.reply_to(msg, "Accept races in the original group chat")
@@ -2101,8 +2464,7 @@ def race_accept(msg):
         bot.reply_to(msg, "Accept the race in the original chat")
         conn.close()
         return
-    c.execute('SELECT money FROM users WHERE user_id = ?', (target_id,))
-    money = c.fetchone()[0]
+    money = get_user_money(target_id)
     if money < bet:
         bot.reply_to(msg, f"💸 Need {bet} iso$ to accept")
         c.execute('UPDATE pending_races SET status = ? WHERE race_id = ?', ('failed', race_id))
@@ -2119,6 +2481,7 @@ def race_accept(msg):
         bot.reply_to(msg, result)
 
 @bot.message_handler(commands=['racedecline'])
+@transactional
 def race_decline(msg):
     if msg.chat.type == 'private':
         bot.reply_to(msg, "Decline races in the original group chat")
@@ -2148,5 +2511,10 @@ def race_decline(msg):
     bot.reply_to(msg, "Declined")
     send_to_chat(msg.chat.id, f"@{msg.from_user.username or 'unknown'} declined the race")
 
-print("Bot running...")
-bot.infinity_polling()
+def main():
+    start_services()
+    print("Bot running...")
+    bot.infinity_polling()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import os
+import io
+import sys
+import json
+import math
+import time
+import random
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import ImageDraw
+
+import compositor
+from render_cache import digest_of
+from utils import hex_colors, load_lists, sprites, GRAPHICS_DIR, RENDER_VERSION, RAINBOW_STREAKS, RAINBOW_STREAK_COLOR, rainbow_digest, _render_sprite
+
+# ---------------------------------------------------------------------------
+# build_assets.py
+# Builds the static PNGs in Assets/Graphics: <color>isopod.png and
+# <color>isofish.png for every color in colors.txt, plus rainbowpillbug.png.
+# Replaces genfiles.py and rainbow_gen.py.
+#
+# Every output is recorded in .build_manifest.json with a hash of what went
+# into it (sprite file, color or RAINBOW_* settings, BUILD_VERSION /
+# RENDER_VERSION). Outputs whose hash hasn't changed are skipped, so adding
+# one color renders two files, not thirty. Renders run on a process pool
+# and are seeded, so the same inputs always give the same file. Color
+# variants are the same image the bot renders as variant 0.
+#
+#   python build_assets.py                 # build what changed
+#   python build_assets.py --force         # rebuild everything
+#   python build_assets.py --only rainbow  # just one kind
+# ---------------------------------------------------------------------------
+
+BUILD_VERSION = 1
+MANIFEST_NAME = '.build_manifest.json'
+KINDS = ('isopod', 'isofish', 'rainbow')
+
+def render_rainbow(sprite_name='isopod'):
+    """White sprite on a full-hue gradient with gold streaks."""
+    base = sprites.get(sprite_name)
+    canvas_side = max(base.width, base.height) * 2
+    canvas = compositor.to_image(compositor.hsv_gradient((canvas_side, canvas_side)))
+    draw = ImageDraw.Draw(canvas)
+    rng = random.Random(f'rainbow:{sprite_name}')
+    max_radius = canvas_side * 0.45
+    for _ in range(RAINBOW_STREAKS):
+        angle = math.pi * 2 * rng.random()
+        start_radius = max_radius * rng.uniform(0.7, 1.0)
+        end_radius = max_radius * rng.uniform(0.0, 0.2)
+        sx = canvas_side // 2 + int(start_radius * math.cos(angle))
+        sy = canvas_side // 2 + int(start_radius * math.sin(angle))
+        ex = canvas_side // 2 + int(end_radius * math.cos(angle))
+        ey = canvas_side // 2 + int(end_radius * math.sin(angle))
+        draw.line((sx, sy, ex, ey), fill=RAINBOW_STREAK_COLOR, width=rng.randint(2, 5))
+    white = np.empty((base.height, base.width, 4), dtype=np.uint8)
+    white[:, :, :3] = 255
+    white[:, :, 3] = base.alpha
+    paste_x = (canvas_side - base.width) // 2
+    paste_y = (canvas_side - base.height) // 2
+    compositor.composite(canvas, white, (paste_x, paste_y))
+    buf = io.BytesIO()
+    canvas.save(buf, 'PNG')
+    return buf.getvalue()
+
+def plan(kinds, colors):
+    """(output filename, kind, sprite, color, input hash) for everything buildable."""
+    jobs = []
+    for kind in kinds:
+        if kind == 'rainbow':
+            digest = digest_of(sprites.get('isopod').digest, rainbow_digest(), str(BUILD_VERSION))
+            jobs.append(('rainbowpillbug.png', kind, 'isopod', None, digest))
+            continue
+        sprite = sprites.get(kind)
+        for color in colors:
+            digest = digest_of(sprite.digest, kind, hex_colors[color], str(BUILD_VERSION), str(RENDER_VERSION))
+            jobs.append((f'{color}{kind}.png', kind, kind, color, digest))
+    return jobs
+
+def _build_one(job, out_dir):
+    output, kind, sprite, color, _ = job
+    start = time.perf_counter()
+    if kind == 'rainbow':
+        data = render_rainbow(sprite)
+    else:
+        data = _render_sprite(sprite, color, 0, 'lossless')
+    path = os.path.join(out_dir, output)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return output, time.perf_counter() - start
+
+def _load_manifest(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build colored isopod/isofish PNGs and the rainbow pillbug')
+    parser.add_argument('--out', default=GRAPHICS_DIR, help='output directory (default: %(default)s)')
+    parser.add_argument('--only', nargs='+', choices=KINDS, default=list(KINDS))
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--force', action='store_true', help='rebuild even if inputs are unchanged')
+    args = parser.parse_args(argv)
+
+    colors, _ = load_lists()
+    unknown = [c for c in colors if c not in hex_colors]
+    for color in unknown:
+        print(f"Unknown color '{color}', skipping.")
+    colors = [c for c in colors if c in hex_colors]
+
+    os.makedirs(args.out, exist_ok=True)
+    manifest_path = os.path.join(args.out, MANIFEST_NAME)
+    manifest = _load_manifest(manifest_path)
+    jobs = plan(args.only, colors)
+    todo = [
+        job for job in jobs
+        if args.force or manifest.get(job[0]) != job[4] or not os.path.exists(os.path.join(args.out, job[0]))
+    ]
+    print(f"{len(jobs)} assets, {len(jobs) - len(todo)} up to date, {len(todo)} to build")
+
+    start = time.perf_counter()
+    built = 0
+    if todo:
+        digests = {job[0]: job[4] for job in todo}
+        try:
+            with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+                futures = [pool.submit(_build_one, job, args.out) for job in todo]
+                for future in futures:
+                    output, seconds = future.result()
+                    manifest[output] = digests[output]
+                    built += 1
+                    print(f"  {output:<24} {seconds * 1000:8.1f} ms")
+        finally:
+            # Keep whatever finished, so a failed run resumes where it stopped
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+    print(f"Built {built} assets in {time.perf_counter() - start:.2f}s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+import pytest
+
+import db
+
+# ---------------------------------------------------------------------------
+# Shared fixtures
+# fresh_db points db.py at an empty, migrated database in tmp_path, with its
+# own user cache, counter writer and effect index, so no test sees another's
+# rows or cached state. The counter writer's thread is parked (flush only
+# when the test calls flush_counters()) to keep timings out of the checks.
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'isopods.db')
+    monkeypatch.setattr(db, 'DB_PATH', path)
+    monkeypatch.setattr(db, 'COUNTER_FLUSH_MS', 10 ** 9)
+    monkeypatch.setattr(db, '_user_cache', db.UserCache(db._state_lock))
+    monkeypatch.setattr(db, '_counters', db.CounterWriter(db._state_lock))
+    monkeypatch.setattr(db, '_store', None)
+    monkeypatch.setattr(db, '_effect_index', None)
+    db.init_db()
+    yield path
+    # Whatever is still queued belongs to this database, not the one the
+    # writer's atexit flush would find in DB_PATH after the test
+    db.flush_counters()
+    db.get_pool().close_all()
@@ -1,10 +1,19 @@
 import sqlite3
 import os
+import threading
+import time
+import functools
+import atexit
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any, List, Tuple
 
 DB_PATH = 'isopods.db'
 
+logger = logging.getLogger(__name__)
+
 # ---------------------------------------------------------------------------
 # Database schema & helpers
 # This module owns the SQLite schema and tiny helper functions used across
@@ -17,15 +26,288 @@ DB_PATH = 'isopods.db'
 # If you tinker, back up the DB first.
 # ---------------------------------------------------------------------------
 
+# --------------------------------------------------------------------------------
+# Connection pool
+# Opening a fresh sqlite3 connection per helper call means re-reading the
+# schema every time, and several connections fighting over the rollback
+# journal is where "database is locked" came from. Connections are now kept
+# warm in a small pool and switched to WAL so readers never block the writer.
+#
+# get_conn() is still the one entry point and conn.close() still works: it
+# hands the connection back instead of closing it. Nested get_conn() calls on
+# the same thread (a handler calling update_user_money while holding its own
+# conn) share one connection, so they can't deadlock waiting on each other.
+# --------------------------------------------------------------------------------
+
+POOL_SIZE = 8
+POOL_WAIT_TIMEOUT = 30.0
+BUSY_TIMEOUT_MS = 10000
+CACHE_SIZE_KIB = 16384
+MMAP_SIZE = 64 * 1024 * 1024
+
+class PooledConnection:
+    """Handle on a pooled connection. Anything not defined here goes to the
+    underlying sqlite3.Connection; close() returns it to the pool."""
+
+    def __init__(self, pool, lease):
+        self._pool = pool
+        self._lease = lease
+        self._closed = False
+
+    def __getattr__(self, name):
+        if self._closed:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return getattr(self._lease['raw'], name)
+
+    def __enter__(self):
+        return self._lease['raw'].__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._lease['raw'].__exit__(exc_type, exc, tb)
+
+    def commit(self):
+        # Inside a unit of work the commit happens once, when it ends
+        if self._lease.get('uow'):
+            return
+        self._lease['raw'].commit()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._pool.release(self._lease)
+
+class ConnectionPool:
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = []
+        self._opened = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self.stats = {
+            'opened': 0,
+            'acquired': 0,
+            'reused': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'max_wait_seconds': 0.0
+        }
+
+    def _open(self):
+        raw = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        raw.execute('PRAGMA journal_mode=WAL')
+        raw.execute('PRAGMA synchronous=NORMAL')
+        raw.execute(f'PRAGMA busy_timeout={int(BUSY_TIMEOUT_MS)}')
+        raw.execute(f'PRAGMA cache_size=-{int(CACHE_SIZE_KIB)}')
+        raw.execute(f'PRAGMA mmap_size={int(MMAP_SIZE)}')
+        raw.execute('PRAGMA temp_store=MEMORY')
+        return raw
+
+    def acquire(self):
+        lease = getattr(self._local, 'lease', None)
+        if lease is not None:
+            lease['refs'] += 1
+            with self._cond:
+                self.stats['reused'] += 1
+            return PooledConnection(self, lease)
+        raw = None
+        with self._cond:
+            if not self._idle and self._opened >= self.size:
+                start = time.perf_counter()
+                self.stats['waits'] += 1
+                while not self._idle and self._opened >= self.size:
+                    remaining = POOL_WAIT_TIMEOUT - (time.perf_counter() - start)
+                    if remaining <= 0:
+                        raise sqlite3.OperationalError('timed out waiting for a pooled connection')
+                    self._cond.wait(remaining)
+                waited = time.perf_counter() - start
+                self.stats['wait_seconds'] += waited
+                self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], waited)
+            if self._idle:
+                raw = self._idle.pop()
+            else:
+                self._opened += 1
+                self.stats['opened'] += 1
+            self.stats['acquired'] += 1
+        if raw is None:
+            try:
+                raw = self._open()
+            except Exception:
+                with self._cond:
+                    self._opened -= 1
+                    self._cond.notify()
+                raise
+        lease = {'raw': raw, 'refs': 1}
+        self._local.lease = lease
+        return PooledConnection(self, lease)
+
+    def release(self, lease):
+        lease['refs'] -= 1
+        if lease['refs'] > 0:
+            return
+        self._local.lease = None
+        raw = lease['raw']
+        # A plain sqlite3 close() threw away uncommitted work, keep it that way
+        if raw.in_transaction:
+            raw.rollback()
+        with self._cond:
+            self._idle.append(raw)
+            self._cond.notify()
+
+    def close_all(self):
+        with self._cond:
+            for raw in self._idle:
+                raw.close()
+            self._opened -= len(self._idle)
+            self._idle = []
+
+    def snapshot(self):
+        with self._cond:
+            data = dict(self.stats)
+            data['idle'] = len(self._idle)
+            data['in_use'] = self._opened - len(self._idle)
+        return data
+
+    def current_lease(self):
+        return getattr(self._local, 'lease', None)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None or _pool.path != DB_PATH:
+        with _pool_lock:
+            if _pool is None or _pool.path != DB_PATH:
+                _pool = ConnectionPool(DB_PATH)
+    return _pool
+
 def get_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    return get_pool().acquire()
 
-def init_db():
+def in_write_transaction() -> bool:
+    lease = get_pool().current_lease()
+    return lease is not None and lease['raw'].in_transaction
+
+def open_standalone_conn():
+    """A private connection with the pool's pragmas that never joins the
+    caller's unit of work. For background jobs that commit on their own."""
+    return get_pool()._open()
+
+def pool_stats() -> Dict[str, Any]:
+    return get_pool().snapshot()
+
+# --------------------------------------------------------------------------------
+# Unit of work
+# A bot command used to commit five or six times (handler conn, then
+# update_user_money, then update_user_last_roll...) so a crash halfway through
+# could take someone's iso$ without handing over the isopod. Everything that
+# runs inside unit_of_work() shares the thread's pooled connection, the
+# conn.commit() calls sprinkled through the helpers become no-ops, and the
+# whole command is committed once at the end, or rolled back if it raised.
+#
+# Work that shouldn't happen under the write lock, or at all if the command
+# fails (Telegram sends), goes through after_commit(): it runs once the
+# commit is done and the connection is back in the pool.
+# --------------------------------------------------------------------------------
+
+@contextmanager
+def unit_of_work():
     conn = get_conn()
-    c = conn.cursor()
-    # OK database time. The following block creates all tables if missing.
-    # If you squint, it's just a bunch of CREATE TABLE statements. If you
-    # touch them, expect surprises. Migrations are not sophisticated here.
+    lease = conn._lease
+    lease['uow'] = lease.get('uow', 0) + 1
+    ok = False
+    after = None
+    try:
+        yield conn
+        ok = True
+    finally:
+        lease['uow'] -= 1
+        try:
+            if lease['uow'] == 0:
+                staged = lease.pop('counters', None)
+                user_writes = lease.pop('user_writes', None)
+                effects = lease.pop('effects', None)
+                undo = lease.pop('undo', None)
+                callbacks = lease.pop('after_commit', None)
+                if ok:
+                    lease['raw'].commit()
+                    after = callbacks
+                    if user_writes:
+                        _user_cache.invalidate(user_writes)
+                    if effects:
+                        _apply_effects(effects)
+                    if staged:
+                        _counters.submit(staged)
+                else:
+                    lease['raw'].rollback()
+                    for revert in reversed(undo or ()):
+                        revert()
+        finally:
+            conn.close()
+        for callback in after or ():
+            try:
+                callback()
+            except Exception:
+                logger.exception('After-commit callback failed')
+
+def _register_undo(revert):
+    """Run revert() if the current unit of work rolls back. State kept
+    outside SQLite (the memory store) uses this to roll back with it."""
+    lease = get_pool().current_lease()
+    if lease is not None and lease.get('uow'):
+        lease.setdefault('undo', []).append(revert)
+
+def after_commit(callback):
+    """Run callback() once the current unit of work has committed, or right
+    away outside one. Dropped if it rolls back; if it raises, that's logged
+    and the commit stands."""
+    lease = get_pool().current_lease()
+    if lease is not None and lease.get('uow'):
+        lease.setdefault('after_commit', []).append(callback)
+    else:
+        callback()
+
+def has_pending_writes() -> bool:
+    """True once the current unit of work has changed anything it hasn't
+    committed yet (SQL, staged counters or memory store changes)."""
+    lease = get_pool().current_lease()
+    if lease is None or not lease.get('uow'):
+        return False
+    return lease['raw'].in_transaction or any(lease.get(key) for key in ('counters', 'user_writes', 'effects', 'undo'))
+
+def transactional(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with unit_of_work():
+            return func(*args, **kwargs)
+    return wrapper
+
+# --------------------------------------------------------------------------------
+# Schema migrations
+# The schema version lives in PRAGMA user_version. Each entry in MIGRATIONS
+# moves the database one version forward and is written so it can be re-run
+# on a database that already has the change (old installs were built by the
+# previous CREATE IF NOT EXISTS + ensure_columns dance and sit at version 0).
+# When user_version is already current, init_db() is a single PRAGMA read.
+#
+# To change the schema: append a step, never edit one that has shipped.
+#   python db.py status     # show current version and pending steps
+#   python db.py migrate    # apply pending steps
+# --------------------------------------------------------------------------------
+
+def _table_columns(c, table):
+    c.execute(f'PRAGMA table_info({table})')
+    return {row[1] for row in c.fetchall()}
+
+def _add_missing_columns(c, table, columns):
+    existing = _table_columns(c, table)
+    for col, col_def in columns:
+        if col not in existing:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN {col} {col_def}')
+
+def _migrate_base_schema(c):
     # Users table
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -222,29 +504,15 @@ def init_db():
     c.execute('CREATE INDEX IF NOT EXISTS idx_user_fish ON user_fish(user_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_auctions_state ON auctions(state)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_races_target ON pending_races(target_id)')
-    conn.commit()
-    ensure_columns(conn)
-    conn.close()
 
-# --------------------------------------------------------------------------------
-# ensure_columns: tiny migration helper that adds columns if older DB lacks
-# them. This is intentionally simplistic: it runs PRAGMA table_info then
-# issues ALTER TABLE ADD COLUMN when necessary. It is safe-ish but slow.
-# --------------------------------------------------------------------------------
-
-def ensure_columns(conn):
-    c = conn.cursor()
-    def has_column(table, column):
-        c.execute(f'PRAGMA table_info({table})')
-        return any(row[1] == column for row in c.fetchall())
-    user_columns = [
+def _migrate_user_charge_columns(c):
+    _add_missing_columns(c, 'users', [
         ('roll_charges', 'INTEGER DEFAULT 1'),
         ('last_charge_at', 'REAL DEFAULT 0')
-    ]
-    for col, col_def in user_columns:
-        if not has_column('users', col):
-            c.execute(f'ALTER TABLE users ADD COLUMN {col} {col_def}')
-    inv_columns = [
+    ])
+
+def _migrate_inventory_columns(c):
+    _add_missing_columns(c, 'inventory', [
         ('name', 'TEXT'),
         ('status', 'TEXT'),
         ('price', 'INTEGER'),
@@ -255,55 +523,999 @@ def ensure_columns(conn):
         ('locked', 'INTEGER DEFAULT 0'),
         ('level', 'INTEGER DEFAULT 1'),
         ('xp', 'INTEGER DEFAULT 0')
-    ]
-    for col, col_def in inv_columns:
-        if not has_column('inventory', col):
-            c.execute(f'ALTER TABLE inventory ADD COLUMN {col} {col_def}')
-    if not has_column('pending_battles', 'chat_id'):
-        c.execute('ALTER TABLE pending_battles ADD COLUMN chat_id INTEGER')
-    conn.commit()
+    ])
+
+def _migrate_battle_chat_id(c):
+    _add_missing_columns(c, 'pending_battles', [('chat_id', 'INTEGER')])
+
+def _migrate_username_index(c):
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)')
+
+def _migrate_market_price_index(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS market_price_index (
+            seed INTEGER,
+            kind TEXT,
+            rank INTEGER,
+            full_name TEXT,
+            price INTEGER,
+            status TEXT,
+            PRIMARY KEY(seed, kind, rank)
+        )
+    ''')
+
+def _migrate_photo_file_ids(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS photo_file_ids (
+            content_hash TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            created_at REAL,
+            uses INTEGER DEFAULT 0
+        )
+    ''')
+
+def _backfill_last_charge_at(c):
+    # Rows from before migration 2 got last_charge_at 0, which derive_charges
+    # reads as "now" every time, so those users never regenerated a charge
+    c.execute('UPDATE users SET last_charge_at = ? WHERE last_charge_at IS NULL OR last_charge_at = 0', (time.time(),))
+
+MIGRATIONS = [
+    (1, 'base schema', _migrate_base_schema),
+    (2, 'users.roll_charges / users.last_charge_at', _migrate_user_charge_columns),
+    (3, 'denormalized inventory columns, locked, level, xp', _migrate_inventory_columns),
+    (4, 'pending_battles.chat_id', _migrate_battle_chat_id),
+    (5, 'index users.username', _migrate_username_index),
+    (6, 'market_price_index for procedural markets', _migrate_market_price_index),
+    (7, 'photo_file_ids upload cache', _migrate_photo_file_ids),
+    (8, 'backfill users.last_charge_at', _backfill_last_charge_at),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Market tables are rebuilt wholesale by utils.generate_marketplace into
+# *_next copies and swapped in, so their DDL lives here as templates. Keep
+# these in line with what the migrations create.
+MARKET_TABLES_SQL = {
+    'marketplace': '''
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            color TEXT,
+            word TEXT,
+            full_name TEXT UNIQUE,
+            status TEXT,
+            price INTEGER
+        )
+    ''',
+    'isopod_stats': '''
+        CREATE TABLE {name} (
+            market_id INTEGER PRIMARY KEY,
+            hp INTEGER,
+            attack INTEGER,
+            moves_json TEXT
+        )
+    '''
+}
+MARKET_INDEXES_SQL = [
+    'CREATE INDEX IF NOT EXISTS idx_market_price ON marketplace(price)',
+    'CREATE INDEX IF NOT EXISTS idx_stats_market ON isopod_stats(market_id)'
+]
+
+def get_schema_version(conn) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def pending_migrations(conn) -> List[Tuple[int, str, Any]]:
+    current = get_schema_version(conn)
+    return [m for m in MIGRATIONS if m[0] > current]
+
+def migrate(conn) -> List[int]:
+    applied = []
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        return applied
+    c = conn.cursor()
+    for version, description, step in MIGRATIONS:
+        # BEGIN IMMEDIATE takes the write lock first, so if two processes
+        # start at once the second one re-reads the version and skips
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            if get_schema_version(conn) >= version:
+                c.execute('COMMIT')
+                continue
+            step(c)
+            c.execute(f'PRAGMA user_version = {int(version)}')
+            c.execute('COMMIT')
+        except Exception:
+            c.execute('ROLLBACK')
+            raise
+        applied.append(version)
+    return applied
+
+def init_db():
+    conn = get_conn()
+    migrate(conn)
+    conn.close()
+
+# --------------------------------------------------------------------------------
+# Write-behind counters
+# money, roll_charges, last_charge_at and last_roll change several times per
+# roll or battle. With COUNTER_DURABILITY = 'group' those writes are merged per
+# user in memory and a single writer thread flushes them in one transaction
+# every COUNTER_FLUSH_MS, or sooner once COUNTER_FLUSH_OPS have piled up. A
+# crash can lose at most that window. 'sync' writes straight through inside
+# the caller's transaction like before.
+#
+# Writes made inside a unit of work are only handed to the writer when that
+# unit commits, so a failed command still doesn't move any iso$. Reads go
+# through get_user_money / get_user_charges / get_or_create_user, which lay
+# the not-yet-flushed values over what's in the table. In 'sync' mode the
+# UPDATE is part of the caller's transaction and the cached row is dropped
+# once it commits (see the user cache below).
+# --------------------------------------------------------------------------------
+
+COUNTER_DURABILITY = 'group'
+COUNTER_FLUSH_MS = 200
+COUNTER_FLUSH_OPS = 256
+COUNTER_MAX_RETRIES = 50
+COUNTER_FIELDS = ('roll_charges', 'last_charge_at', 'last_roll')
+
+def _merge_counter(target, user_id, entry):
+    merged = target.setdefault(user_id, {})
+    for key, value in entry.items():
+        if key == 'money':
+            merged['money'] = merged.get('money', 0) + value
+        else:
+            merged[key] = value
+    return merged
+
+class CounterWriter:
+    def __init__(self, lock):
+        self._lock = lock
+        self._seq = 0
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._inflight = {}
+        self._retries = {}
+        self._ops = 0
+        self._wake = threading.Event()
+        self._thread = None
+        self._conn = None
+        self.stats = {
+            'ops': 0,
+            'flushes': 0,
+            'rows': 0,
+            'flush_seconds': 0.0,
+            'retried': 0,
+            'dropped': 0
+        }
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='counter-writer', daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(COUNTER_FLUSH_MS / 1000)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Counter flush failed')
+
+    def submit(self, entries):
+        with self._lock:
+            for user_id, entry in entries.items():
+                _merge_counter(self._pending, user_id, entry)
+                _user_cache.apply(user_id, entry)
+            self._ops += len(entries)
+            self.stats['ops'] += len(entries)
+            full = self._ops >= COUNTER_FLUSH_OPS
+        if self._thread is None:
+            self._start()
+        if full:
+            self._wake.set()
+
+    def overlay(self, user_id):
+        # Caller holds the state lock
+        merged = {}
+        for source in (self._inflight, self._pending):
+            entry = source.get(user_id)
+            if entry:
+                _merge_counter(merged, user_id, entry)
+        return merged.get(user_id, {})
+
+    def read_consistent(self, read_row):
+        """Run read_row() so that no flush commits between it and the
+        overlay read that follows; callers do that read under the lock."""
+        while True:
+            seq = self._seq
+            if seq % 2:
+                time.sleep(0.001)
+                continue
+            row = read_row()
+            self._lock.acquire()
+            if self._seq == seq:
+                return row
+            self._lock.release()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch = self._pending
+                self._inflight = batch
+                self._pending = {}
+                self._ops = 0
+            start = time.perf_counter()
+            failed = {}
+            try:
+                if self._conn is None:
+                    self._conn = open_standalone_conn()
+                c = self._conn.cursor()
+                c.execute('BEGIN IMMEDIATE')
+                try:
+                    for user_id, entry in batch.items():
+                        sets = []
+                        params = []
+                        if entry.get('money'):
+                            sets.append('money = money + ?')
+                            params.append(entry['money'])
+                        for field in COUNTER_FIELDS:
+                            if field in entry:
+                                sets.append(f'{field} = ?')
+                                params.append(entry[field])
+                        if not sets:
+                            continue
+                        c.execute(f"UPDATE users SET {', '.join(sets)} WHERE user_id = ?", params + [user_id])
+                        # The users row may still be sitting in an uncommitted
+                        # get_or_create_user on another thread, try again later
+                        if c.rowcount == 0:
+                            failed[user_id] = entry
+                    with self._lock:
+                        self._seq += 1
+                    c.execute('COMMIT')
+                except Exception:
+                    if self._conn.in_transaction:
+                        c.execute('ROLLBACK')
+                    raise
+            except Exception:
+                logger.exception('Counter flush of %d users failed, will retry', len(batch))
+                failed = batch
+            finally:
+                with self._lock:
+                    self._inflight = {}
+                    if self._seq % 2:
+                        self._seq += 1
+                    for user_id, entry in failed.items():
+                        retries = self._retries.get(user_id, 0) + 1
+                        if retries > COUNTER_MAX_RETRIES:
+                            self._retries.pop(user_id, None)
+                            self.stats['dropped'] += 1
+                            logger.warning('Dropping counter update for missing user %s: %s', user_id, entry)
+                            continue
+                        self._retries[user_id] = retries
+                        self.stats['retried'] += 1
+                        # Older values go underneath whatever arrived meanwhile
+                        newer = self._pending.pop(user_id, None)
+                        _merge_counter(self._pending, user_id, entry)
+                        if newer:
+                            _merge_counter(self._pending, user_id, newer)
+                    for user_id in batch:
+                        if user_id not in failed:
+                            self._retries.pop(user_id, None)
+                    self.stats['flushes'] += 1
+                    self.stats['rows'] += len(batch) - len(failed)
+                    self.stats['flush_seconds'] += time.perf_counter() - start
+            return len(batch) - len(failed)
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+            data['pending'] = len(self._pending)
+        return data
+
+
+# --------------------------------------------------------------------------------
+# User cache
+# get_or_create_user used to SELECT the whole row on every /roll, /charges and
+# /start. Rows are now kept in an LRU keyed by user_id, holding the committed
+# row plus the unflushed counters. A username -> user_id map rides along for
+# @mentions, and a changed Telegram username is written back the next time
+# that user shows up.
+#
+# Only committed values go in; other handlers must not see a command's
+# changes before it commits:
+# - Counters written in a unit of work wait on the lease and reach the
+#   cache through the writer at commit (see _record_counter).
+# - A direct UPDATE of the row (legendary, username, 'sync' counters) is
+#   noted on the lease, and the cached row is dropped when the unit of work
+#   commits. The next read loads the committed row. Patching the cached copy
+#   instead would race with a reader that has already loaded that row.
+# - The thread that made those UPDATEs reads the row from its own
+#   connection until it commits, and rows read by a connection with
+#   uncommitted writes are never cached.
+# - A read that started before an invalidation doesn't put its row
+#   (generation check), so a stale row can't slip back in behind it.
+# --------------------------------------------------------------------------------
+
+USER_CACHE_SIZE = 4096
+
+def _apply_counter(record, entry):
+    for key, value in entry.items():
+        if key == 'money':
+            record['money'] += value
+        else:
+            record[key] = value
+
+class UserCache:
+    def __init__(self, lock, size=USER_CACHE_SIZE):
+        self._lock = lock
+        self.size = size
+        self._entries = OrderedDict()
+        self._usernames = {}
+        self.generation = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, user_id):
+        with self._lock:
+            record = self._entries.get(user_id)
+            if record is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.stats['hits'] += 1
+            return dict(record)
+
+    def put(self, record, generation=None):
+        """Cache record; skipped if generation is given and an invalidation
+        has happened since (the record may predate it)."""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            user_id = record['user_id']
+            old = self._entries.get(user_id)
+            if old is not None and old['username'] != record['username']:
+                self._forget_username(old['username'], user_id)
+            self._entries[user_id] = dict(record)
+            self._entries.move_to_end(user_id)
+            if record['username']:
+                self._usernames[record['username']] = user_id
+            while len(self._entries) > self.size:
+                evicted_id, evicted = self._entries.popitem(last=False)
+                self._forget_username(evicted['username'], evicted_id)
+                self.stats['evictions'] += 1
+
+    def _forget_username(self, username, user_id):
+        if self._usernames.get(username) == user_id:
+            del self._usernames[username]
+
+    def apply(self, user_id, entry):
+        with self._lock:
+            record = self._entries.get(user_id)
+            if record is not None:
+                _apply_counter(record, entry)
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            self.generation += 1
+            for user_id in user_ids:
+                record = self._entries.pop(user_id, None)
+                if record is not None:
+                    self._forget_username(record['username'], user_id)
+                    self.stats['invalidations'] += 1
+
+    def lookup_username(self, username):
+        with self._lock:
+            return self._usernames.get(username)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._usernames.clear()
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+            data['size'] = len(self._entries)
+        return data
+
+_state_lock = threading.RLock()
+_user_cache = UserCache(_state_lock)
+_counters = CounterWriter(_state_lock)
+
+def _record_counter(user_id, entry):
+    lease = get_pool().current_lease()
+    if lease is not None and lease.get('uow'):
+        _merge_counter(lease.setdefault('counters', {}), user_id, entry)
+    else:
+        _counters.submit({user_id: entry})
+
+def _note_user_write(user_id):
+    """A users row was UPDATEd directly. Inside a unit of work the cached
+    copy is dropped at commit; outside one the change is committed already."""
+    lease = get_pool().current_lease()
+    if lease is not None and lease.get('uow'):
+        lease.setdefault('user_writes', set()).add(user_id)
+    else:
+        _user_cache.invalidate((user_id,))
+
+def _wrote_user(user_id):
+    lease = get_pool().current_lease()
+    return lease is not None and user_id in lease.get('user_writes', ())
+
+def _staged_counters(user_id):
+    lease = get_pool().current_lease()
+    if lease is None:
+        return None
+    return lease.get('counters', {}).get(user_id)
+
+def _user_from_row(row):
+    return {
+        'user_id': row[0],
+        'username': row[1],
+        'money': row[2] or 0,
+        'legendary': bool(row[3]),
+        'last_roll': row[4],
+        'roll_charges': row[5],
+        'last_charge_at': row[6]
+    }
+
+def _load_user(user_id):
+    # Our own uncommitted UPDATEs aren't in the cache; the connection has them
+    own_writes = _wrote_user(user_id)
+    if not own_writes:
+        cached = _user_cache.get(user_id)
+        if cached is not None:
+            return cached
+    generation = _user_cache.generation
+    def read_row():
+        conn = get_conn()
+        c = conn.cursor()
+        c.execute('SELECT user_id, username, money, legendary, last_roll, roll_charges, last_charge_at FROM users WHERE user_id = ?', (user_id,))
+        row = c.fetchone()
+        conn.close()
+        return row
+    row = _counters.read_consistent(read_row)
+    try:
+        if not row:
+            return None
+        record = _user_from_row(row)
+        _apply_counter(record, _counters.overlay(user_id))
+        if not own_writes and not in_write_transaction():
+            _user_cache.put(record, generation)
+        return record
+    finally:
+        _state_lock.release()
+
+def _current_user(user_id):
+    """The user's record as this thread should see it, or None."""
+    record = _load_user(user_id)
+    if record is None:
+        return None
+    staged = _staged_counters(user_id)
+    if staged:
+        _apply_counter(record, staged)
+    return record
+
+def flush_counters() -> int:
+    return _counters.flush()
+
+def counter_stats() -> Dict[str, Any]:
+    return _counters.snapshot()
+
+def user_cache_stats() -> Dict[str, Any]:
+    return _user_cache.snapshot()
 
 def get_or_create_user(user_id: int, username: str) -> Dict[str, Any]:
+    if _store is not None:
+        user = _store.get_user(user_id)
+        if user is None:
+            return _store.create_user(user_id, username, datetime.utcnow().timestamp(), _register_undo)
+        if username and user['username'] != username:
+            _store.update_user(user_id, _register_undo, username=username)
+            user['username'] = username
+        return user
+    user = _current_user(user_id)
+    if user:
+        if username and user['username'] != username:
+            conn = get_conn()
+            conn.execute('UPDATE users SET username = ? WHERE user_id = ?', (username, user_id))
+            conn.commit()
+            conn.close()
+            _note_user_write(user_id)
+            user['username'] = username
+        return user
+    now = datetime.utcnow().timestamp()
     conn = get_conn()
     c = conn.cursor()
-    c.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = c.fetchone()
-    if user:
-        conn.close()
-        return {
-            'user_id': user[0],
-            'username': user[1],
-            'money': user[2],
-            'legendary': bool(user[3]),
-            'last_roll': user[4],
-            'roll_charges': user[5],
-            'last_charge_at': user[6]
-        }
     c.execute('INSERT INTO users (user_id, username, roll_charges, last_charge_at) VALUES (?, ?, ?, ?)',
-              (user_id, username, 1, datetime.utcnow().timestamp()))
+              (user_id, username, 1, now))
     conn.commit()
     conn.close()
-    return {'user_id': user_id, 'username': username, 'money': 0, 'legendary': False, 'last_roll': 0, 'roll_charges': 1, 'last_charge_at': datetime.utcnow().timestamp()}
+    user = {'user_id': user_id, 'username': username, 'money': 0, 'legendary': False, 'last_roll': 0, 'roll_charges': 1, 'last_charge_at': now}
+    # Inside a unit of work the row isn't committed yet; the first read after
+    # the commit caches it
+    if not in_write_transaction():
+        _user_cache.put(user)
+    return dict(user)
+
+def get_user_id_by_username(username: str) -> Optional[int]:
+    if _store is not None:
+        return _store.user_id_by_username(username)
+    user_id = _user_cache.lookup_username(username)
+    if user_id is not None:
+        return user_id
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT user_id FROM users WHERE username = ?', (username,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
 
 def update_user_last_roll(user_id: int, timestamp: float):
+    if _store is not None:
+        _store.update_user(user_id, _register_undo, last_roll=timestamp)
+        return
+    if COUNTER_DURABILITY != 'sync':
+        _record_counter(user_id, {'last_roll': timestamp})
+        return
     conn = get_conn()
     c = conn.cursor()
     c.execute('UPDATE users SET last_roll = ? WHERE user_id = ?', (timestamp, user_id))
     conn.commit()
     conn.close()
+    _note_user_write(user_id)
 
 def update_user_money(user_id: int, delta: int):
+    if _store is not None:
+        _store.update_user(user_id, _register_undo, money_delta=delta)
+        return
+    if COUNTER_DURABILITY != 'sync':
+        _record_counter(user_id, {'money': delta})
+        return
     conn = get_conn()
     c = conn.cursor()
     c.execute('UPDATE users SET money = money + ? WHERE user_id = ?', (delta, user_id))
     conn.commit()
     conn.close()
+    _note_user_write(user_id)
+
+def set_user_charges(user_id: int, charges: int, last_charge_at: Optional[float] = None):
+    entry = {'roll_charges': charges}
+    if last_charge_at is not None:
+        entry['last_charge_at'] = last_charge_at
+    if _store is not None:
+        _store.update_user(user_id, _register_undo, **entry)
+        return
+    if COUNTER_DURABILITY != 'sync':
+        _record_counter(user_id, entry)
+        return
+    conn = get_conn()
+    c = conn.cursor()
+    if last_charge_at is None:
+        c.execute('UPDATE users SET roll_charges = ? WHERE user_id = ?', (charges, user_id))
+    else:
+        c.execute('UPDATE users SET roll_charges = ?, last_charge_at = ? WHERE user_id = ?', (charges, last_charge_at, user_id))
+    conn.commit()
+    conn.close()
+    _note_user_write(user_id)
+
+def get_user_money(user_id: int) -> int:
+    user = _store.get_user(user_id) if _store is not None else _current_user(user_id)
+    return user['money'] if user else 0
+
+def get_user_charges(user_id: int) -> Optional[Tuple[int, float]]:
+    user = _store.get_user(user_id) if _store is not None else _current_user(user_id)
+    if not user:
+        return None
+    return user['roll_charges'], user['last_charge_at']
 
 def set_legendary(user_id: int, is_legendary: bool):
+    if _store is not None:
+        _store.update_user(user_id, _register_undo, legendary=bool(is_legendary))
+        return
     conn = get_conn()
     c = conn.cursor()
     c.execute('UPDATE users SET legendary = ? WHERE user_id = ?', (int(is_legendary), user_id))
     conn.commit()
     conn.close()
+    _note_user_write(user_id)
+
+def get_username(user_id: int) -> Optional[str]:
+    if _store is not None:
+        return _store.username(user_id)
+    user = _current_user(user_id)
+    return user['username'] if user else None
+
+def top_users(limit: int = 10) -> List[Tuple[str, int]]:
+    if _store is not None:
+        return _store.top_users(limit)
+    flush_counters()
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT username, money FROM users ORDER BY money DESC LIMIT ?', (limit,))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def legendary_usernames() -> List[str]:
+    if _store is not None:
+        return _store.legendary_usernames()
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT username FROM users WHERE legendary = 1')
+    rows = [r[0] for r in c.fetchall()]
+    conn.close()
+    return rows
+
+def all_user_ids() -> List[int]:
+    if _store is not None:
+        return _store.user_ids()
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT user_id FROM users')
+    rows = [r[0] for r in c.fetchall()]
+    conn.close()
+    return rows
+
+# --------------------------------------------------------------------------------
+# Items & effects
+# Per-user shop items (user_items) and timed effects (user_effects). Both go
+# through the memory store when it's enabled.
+# --------------------------------------------------------------------------------
+
+def get_item_qty(user_id: int, item_id: str) -> int:
+    if _store is not None:
+        return _store.item_qty(user_id, item_id)
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT qty FROM user_items WHERE user_id = ? AND item_id = ?', (user_id, item_id))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+def add_item(user_id: int, item_id: str, qty: int = 1):
+    if _store is not None:
+        _store.add_item(user_id, item_id, qty, _register_undo)
+        return
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('''
+        INSERT INTO user_items (user_id, item_id, qty) VALUES (?, ?, ?)
+        ON CONFLICT(user_id, item_id) DO UPDATE SET qty = qty + excluded.qty
+    ''', (user_id, item_id, qty))
+    conn.commit()
+    conn.close()
+
+def consume_item(user_id: int, item_id: str, qty: int = 1) -> bool:
+    if _store is not None:
+        return _store.consume_item(user_id, item_id, qty, _register_undo)
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT qty FROM user_items WHERE user_id = ? AND item_id = ?', (user_id, item_id))
+    row = c.fetchone()
+    if not row or row[0] < qty:
+        conn.close()
+        return False
+    c.execute('UPDATE user_items SET qty = qty - ? WHERE user_id = ? AND item_id = ?', (qty, user_id, item_id))
+    c.execute('DELETE FROM user_items WHERE user_id = ? AND item_id = ? AND qty <= 0', (user_id, item_id))
+    conn.commit()
+    conn.close()
+    return True
+
+def list_items(user_id: int) -> List[Tuple[str, int]]:
+    if _store is not None:
+        return _store.list_items(user_id)
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT item_id, qty FROM user_items WHERE user_id = ? AND qty > 0 ORDER BY qty DESC', (user_id,))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+# Once init_storage() has loaded the effect index (effects.py), effect reads
+# are answered from memory and expiry is handled by sweep_expired_effects()
+# on the scheduler thread; nothing here touches user_effects unless an effect
+# is actually being set or removed. Before that (scripts, db.py itself) the
+# helpers fall back to querying the table directly.
+#
+# Like the user cache, the index only holds committed effects: a change made
+# inside a unit of work waits on the lease (this thread reads it from there)
+# and reaches the index when the unit commits.
+#
+# The sweep job is scheduled from the heap: after each sweep it asks to run
+# again at next_effect_expiry(), and bot.set_effect brings it forward for a
+# new effect that expires sooner. EFFECT_SWEEP_INTERVAL is only the longest
+# it will wait.
+
+EFFECT_SWEEP_INTERVAL = 60
+EFFECT_SWEEP_BATCH = 500
+
+_effect_index = None
+
+def _load_effect_index():
+    global _effect_index
+    from effects import EffectIndex
+    index = EffectIndex()
+    if _store is not None:
+        index.load(_store.effect_rows())
+    else:
+        conn = get_conn()
+        c = conn.cursor()
+        c.execute('SELECT user_id, effect_type, effect_value, expires_at FROM user_effects')
+        index.load(c.fetchall())
+        conn.close()
+    _effect_index = index
+
+def _staged_effects():
+    lease = get_pool().current_lease()
+    return lease.get('effects') if lease is not None else None
+
+def _stage_effect(user_id, effect_type, current):
+    """current: (value, expires_at) just written, or None for a delete."""
+    lease = get_pool().current_lease()
+    if lease is not None and lease.get('uow'):
+        lease.setdefault('effects', {})[(user_id, effect_type)] = current
+    else:
+        _apply_effects({(user_id, effect_type): current})
+
+def _apply_effects(effects):
+    for (user_id, effect_type), current in effects.items():
+        if current is None:
+            _effect_index.remove(user_id, effect_type)
+        else:
+            _effect_index.put(user_id, effect_type, *current)
+
+def get_effect_row(user_id: int, effect_type: str) -> Optional[Tuple[Any, Optional[float]]]:
+    """(effect_value, expires_at) or None. Doesn't look at expiry."""
+    if _effect_index is not None:
+        staged = _staged_effects()
+        if staged and (user_id, effect_type) in staged:
+            return staged[(user_id, effect_type)]
+        return _effect_index.get(user_id, effect_type)
+    if _store is not None:
+        return _store.get_effect(user_id, effect_type)
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT effect_value, expires_at FROM user_effects WHERE user_id = ? AND effect_type = ?', (user_id, effect_type))
+    row = c.fetchone()
+    conn.close()
+    return tuple(row) if row else None
+
+def put_effect(user_id: int, effect_type: str, value, expires_at: Optional[float]):
+    if _store is not None:
+        _store.put_effect(user_id, effect_type, value, expires_at, _register_undo)
+    else:
+        conn = get_conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO user_effects (user_id, effect_type, effect_value, expires_at) VALUES (?, ?, ?, ?)',
+            (user_id, effect_type, value, expires_at)
+        )
+        conn.commit()
+        conn.close()
+    if _effect_index is not None:
+        _stage_effect(user_id, effect_type, (value, expires_at))
+
+def delete_effect(user_id: int, effect_type: str):
+    if _effect_index is not None and get_effect_row(user_id, effect_type) is None:
+        return
+    if _store is not None:
+        _store.delete_effect(user_id, effect_type, _register_undo)
+    else:
+        conn = get_conn()
+        conn.execute('DELETE FROM user_effects WHERE user_id = ? AND effect_type = ?', (user_id, effect_type))
+        conn.commit()
+        conn.close()
+    if _effect_index is not None:
+        _stage_effect(user_id, effect_type, None)
+
+def pop_expired_effects(user_id: int, now: float) -> List[str]:
+    """Types of the user's effects that have expired since the last call.
+    With the effect index these were already deleted by the sweeper."""
+    if _effect_index is not None:
+        return _effect_index.pop_expired(user_id)
+    if _store is not None:
+        return _store.pop_expired_effects(user_id, now, _register_undo)
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT effect_type FROM user_effects WHERE user_id = ? AND expires_at IS NOT NULL AND expires_at <= ?', (user_id, now))
+    expired = [r[0] for r in c.fetchall()]
+    if expired:
+        c.execute('DELETE FROM user_effects WHERE user_id = ? AND expires_at IS NOT NULL AND expires_at <= ?', (user_id, now))
+        conn.commit()
+    conn.close()
+    return expired
+
+def sweep_expired_effects(now: Optional[float] = None) -> int:
+    """Delete every effect due by now, EFFECT_SWEEP_BATCH rows per statement,
+    and queue them for pop_expired_effects(). Returns how many went."""
+    if _effect_index is None:
+        return 0
+    if now is None:
+        now = time.time()
+    swept = 0
+    while True:
+        rows = _effect_index.take_due(now, EFFECT_SWEEP_BATCH)
+        if not rows:
+            break
+        # If this raises, the rows are already gone from the index but stay in
+        # the table; they come back as due on the next load and get swept then.
+        if _store is not None:
+            _store.delete_expired_effects(rows)
+        else:
+            conn = get_conn()
+            # Matching on expires_at leaves alone an effect that was set again meanwhile
+            conn.executemany(
+                'DELETE FROM user_effects WHERE user_id = ? AND effect_type = ? AND expires_at = ?',
+                rows
+            )
+            conn.commit()
+            conn.close()
+        _effect_index.queue_expired(rows)
+        swept += len(rows)
+        if len(rows) < EFFECT_SWEEP_BATCH:
+            break
+    return swept
+
+def next_effect_expiry() -> Optional[float]:
+    """When the earliest indexed effect expires (None: nothing timed)."""
+    return _effect_index.next_expiry() if _effect_index is not None else None
+
+def effect_stats() -> Dict[str, Any]:
+    if _effect_index is None:
+        return {'indexed': False}
+    return dict(_effect_index.snapshot(), indexed=True)
+
+# --------------------------------------------------------------------------------
+# Photo file_id cache
+# Telegram hands back a file_id for every photo we upload, and sending that
+# id again costs no upload. Keyed by a hash of the image bytes.
+#
+# Reuse counts are kept in memory and added to the uses column by
+# flush_photo_uses() (a scheduler job, and at exit) rather than with an
+# UPDATE + commit on every send.
+# --------------------------------------------------------------------------------
+
+PHOTO_USES_FLUSH_INTERVAL = 300
+
+_photo_uses: Dict[str, int] = {}
+_photo_uses_lock = threading.Lock()
+
+def get_photo_file_id(content_hash: str) -> Optional[str]:
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute('SELECT file_id FROM photo_file_ids WHERE content_hash = ?', (content_hash,))
+    row = c.fetchone()
+    conn.close()
+    if row is None:
+        return None
+    with _photo_uses_lock:
+        _photo_uses[content_hash] = _photo_uses.get(content_hash, 0) + 1
+    return row[0]
+
+def save_photo_file_id(content_hash: str, file_id: str):
+    with _photo_uses_lock:
+        _photo_uses.pop(content_hash, None)
+    conn = get_conn()
+    conn.execute(
+        'INSERT OR REPLACE INTO photo_file_ids (content_hash, file_id, created_at, uses) VALUES (?, ?, ?, 0)',
+        (content_hash, file_id, time.time())
+    )
+    conn.commit()
+    conn.close()
+
+def forget_photo_file_id(content_hash: str):
+    with _photo_uses_lock:
+        _photo_uses.pop(content_hash, None)
+    conn = get_conn()
+    conn.execute('DELETE FROM photo_file_ids WHERE content_hash = ?', (content_hash,))
+    conn.commit()
+    conn.close()
+
+def flush_photo_uses() -> int:
+    """Write the reuse counts gathered since the last flush; returns how many rows."""
+    with _photo_uses_lock:
+        pending = list(_photo_uses.items())
+        _photo_uses.clear()
+    if not pending:
+        return 0
+    conn = get_conn()
+    try:
+        conn.executemany('UPDATE photo_file_ids SET uses = uses + ? WHERE content_hash = ?',
+                         [(count, content_hash) for content_hash, count in pending])
+        conn.commit()
+    except Exception:
+        with _photo_uses_lock:
+            for content_hash, count in pending:
+                _photo_uses[content_hash] = _photo_uses.get(content_hash, 0) + count
+        raise
+    finally:
+        conn.close()
+    return len(pending)
+
+atexit.register(flush_photo_uses)
+
+# --------------------------------------------------------------------------------
+# Storage engine
+# STORAGE_ENGINE = 'memory' keeps users, user_items and user_effects in a
+# MemoryStore (see memstore.py) and persists them through an op log plus a
+# snapshot every SNAPSHOT_INTERVAL seconds. 'sqlite' is the default and
+# leaves everything above on the SQL path. Chosen once, by init_storage().
+# --------------------------------------------------------------------------------
+
+STORAGE_ENGINE = os.environ.get('ISOPOD_STORAGE', 'sqlite')
+SNAPSHOT_INTERVAL = 300
+
+_store = None
+
+def init_storage(engine: Optional[str] = None):
+    global _store, STORAGE_ENGINE
+    if engine is not None:
+        STORAGE_ENGINE = engine
+    if STORAGE_ENGINE == 'sqlite':
+        _store = None
+        _load_effect_index()
+        return None
+    if STORAGE_ENGINE != 'memory':
+        raise ValueError(f"Unknown storage engine {STORAGE_ENGINE!r}")
+    from memstore import MemoryStore
+    # Anything still queued for the SQL path has to land before we load
+    flush_counters()
+    store = MemoryStore(DB_PATH + '.oplog')
+    conn = open_standalone_conn()
+    try:
+        store.load(conn)
+    finally:
+        conn.close()
+    _store = store
+    _load_effect_index()
+    return store
+
+def snapshot_store():
+    if _store is None:
+        return
+    conn = open_standalone_conn()
+    try:
+        _store.snapshot(conn)
+    finally:
+        conn.close()
+
+atexit.register(snapshot_store)
+
+def storage_stats() -> Dict[str, Any]:
+    if _store is None:
+        return {'engine': 'sqlite'}
+    return dict(_store.stats, engine='memory')
 
 # More funcs later
+
+def _main(argv=None):
+    global DB_PATH
+    import argparse
+    parser = argparse.ArgumentParser(description='Isopod DB schema migrations')
+    parser.add_argument('--db', default=DB_PATH, help='database file (default: %(default)s)')
+    parser.add_argument('command', choices=['status', 'migrate'])
+    args = parser.parse_args(argv)
+    DB_PATH = args.db
+    conn = get_conn()
+    current = get_schema_version(conn)
+    pending = pending_migrations(conn)
+    if args.command == 'status':
+        print(f"Schema version {current} (latest {SCHEMA_VERSION})")
+        for version, description, _ in pending:
+            print(f"  pending {version}: {description}")
+        if not pending:
+            print("Up to date")
+    else:
+        applied = migrate(conn)
+        for version, description, _ in MIGRATIONS:
+            if version in applied:
+                print(f"Applied {version}: {description}")
+        print(f"Schema version {get_schema_version(conn)}")
+    conn.close()
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,110 @@
+import heapq
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------
+# Effect index
+# Every user's timed effects (user_effects) kept in a dict, so handlers can
+# ask "does this user have a shop discount?" without a query. The table (or
+# the memory store) is still where effects live; db.py writes through to it
+# and updates the index once the write is committed.
+#
+# Expiry times go into a heap. The sweeper (db.sweep_expired_effects, run
+# from the scheduler whenever the head of the heap comes due) pops whatever
+# is due, deletes those rows in one batch and leaves the effect types here
+# until the user's next command picks them up as the "Expired" notice. Heap entries are never removed early: when an
+# effect is replaced or consumed its old entry just no longer matches and is
+# dropped when it comes up.
+# ---------------------------------------------------------------------------
+
+class EffectIndex:
+    def __init__(self):
+        self._effects = {}
+        self._heap = []
+        self._expired = {}
+        self._lock = threading.Lock()
+        self.stats = {'loaded': 0, 'swept': 0, 'sweeps': 0, 'stale': 0}
+
+    def load(self, rows):
+        """rows: (user_id, effect_type, value, expires_at) for every effect."""
+        with self._lock:
+            self._effects.clear()
+            self._heap = []
+            for user_id, effect_type, value, expires_at in rows:
+                self._effects.setdefault(user_id, {})[effect_type] = (value, expires_at)
+                if expires_at is not None:
+                    self._heap.append((expires_at, user_id, effect_type))
+            heapq.heapify(self._heap)
+            self.stats['loaded'] = len(rows)
+        logger.info(f"Effect index loaded {len(rows)} effects")
+
+    def get(self, user_id, effect_type):
+        """(value, expires_at) or None. Like the table, doesn't look at expiry."""
+        with self._lock:
+            effs = self._effects.get(user_id)
+            return effs.get(effect_type) if effs else None
+
+    def put(self, user_id, effect_type, value, expires_at):
+        """Set an effect and return what it replaced."""
+        with self._lock:
+            effs = self._effects.setdefault(user_id, {})
+            before = effs.get(effect_type)
+            effs[effect_type] = (value, expires_at)
+            if expires_at is not None:
+                heapq.heappush(self._heap, (expires_at, user_id, effect_type))
+            return before
+
+    def remove(self, user_id, effect_type):
+        """Drop an effect and return what it was (None if there wasn't one)."""
+        with self._lock:
+            effs = self._effects.get(user_id)
+            if not effs:
+                return None
+            before = effs.pop(effect_type, None)
+            if not effs:
+                del self._effects[user_id]
+            return before
+
+    def take_due(self, now, limit):
+        """Remove up to limit effects expired by now; [(user_id, effect_type, expires_at)]."""
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and len(due) < limit:
+                expires_at, user_id, effect_type = heapq.heappop(self._heap)
+                effs = self._effects.get(user_id)
+                current = effs.get(effect_type) if effs else None
+                if current is None or current[1] != expires_at:
+                    self.stats['stale'] += 1
+                    continue
+                del effs[effect_type]
+                if not effs:
+                    del self._effects[user_id]
+                due.append((user_id, effect_type, expires_at))
+        return due
+
+    def queue_expired(self, rows):
+        with self._lock:
+            for user_id, effect_type, _ in rows:
+                self._expired.setdefault(user_id, []).append(effect_type)
+            self.stats['swept'] += len(rows)
+            self.stats['sweeps'] += 1
+
+    def pop_expired(self, user_id):
+        """Effect types swept since the user's last call."""
+        with self._lock:
+            return self._expired.pop(user_id, [])
+
+    def next_expiry(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+            data['users'] = len(self._effects)
+            data['effects'] = sum(len(e) for e in self._effects.values())
+            data['heap'] = len(self._heap)
+            data['pending_notices'] = sum(len(e) for e in self._expired.values())
+        return data
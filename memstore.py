@@ -0,0 +1,359 @@
+import os
+import json
+import time
+import shutil
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------
+# In-memory storage engine
+# Optional replacement for the users / user_items / user_effects tables. The
+# live data sits in plain dicts guarded by one lock; every change is appended
+# to an operation log next to the database, and snapshot() writes the whole
+# thing back into those same isopods.db tables and truncates the log. On
+# startup we load the tables and replay whatever log is left, so a crash
+# loses nothing that reached the log.
+#
+# Log records carry absolute values (the user's whole row, an item's new qty),
+# never deltas, so replaying a record that is already in the snapshot is
+# harmless. Inventory, auctions, battles etc. still live in SQLite: those are
+# joined against the marketplace all over bot.py.
+#
+# Select it with db.STORAGE_ENGINE = 'memory'; db.py does the dispatching.
+#
+# bench_storage.py measured about 3x the SQL engine's commands/s when this
+# went in. The SQL side has since gained the effect index and write-behind
+# counters, and the default bench run now shows 1.5-2x.
+# ---------------------------------------------------------------------------
+
+OPLOG_FSYNC = False
+
+USER_FIELDS = ('username', 'money', 'legendary', 'last_roll', 'roll_charges', 'last_charge_at')
+
+class _User:
+    __slots__ = USER_FIELDS
+
+    def __init__(self, username, money=0, legendary=False, last_roll=0, roll_charges=1, last_charge_at=0):
+        self.username = username
+        self.money = money
+        self.legendary = legendary
+        self.last_roll = last_roll
+        self.roll_charges = roll_charges
+        self.last_charge_at = last_charge_at
+
+    def as_list(self):
+        return [getattr(self, f) for f in USER_FIELDS]
+
+class MemoryStore:
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self._lock = threading.RLock()
+        self._users = {}
+        self._usernames = {}
+        self._items = {}
+        self._effects = {}
+        self._log = None
+        self.stats = {'ops': 0, 'snapshots': 0, 'snapshot_seconds': 0.0, 'replayed': 0}
+
+    # -- persistence -------------------------------------------------------
+
+    def load(self, conn):
+        c = conn.cursor()
+        c.execute('SELECT user_id, username, money, legendary, last_roll, roll_charges, last_charge_at FROM users')
+        for user_id, username, money, legendary, last_roll, roll_charges, last_charge_at in c.fetchall():
+            self._put_user(user_id, _User(username, money or 0, bool(legendary), last_roll, roll_charges, last_charge_at))
+        c.execute('SELECT user_id, item_id, qty FROM user_items WHERE qty > 0')
+        for user_id, item_id, qty in c.fetchall():
+            self._items.setdefault(user_id, {})[item_id] = qty
+        c.execute('SELECT user_id, effect_type, effect_value, expires_at FROM user_effects')
+        for user_id, effect_type, value, expires_at in c.fetchall():
+            self._effects.setdefault(user_id, {})[effect_type] = (value, expires_at)
+        # A snapshot that died halfway leaves its log behind as .old
+        for path in (self.log_path + '.old', self.log_path):
+            if os.path.exists(path):
+                self._replay(path)
+        self._log = open(self.log_path, 'a', encoding='utf-8')
+        logger.info(f"Memory store loaded {len(self._users)} users, replayed {self.stats['replayed']} ops")
+
+    def _replay(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    # Torn final write from a crash
+                    break
+                self._apply(op)
+                self.stats['replayed'] += 1
+
+    def _apply(self, op):
+        kind = op[0]
+        if kind == 'user':
+            _, user_id, values = op
+            self._put_user(user_id, _User(*values))
+        elif kind == 'user_del':
+            _, user_id = op
+            self._pop_user(user_id)
+        elif kind == 'item':
+            _, user_id, item_id, qty = op
+            self._set_item(user_id, item_id, qty)
+        elif kind == 'effect':
+            _, user_id, effect_type, value, expires_at = op
+            self._effects.setdefault(user_id, {})[effect_type] = (value, expires_at)
+        elif kind == 'effect_del':
+            _, user_id, effect_type = op
+            self._effects.get(user_id, {}).pop(effect_type, None)
+
+    def _write(self, op):
+        self.stats['ops'] += 1
+        if self._log is None:
+            return
+        self._log.write(json.dumps(op) + '\n')
+        self._log.flush()
+        if OPLOG_FSYNC:
+            os.fsync(self._log.fileno())
+
+    def snapshot(self, conn):
+        """Write everything into the SQLite tables and start a fresh log.
+        conn must be a connection of its own (not inside a unit of work)."""
+        start = time.perf_counter()
+        with self._lock:
+            users = [(uid, *u.as_list()) for uid, u in self._users.items()]
+            items = [(uid, item_id, qty) for uid, inv in self._items.items() for item_id, qty in inv.items()]
+            effects = self.effect_rows()
+            if self._log is not None:
+                self._log.close()
+                self._retire_log()
+                self._log = open(self.log_path, 'a', encoding='utf-8')
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            c.executemany('''
+                INSERT INTO users (user_id, username, money, legendary, last_roll, roll_charges, last_charge_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username, money = excluded.money, legendary = excluded.legendary,
+                    last_roll = excluded.last_roll, roll_charges = excluded.roll_charges,
+                    last_charge_at = excluded.last_charge_at
+            ''', [(u[0], u[1], u[2], int(bool(u[3])), u[4], u[5], u[6]) for u in users])
+            c.execute('DELETE FROM user_items')
+            c.executemany('INSERT INTO user_items (user_id, item_id, qty) VALUES (?, ?, ?)', items)
+            c.execute('DELETE FROM user_effects')
+            c.executemany('INSERT INTO user_effects (user_id, effect_type, effect_value, expires_at) VALUES (?, ?, ?, ?)', effects)
+            c.execute('COMMIT')
+        except Exception:
+            c.execute('ROLLBACK')
+            raise
+        if os.path.exists(self.log_path + '.old'):
+            os.remove(self.log_path + '.old')
+        elapsed = time.perf_counter() - start
+        self.stats['snapshots'] += 1
+        self.stats['snapshot_seconds'] += elapsed
+        logger.info(f"Memory store snapshot: {len(users)} users, {len(items)} items, {len(effects)} effects in {elapsed:.3f}s")
+
+    def _retire_log(self):
+        old_path = self.log_path + '.old'
+        if not os.path.exists(old_path):
+            os.replace(self.log_path, old_path)
+            return
+        # A previous snapshot failed and its ops aren't in the tables yet:
+        # keep them and add this log after them, replay order stays the same
+        with open(self.log_path, 'r', encoding='utf-8') as src, open(old_path, 'a', encoding='utf-8') as dst:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.remove(self.log_path)
+
+    # -- users -------------------------------------------------------------
+
+    def _put_user(self, user_id, user):
+        old = self._users.get(user_id)
+        if old is not None and self._usernames.get(old.username) == user_id:
+            del self._usernames[old.username]
+        self._users[user_id] = user
+        if user.username:
+            self._usernames[user.username] = user_id
+
+    def _save_user(self, user_id, user, undo):
+        before = self._users.get(user_id)
+        before_values = before.as_list() if before is not None else None
+        self._put_user(user_id, user)
+        self._write(['user', user_id, user.as_list()])
+        if before_values is not None:
+            undo(lambda: self._restore_user(user_id, before_values))
+        else:
+            undo(lambda: self._drop_user(user_id))
+
+    def _restore_user(self, user_id, values):
+        with self._lock:
+            self._put_user(user_id, _User(*values))
+            self._write(['user', user_id, values])
+
+    def _pop_user(self, user_id):
+        user = self._users.pop(user_id, None)
+        if user is not None and self._usernames.get(user.username) == user_id:
+            del self._usernames[user.username]
+
+    def _drop_user(self, user_id):
+        # Only reachable by undoing a create; the row was never snapshotted
+        # unless a snapshot raced the command, in which case zeroing is fine.
+        # Logged too, or replay would bring the user back.
+        with self._lock:
+            self._pop_user(user_id)
+            self._write(['user_del', user_id])
+
+    def get_user(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                return None
+            return {
+                'user_id': user_id,
+                'username': user.username,
+                'money': user.money,
+                'legendary': bool(user.legendary),
+                'last_roll': user.last_roll,
+                'roll_charges': user.roll_charges,
+                'last_charge_at': user.last_charge_at
+            }
+
+    def create_user(self, user_id, username, now, undo):
+        with self._lock:
+            if user_id not in self._users:
+                self._save_user(user_id, _User(username, 0, False, 0, 1, now), undo)
+            return self.get_user(user_id)
+
+    def update_user(self, user_id, undo, money_delta=0, **fields):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                return
+            updated = _User(*user.as_list())
+            updated.money += money_delta
+            for key, value in fields.items():
+                setattr(updated, key, value)
+            self._save_user(user_id, updated, undo)
+
+    def user_id_by_username(self, username):
+        with self._lock:
+            return self._usernames.get(username)
+
+    def username(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id)
+            return user.username if user else None
+
+    def top_users(self, limit):
+        with self._lock:
+            rows = [(u.username, u.money) for u in self._users.values()]
+        rows.sort(key=lambda r: r[1], reverse=True)
+        return rows[:limit]
+
+    def legendary_usernames(self):
+        with self._lock:
+            return [u.username for u in self._users.values() if u.legendary]
+
+    def user_ids(self):
+        with self._lock:
+            return list(self._users)
+
+    # -- items -------------------------------------------------------------
+
+    def _set_item(self, user_id, item_id, qty):
+        inv = self._items.setdefault(user_id, {})
+        if qty > 0:
+            inv[item_id] = qty
+        else:
+            inv.pop(item_id, None)
+
+    def _change_item(self, user_id, item_id, qty, undo):
+        before = self._items.get(user_id, {}).get(item_id, 0)
+        self._set_item(user_id, item_id, qty)
+        self._write(['item', user_id, item_id, qty])
+        undo(lambda: self._restore_item(user_id, item_id, before))
+
+    def _restore_item(self, user_id, item_id, qty):
+        with self._lock:
+            self._set_item(user_id, item_id, qty)
+            self._write(['item', user_id, item_id, qty])
+
+    def item_qty(self, user_id, item_id):
+        with self._lock:
+            return self._items.get(user_id, {}).get(item_id, 0)
+
+    def add_item(self, user_id, item_id, qty, undo):
+        with self._lock:
+            self._change_item(user_id, item_id, self.item_qty(user_id, item_id) + qty, undo)
+
+    def consume_item(self, user_id, item_id, qty, undo):
+        with self._lock:
+            have = self.item_qty(user_id, item_id)
+            if have < qty:
+                return False
+            self._change_item(user_id, item_id, have - qty, undo)
+            return True
+
+    def list_items(self, user_id):
+        with self._lock:
+            rows = list(self._items.get(user_id, {}).items())
+        rows.sort(key=lambda r: r[1], reverse=True)
+        return rows
+
+    # -- effects -----------------------------------------------------------
+
+    def get_effect(self, user_id, effect_type):
+        with self._lock:
+            return self._effects.get(user_id, {}).get(effect_type)
+
+    def put_effect(self, user_id, effect_type, value, expires_at, undo):
+        with self._lock:
+            before = self.get_effect(user_id, effect_type)
+            self._effects.setdefault(user_id, {})[effect_type] = (value, expires_at)
+            self._write(['effect', user_id, effect_type, value, expires_at])
+            undo(lambda: self._restore_effect(user_id, effect_type, before))
+
+    def delete_effect(self, user_id, effect_type, undo):
+        with self._lock:
+            before = self._effects.get(user_id, {}).pop(effect_type, None)
+            if before is None:
+                return
+            self._write(['effect_del', user_id, effect_type])
+            undo(lambda: self._restore_effect(user_id, effect_type, before))
+
+    def _restore_effect(self, user_id, effect_type, before):
+        with self._lock:
+            if before is None:
+                self._effects.get(user_id, {}).pop(effect_type, None)
+                self._write(['effect_del', user_id, effect_type])
+            else:
+                self._effects.setdefault(user_id, {})[effect_type] = before
+                self._write(['effect', user_id, effect_type, before[0], before[1]])
+
+    def effect_rows(self):
+        with self._lock:
+            return [
+                (uid, effect_type, value, expires_at)
+                for uid, effs in self._effects.items()
+                for effect_type, (value, expires_at) in effs.items()
+            ]
+
+    def delete_expired_effects(self, rows):
+        """Drop each (user_id, effect_type, expires_at) that still has that expiry."""
+        with self._lock:
+            for user_id, effect_type, expires_at in rows:
+                current = self._effects.get(user_id, {}).get(effect_type)
+                if current is not None and current[1] == expires_at:
+                    del self._effects[user_id][effect_type]
+                    self._write(['effect_del', user_id, effect_type])
+
+    def pop_expired_effects(self, user_id, now, undo):
+        with self._lock:
+            effs = self._effects.get(user_id)
+            if not effs:
+                return []
+            expired = [t for t, (_, expires_at) in effs.items() if expires_at is not None and expires_at <= now]
+            for effect_type in expired:
+                self.delete_effect(user_id, effect_type, undo)
+            return expired
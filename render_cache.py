@@ -0,0 +1,110 @@
+import os
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------
+# Render cache
+# Encoded PNG bytes for (sprite, color, variant), so a roll doesn't colorize,
+# draw a gradient and encode a PNG every time. There are only a dozen colors
+# and a handful of streak variants per color, so after warm-up every render is
+# a dict lookup.
+#
+# Entries live in an LRU bounded by max_entries. With disk_dir set, renders
+# are also written there under a hash of everything that went into them
+# (sprite file contents, color, variant, RENDER_VERSION in utils), so they
+# survive restarts and go stale on their own when a sprite changes.
+# ---------------------------------------------------------------------------
+
+class RenderCache:
+    def __init__(self, max_entries=256, disk_dir=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'render_seconds': 0.0}
+
+    def _disk_path(self, digest):
+        return os.path.join(self.disk_dir, digest[:2], digest + '.png')
+
+    def _read_disk(self, digest):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(digest), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, digest, data):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(digest)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            logger.warning(f"Could not write render cache file {path}", exc_info=True)
+
+    def _put(self, key, data):
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def get(self, key, digest, render):
+        """Bytes for key, from memory, then disk, then render() -> bytes.
+        digest names the on-disk copy and must change whenever the output would."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return data
+        data = self._read_disk(digest)
+        if data is not None:
+            with self._lock:
+                self.stats['disk_hits'] += 1
+            self._put(key, data)
+            return data
+        # Two threads may render the same key at once; both get identical bytes
+        start = time.perf_counter()
+        data = render()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stats['misses'] += 1
+            self.stats['render_seconds'] += elapsed
+        self._write_disk(digest, data)
+        self._put(key, data)
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+            data['size'] = len(self._entries)
+            data['bytes'] = sum(len(v) for v in self._entries.values())
+        lookups = data['hits'] + data['disk_hits'] + data['misses']
+        data['hit_rate'] = (data['hits'] + data['disk_hits']) / lookups if lookups else 0.0
+        return data
+
+def digest_of(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(part)
+        h.update(b'\0')
+    return h.hexdigest()
@@ -0,0 +1,73 @@
+import os
+import random
+import hashlib
+import threading
+
+import numpy as np
+
+# ---------------------------------------------------------------------------
+# Random streams
+# Each subsystem (rolls, battles, races, fishing, market, streaks, shop,
+# items) draws from its own Stream instead of the global random module, so
+# one subsystem using more or fewer numbers doesn't shift everything else.
+#
+# A Stream is a random.Random (randint, choice, sample... all work) with a
+# NumPy Generator next to it for hot loops: uniforms(n) hands back a block
+# of n floats in one call, and gen can go straight into
+# AliasTable.draw_many().
+#
+# With ISOPOD_SEED set (or after seed_all()), every stream is seeded from
+# that seed and its own name, so a benchmark or replay run on one thread
+# makes exactly the same draws every time. Without it, streams seed from the
+# OS like random does. Handler threads and the variant pool still interleave
+# however the scheduler runs them, so the live bot isn't reproducible even
+# with a seed. In particular the 'streaks' stream is shared by roll renders
+# and the background variant_pool thread (which also decides what the pools
+# hold when), so roll images aren't byte-for-byte repeatable; the game
+# outcomes drawn from the other streams are.
+# ---------------------------------------------------------------------------
+
+SEED = os.environ.get('ISOPOD_SEED')
+
+_streams = {}
+_lock = threading.Lock()
+
+def _derive(seed, name):
+    data = hashlib.sha256(f'{seed}:{name}'.encode('utf-8')).digest()
+    return int.from_bytes(data[:16], 'big')
+
+class Stream(random.Random):
+    def __init__(self, name, seed=None):
+        self.name = name
+        self.gen = None
+        super().__init__()
+        self.reseed(seed)
+
+    def reseed(self, seed=None):
+        """Seed from (seed, name), or from the OS if seed is None."""
+        if seed is None:
+            self.seed()
+            self.gen = np.random.default_rng()
+        else:
+            derived = _derive(seed, self.name)
+            self.seed(derived)
+            self.gen = np.random.default_rng(derived)
+
+    def uniforms(self, shape):
+        """Block of floats in [0, 1) from the NumPy side of the stream."""
+        return self.gen.random(shape)
+
+def get_stream(name):
+    with _lock:
+        stream = _streams.get(name)
+        if stream is None:
+            stream = _streams[name] = Stream(name, SEED)
+        return stream
+
+def seed_all(seed):
+    """Reseed every stream, existing and future, from seed (None: from the OS)."""
+    global SEED
+    with _lock:
+        SEED = None if seed is None else str(seed)
+        for stream in _streams.values():
+            stream.reseed(SEED)
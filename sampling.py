@@ -0,0 +1,161 @@
+import sys
+import math
+import random
+import argparse
+from collections import Counter
+
+import numpy as np
+
+from rng import get_stream
+
+# ---------------------------------------------------------------------------
+# Weighted sampling
+# AliasTable is Walker's alias method (Vose's construction): built once from
+# a weight list, after which every draw is one uniform number, one index and
+# one comparison, whatever the number of outcomes. random.choices redoes the
+# cumulative sums on every call and bisects them.
+#
+# draw() takes anything with the random.Random API, so seeded callers keep
+# their own stream. draw_many() draws a whole batch with NumPy (a market
+# build wants one status per color x word row). Callers that don't pass one
+# get the 'sampling' stream from rng.py, so ISOPOD_SEED covers them too.
+#
+# The distribution is exactly the normalized weights; probabilities() gives
+# it back from the table. test_sampling.py checks that and a chi-square on
+# seeded draws for every table the game uses; `python sampling.py` prints
+# the same check with any number of draws.
+# ---------------------------------------------------------------------------
+
+class AliasTable:
+    def __init__(self, outcomes, weights):
+        outcomes = list(outcomes)
+        weights = [float(w) for w in weights]
+        if not outcomes or len(outcomes) != len(weights):
+            raise ValueError("need one weight per outcome")
+        if any(w < 0 for w in weights) or sum(weights) <= 0:
+            raise ValueError("weights must be non-negative with a positive total")
+        n = len(weights)
+        total = sum(weights)
+        scaled = [w * n / total for w in weights]
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        # Whatever is left is 1.0 up to rounding
+        self.outcomes = outcomes
+        self.weights = weights
+        self._prob = prob
+        self._alias = alias
+        self._prob_arr = np.asarray(prob, dtype=np.float64)
+        self._alias_arr = np.asarray(alias, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.outcomes)
+
+    def draw(self, rng=None):
+        """One outcome, using a single rng.random()."""
+        u = (rng or get_stream('sampling')).random() * len(self._prob)
+        i = int(u)
+        if u - i >= self._prob[i]:
+            i = self._alias[i]
+        return self.outcomes[i]
+
+    def pick(self, u):
+        """Outcome indices (int64 array) for an array of uniforms in [0, 1),
+        one per draw. For callers that make their own uniforms."""
+        u = np.asarray(u, dtype=np.float64) * len(self._prob)
+        i = u.astype(np.int64)
+        return np.where(u - i < self._prob_arr[i], i, self._alias_arr[i])
+
+    def draw_indices(self, n, gen=None):
+        """n outcome indices as an int64 array. gen is a numpy Generator."""
+        gen = gen or get_stream('sampling').gen
+        return self.pick(gen.random(n))
+
+    def draw_many(self, n, gen=None):
+        """n outcomes as a list."""
+        if n <= 0:
+            return []
+        outcomes = self.outcomes
+        return [outcomes[i] for i in self.draw_indices(n, gen).tolist()]
+
+    def probabilities(self):
+        """Probability of each outcome as encoded in the table."""
+        n = len(self._prob)
+        probs = [0.0] * n
+        for i in range(n):
+            probs[i] += self._prob[i] / n
+            probs[self._alias[i]] += (1.0 - self._prob[i]) / n
+        return probs
+
+# ---------------------------------------------------------------------------
+# Statistical check
+#   python sampling.py --draws 1000000
+# ---------------------------------------------------------------------------
+
+def _chi2_critical(df, z=3.09):
+    # Wilson-Hilferty; z = 3.09 is the one-sided 0.999 quantile
+    return df * (1 - 2 / (9 * df) + z * math.sqrt(2 / (9 * df))) ** 3
+
+def chi_square(table, counts, draws):
+    total = sum(table.weights)
+    stat = 0.0
+    for outcome, weight in zip(table.outcomes, table.weights):
+        expected = draws * weight / total
+        if expected:
+            stat += (counts.get(outcome, 0) - expected) ** 2 / expected
+    return stat
+
+def check_table(name, table, draws, rng, gen):
+    total = sum(table.weights)
+    exact = max(abs(p - w / total) for p, w in zip(table.probabilities(), table.weights))
+    df = max(1, sum(1 for w in table.weights if w) - 1)
+    limit = _chi2_critical(df)
+    ok = exact < 1e-12
+    print(f"{name}: table error {exact:.1e}")
+    for label, sample in (
+        ('draw', [table.draw(rng) for _ in range(draws)]),
+        ('draw_many', table.draw_many(draws, gen)),
+        ('random.choices', rng.choices(table.outcomes, weights=table.weights, k=draws)),
+    ):
+        stat = chi_square(table, Counter(sample), draws)
+        passed = stat < limit
+        # random.choices is the reference; it only shows what a pass looks like
+        if label != 'random.choices':
+            ok = ok and passed
+        print(f"  {label:<15} chi2 {stat:8.2f} (df {df}, 0.999 limit {limit:.2f}) {'ok' if passed else 'FAIL'}")
+    return ok
+
+def game_tables():
+    """Every alias table the game draws from, by name. Imports bot.py, so it
+    needs a token (ISOPOD_TOKEN will do) but doesn't start anything."""
+    import bot
+    from utils import STATUS_TABLE
+    tables = {'market status': STATUS_TABLE}
+    for tier, table in sorted(bot.FISH_TIER_TABLES.items()):
+        tables[f'fish tier (rod tier {tier})'] = table
+    tables['item drops'] = bot.ITEM_DROP_TABLE
+    return tables
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the alias tables against the weights they replace')
+    parser.add_argument('--draws', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+    gen = np.random.default_rng(args.seed)
+    ok = True
+    for name, table in game_tables().items():
+        ok = check_table(name, table, args.draws, rng, gen) and ok
+    print("all distributions match" if ok else "MISMATCH")
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
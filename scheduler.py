@@ -0,0 +1,123 @@
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------
+# Scheduler
+# One background thread that runs periodic jobs (market regen, shop rotation).
+# Each job's next deadline lives in memory, so request handlers can show
+# "next refresh in ..." without asking the database, and nobody's /roll ends
+# up paying for a three-hour market rebuild.
+#
+# A job that raises is logged and retried after RETRY_DELAY instead of
+# killing the thread. wake_at() brings a job forward when something it
+# handles comes due before its next interval (the effect sweeper asks for the
+# head of its expiry heap); a request made while the job is running counts
+# for its next run.
+# ---------------------------------------------------------------------------
+
+RETRY_DELAY = 60
+
+class Scheduler:
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add_job(self, name, interval, func, next_run=None):
+        """Run func() every interval seconds, first at next_run (default: now)."""
+        with self._lock:
+            self._jobs[name] = {
+                'interval': interval,
+                'func': func,
+                'next_run': time.time() if next_run is None else next_run,
+                'wake': None,
+                'runs': 0,
+                'failures': 0,
+                'last_seconds': 0.0
+            }
+        self._wake.set()
+
+    def next_run(self, name):
+        with self._lock:
+            job = self._jobs.get(name)
+            return job['next_run'] if job else None
+
+    def reschedule(self, name, next_run):
+        with self._lock:
+            if name in self._jobs:
+                self._jobs[name]['next_run'] = next_run
+        self._wake.set()
+
+    def wake_at(self, name, when):
+        """Run the job at when, unless it's due sooner anyway."""
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is None:
+                return
+            job['wake'] = when if job['wake'] is None else min(job['wake'], when)
+            if when >= job['next_run']:
+                return
+            job['next_run'] = when
+        self._wake.set()
+
+    def run_now(self, name):
+        self.reschedule(name, time.time())
+
+    def _due_jobs(self, now):
+        with self._lock:
+            return [name for name, job in self._jobs.items() if job['next_run'] <= now]
+
+    def _run_job(self, name):
+        with self._lock:
+            job = self._jobs[name]
+            # This run covers anything that was due by now
+            if job['wake'] is not None and job['wake'] <= time.time():
+                job['wake'] = None
+        start = time.perf_counter()
+        try:
+            job['func']()
+        except Exception:
+            logger.exception(f"Scheduled job {name} failed")
+            with self._lock:
+                job['failures'] += 1
+                job['next_run'] = time.time() + RETRY_DELAY
+            return
+        with self._lock:
+            job['runs'] += 1
+            job['last_seconds'] = time.perf_counter() - start
+            job['next_run'] = time.time() + job['interval']
+            if job['wake'] is not None:
+                job['next_run'] = min(job['next_run'], job['wake'])
+
+    def run_pending(self):
+        """Run every job that is due, on the calling thread."""
+        for name in self._due_jobs(time.time()):
+            self._run_job(name)
+
+    def _loop(self):
+        while True:
+            self.run_pending()
+            with self._lock:
+                deadlines = [job['next_run'] for job in self._jobs.values()]
+            timeout = max(0.0, min(deadlines) - time.time()) if deadlines else None
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {k: v for k, v in job.items() if k != 'func'}
+                for name, job in self._jobs.items()
+            }
+
+scheduler = Scheduler()
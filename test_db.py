@@ -0,0 +1,381 @@
+import time
+import sqlite3
+import threading
+
+import pytest
+
+import db
+
+def _committed(path, sql, params=()):
+    # A connection of our own, outside the pool: only sees committed rows
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+# ---------------------------------------------------------------------------
+# Connection pool
+# ---------------------------------------------------------------------------
+
+def test_nested_get_conn_shares_one_connection(fresh_db):
+    outer = db.get_conn()
+    inner = db.get_conn()
+    assert inner._lease is outer._lease
+    inner.close()
+    assert db.get_pool().current_lease() is outer._lease
+    outer.close()
+    assert db.get_pool().current_lease() is None
+
+def test_close_discards_uncommitted_work(fresh_db):
+    conn = db.get_conn()
+    conn.execute("INSERT INTO users (user_id, username) VALUES (1, 'alice')")
+    conn.close()
+    assert _committed(fresh_db, 'SELECT * FROM users') == []
+    conn = db.get_conn()
+    assert not conn.in_transaction
+    conn.close()
+
+def test_connections_are_reused_and_capped(fresh_db, monkeypatch):
+    monkeypatch.setattr(db, 'POOL_WAIT_TIMEOUT', 0.2)
+    pool = db.ConnectionPool(fresh_db, size=1)
+    conn = pool.acquire()
+    raw = conn._lease['raw']
+    assert raw.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    errors = []
+
+    def other_thread():
+        try:
+            pool.acquire()
+        except sqlite3.OperationalError as e:
+            errors.append(str(e))
+
+    t = threading.Thread(target=other_thread)
+    t.start()
+    t.join()
+    assert errors == ['timed out waiting for a pooled connection']
+    conn.close()
+    again = pool.acquire()
+    assert again._lease['raw'] is raw
+    again.close()
+    pool.close_all()
+
+# ---------------------------------------------------------------------------
+# Unit of work
+# One commit per command: everything inside goes in together or not at all,
+# and after_commit() work only runs once the commit has happened.
+# ---------------------------------------------------------------------------
+
+def test_unit_of_work_rolls_back_everything(fresh_db):
+    db.get_or_create_user(1, 'alice')
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.update_user_money(1, 50)
+            db.set_legendary(1, True)
+            db.add_item(1, 'shop_discount', 2)
+            raise RuntimeError('command failed')
+    db.flush_counters()
+    assert _committed(fresh_db, 'SELECT money, legendary FROM users WHERE user_id = 1') == [(0, 0)]
+    assert _committed(fresh_db, 'SELECT * FROM user_items') == []
+    assert db.get_user_money(1) == 0
+    assert db.get_or_create_user(1, 'alice')['legendary'] is False
+
+def test_nested_unit_of_work_commits_once_at_the_outer_end(fresh_db):
+    db.get_or_create_user(1, 'alice')
+    with db.unit_of_work():
+        with db.unit_of_work():
+            db.set_legendary(1, True)
+        assert _committed(fresh_db, 'SELECT legendary FROM users WHERE user_id = 1') == [(0,)]
+    assert _committed(fresh_db, 'SELECT legendary FROM users WHERE user_id = 1') == [(1,)]
+
+def test_after_commit_runs_in_order_once_committed_and_released(fresh_db):
+    db.get_or_create_user(1, 'alice')
+    seen = []
+
+    def callback(tag):
+        def run():
+            seen.append((
+                tag,
+                _committed(fresh_db, 'SELECT legendary FROM users WHERE user_id = 1')[0][0],
+                db.get_pool().current_lease() is None
+            ))
+        return run
+
+    with db.unit_of_work():
+        db.after_commit(callback('first'))
+        db.set_legendary(1, True)
+        with db.unit_of_work():
+            db.after_commit(callback('nested'))
+        db.after_commit(callback('last'))
+        assert seen == []
+    assert seen == [('first', 1, True), ('nested', 1, True), ('last', 1, True)]
+
+def test_after_commit_dropped_on_rollback(fresh_db):
+    seen = []
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.after_commit(lambda: seen.append('sent'))
+            raise RuntimeError
+    assert seen == []
+
+def test_after_commit_runs_at_once_outside_a_unit_of_work(fresh_db):
+    seen = []
+    db.after_commit(lambda: seen.append('sent'))
+    assert seen == ['sent']
+
+def test_failing_after_commit_callback_keeps_the_commit_and_the_rest(fresh_db):
+    db.get_or_create_user(1, 'alice')
+    seen = []
+
+    def broken():
+        raise ValueError('telegram is down')
+
+    with db.unit_of_work():
+        db.set_legendary(1, True)
+        db.after_commit(broken)
+        db.after_commit(lambda: seen.append('next'))
+    assert seen == ['next']
+    assert _committed(fresh_db, 'SELECT legendary FROM users WHERE user_id = 1') == [(1,)]
+
+def test_has_pending_writes(fresh_db):
+    db.get_or_create_user(1, 'alice')
+    assert not db.has_pending_writes()
+    with db.unit_of_work():
+        db.get_user_money(1)
+        assert not db.has_pending_writes()
+        db.update_user_money(1, 5)
+        assert db.has_pending_writes()
+    assert not db.has_pending_writes()
+
+def test_other_threads_see_nothing_before_commit(fresh_db):
+    db.get_or_create_user(1, 'alice')
+    db.flush_counters()
+    seen = {}
+
+    def read():
+        seen['money'] = db.get_user_money(1)
+
+    with db.unit_of_work():
+        db.update_user_money(1, 100)
+        assert db.get_user_money(1) == 100
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join()
+    assert seen['money'] == 0
+    assert db.get_user_money(1) == 100
+
+# ---------------------------------------------------------------------------
+# Migrations
+# PRAGMA user_version decides what runs, and every step has to be safe to
+# run again on a database that already has its change.
+# ---------------------------------------------------------------------------
+
+def _schema(path):
+    return _committed(path, "SELECT type, name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' ORDER BY name")
+
+def test_fresh_database_is_current_and_migrate_is_a_no_op(fresh_db):
+    conn = db.get_conn()
+    assert db.get_schema_version(conn) == db.SCHEMA_VERSION
+    assert db.pending_migrations(conn) == []
+    assert db.migrate(conn) == []
+    conn.close()
+
+def test_every_step_can_run_again(fresh_db):
+    schema = _schema(fresh_db)
+    conn = db.get_conn()
+    conn.execute('PRAGMA user_version = 0')
+    assert db.migrate(conn) == [m[0] for m in db.MIGRATIONS]
+    assert db.get_schema_version(conn) == db.SCHEMA_VERSION
+    conn.close()
+    assert _schema(fresh_db) == schema
+
+def test_legacy_database_gets_missing_columns(tmp_path, monkeypatch):
+    path = str(tmp_path / 'old.db')
+    legacy = sqlite3.connect(path)
+    legacy.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, money INTEGER DEFAULT 0, legendary INTEGER DEFAULT 0, last_roll REAL DEFAULT 0)')
+    legacy.execute("INSERT INTO users (user_id, username, money) VALUES (1, 'alice', 40)")
+    legacy.commit()
+    legacy.close()
+    monkeypatch.setattr(db, 'DB_PATH', path)
+    db.init_db()
+    columns = {row[1] for row in _committed(path, 'PRAGMA table_info(users)')}
+    assert {'roll_charges', 'last_charge_at'} <= columns
+    assert _committed(path, 'SELECT money FROM users WHERE user_id = 1') == [(40,)]
+    assert _committed(path, 'PRAGMA user_version') == [(db.SCHEMA_VERSION,)]
+    db.get_pool().close_all()
+
+def test_backfill_only_touches_rows_without_a_charge_time(fresh_db):
+    conn = db.get_conn()
+    conn.executemany('INSERT INTO users (user_id, username, last_charge_at) VALUES (?, ?, ?)',
+                     [(1, 'zero', 0), (2, 'null', None), (3, 'set', 123.0)])
+    conn.execute('PRAGMA user_version = 7')
+    conn.commit()
+    before = time.time()
+    assert 8 in db.migrate(conn)
+    conn.close()
+    rows = dict(_committed(fresh_db, 'SELECT user_id, last_charge_at FROM users'))
+    assert rows[1] >= before and rows[2] >= before
+    assert rows[3] == 123.0
+    conn = db.get_conn()
+    assert db.migrate(conn) == []
+    conn.close()
+    assert dict(_committed(fresh_db, 'SELECT user_id, last_charge_at FROM users')) == rows
+
+# ---------------------------------------------------------------------------
+# Write-behind counters
+# ---------------------------------------------------------------------------
+
+def test_counter_updates_merge_per_user(fresh_db):
+    db.get_or_create_user(1, 'alice')
+    db.update_user_money(1, 10)
+    db.update_user_money(1, -3)
+    db.update_user_last_roll(1, 100.0)
+    db.update_user_last_roll(1, 200.0)
+    db.set_user_charges(1, 4, 150.0)
+    assert db.counter_stats()['pending'] == 1
+    assert _committed(fresh_db, 'SELECT money FROM users WHERE user_id = 1') == [(0,)]
+    # Readers get the unflushed values laid over the row
+    assert db.get_user_money(1) == 7
+    assert db.get_user_charges(1) == (4, 150.0)
+    assert db.flush_counters() == 1
+    assert _committed(fresh_db, 'SELECT money, last_roll, roll_charges, last_charge_at FROM users WHERE user_id = 1') == [(7, 200.0, 4, 150.0)]
+    assert db.get_user_money(1) == 7
+
+def test_counters_for_a_missing_row_are_retried_under_newer_ones(fresh_db):
+    db.update_user_money(1, 5)
+    db.update_user_last_roll(1, 100.0)
+    assert db.flush_counters() == 0
+    assert db.counter_stats()['retried'] == 1
+    db.update_user_money(1, 2)
+    db.update_user_last_roll(1, 200.0)
+    conn = db.get_conn()
+    conn.execute("INSERT INTO users (user_id, username) VALUES (1, 'alice')")
+    conn.commit()
+    conn.close()
+    assert db.flush_counters() == 1
+    assert _committed(fresh_db, 'SELECT money, last_roll FROM users WHERE user_id = 1') == [(7, 200.0)]
+
+def test_counters_dropped_after_max_retries(fresh_db, monkeypatch):
+    monkeypatch.setattr(db, 'COUNTER_MAX_RETRIES', 2)
+    db.update_user_money(404, 5)
+    for _ in range(3):
+        db.flush_counters()
+    stats = db.counter_stats()
+    assert stats['dropped'] == 1 and stats['pending'] == 0
+
+def test_counters_wait_for_the_unit_of_work(fresh_db):
+    db.get_or_create_user(1, 'alice')
+    with db.unit_of_work():
+        db.update_user_money(1, 5)
+        assert db.counter_stats()['pending'] == 0
+    assert db.counter_stats()['pending'] == 1
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.update_user_money(1, 100)
+            raise RuntimeError
+    db.flush_counters()
+    assert db.get_user_money(1) == 5
+
+def test_read_consistent_rereads_when_a_flush_commits_in_between():
+    lock = threading.RLock()
+    writer = db.CounterWriter(lock)
+    reads = []
+
+    def read_row():
+        reads.append(writer._seq)
+        if len(reads) == 1:
+            # A flush starts and commits while we were reading
+            writer._seq += 2
+        return 'row'
+
+    assert writer.read_consistent(read_row) == 'row'
+    # Returned holding the lock, so the overlay read matches the row
+    assert lock._is_owned()
+    lock.release()
+    assert reads == [0, 2]
+
+def test_read_consistent_waits_out_a_flush_in_progress():
+    lock = threading.RLock()
+    writer = db.CounterWriter(lock)
+    writer._seq = 1
+    reads = []
+
+    def finish_flush():
+        time.sleep(0.02)
+        writer._seq = 2
+
+    t = threading.Thread(target=finish_flush)
+    t.start()
+    writer.read_consistent(lambda: reads.append(writer._seq))
+    lock.release()
+    t.join()
+    assert reads == [2]
+
+# ---------------------------------------------------------------------------
+# User cache
+# Only committed rows go in: invalidated when a unit of work that UPDATEd a
+# row commits, untouched when it rolls back, and a read that started before
+# an invalidation can't put its (possibly stale) row back.
+# ---------------------------------------------------------------------------
+
+def _record(user_id, username, money=0):
+    return {'user_id': user_id, 'username': username, 'money': money, 'legendary': False,
+            'last_roll': 0, 'roll_charges': 1, 'last_charge_at': 0}
+
+def test_put_from_before_an_invalidation_is_skipped():
+    cache = db.UserCache(threading.RLock())
+    generation = cache.generation
+    cache.invalidate([1])
+    cache.put(_record(1, 'alice'), generation)
+    assert cache.get(1) is None
+    cache.put(_record(1, 'alice'), cache.generation)
+    assert cache.get(1)['username'] == 'alice'
+
+def test_invalidate_drops_the_row_and_its_username():
+    cache = db.UserCache(threading.RLock())
+    cache.put(_record(1, 'alice'))
+    cache.invalidate([1])
+    assert cache.get(1) is None
+    assert cache.lookup_username('alice') is None
+
+def test_lru_eviction_forgets_usernames():
+    cache = db.UserCache(threading.RLock(), size=2)
+    for user_id, name in ((1, 'a'), (2, 'b'), (3, 'c')):
+        cache.put(_record(user_id, name))
+    assert cache.get(1) is None and cache.lookup_username('a') is None
+    assert cache.lookup_username('c') == 3
+
+def test_uncommitted_update_stays_out_of_the_cache(fresh_db):
+    db.get_or_create_user(1, 'alice')
+    db.get_or_create_user(1, 'alice')
+    seen = {}
+
+    def read():
+        seen['legendary'] = db.get_or_create_user(1, 'alice')['legendary']
+
+    with db.unit_of_work():
+        db.set_legendary(1, True)
+        # This thread reads its own write, other threads the committed row
+        assert db.get_or_create_user(1, 'alice')['legendary'] is True
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join()
+        assert seen['legendary'] is False
+        assert db._user_cache.get(1)['legendary'] is False
+    assert db._user_cache.get(1) is None
+    assert db.get_or_create_user(1, 'alice')['legendary'] is True
+    assert db._user_cache.get(1)['legendary'] is True
+
+def test_rolled_back_update_leaves_the_cached_row(fresh_db):
+    db.get_or_create_user(1, 'alice')
+    db.get_or_create_user(1, 'alice')
+    generation = db._user_cache.generation
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.set_legendary(1, True)
+            db.get_or_create_user(1, 'bob')
+            raise RuntimeError
+    assert db._user_cache.generation == generation
+    user = db.get_or_create_user(1, None)
+    assert user['legendary'] is False and user['username'] == 'alice'
+    assert db.get_user_id_by_username('alice') == 1
@@ -0,0 +1,136 @@
+import time
+import sqlite3
+import threading
+
+import pytest
+
+import db
+from effects import EffectIndex
+from scheduler import Scheduler
+
+# ---------------------------------------------------------------------------
+# Effect index: expiry heap
+# ---------------------------------------------------------------------------
+
+def test_take_due_in_expiry_order_up_to_limit():
+    index = EffectIndex()
+    index.load([(1, 'a', 'x', 30.0), (2, 'a', 'x', 10.0), (3, 'a', 'x', 20.0), (4, 'a', 'x', None)])
+    assert index.next_expiry() == 10.0
+    assert index.take_due(25.0, 1) == [(2, 'a', 10.0)]
+    assert index.take_due(25.0, 10) == [(3, 'a', 20.0)]
+    assert index.take_due(25.0, 10) == []
+    assert index.next_expiry() == 30.0
+    # Effects without an expiry never come due
+    assert index.get(4, 'a') == ('x', None)
+
+def test_replaced_and_removed_effects_leave_stale_heap_entries():
+    index = EffectIndex()
+    index.put(1, 'boost', '2', 10.0)
+    index.put(1, 'boost', '3', 50.0)
+    index.put(2, 'boost', '2', 10.0)
+    index.remove(2, 'boost')
+    assert index.take_due(20.0, 10) == []
+    assert index.stats['stale'] == 2
+    assert index.get(1, 'boost') == ('3', 50.0)
+    assert index.take_due(50.0, 10) == [(1, 'boost', 50.0)]
+    assert index.get(1, 'boost') is None
+
+def test_expired_notices_are_handed_out_once():
+    index = EffectIndex()
+    index.put(1, 'boost', '2', 10.0)
+    index.put(1, 'discount', '1', 10.0)
+    index.queue_expired(index.take_due(10.0, 10))
+    assert sorted(index.pop_expired(1)) == ['boost', 'discount']
+    assert index.pop_expired(1) == []
+
+# ---------------------------------------------------------------------------
+# Sweeper and unit of work (SQL engine)
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def indexed_db(fresh_db, monkeypatch):
+    monkeypatch.setattr(db, 'STORAGE_ENGINE', 'sqlite')
+    db.init_storage('sqlite')
+    return fresh_db
+
+def _table(path):
+    conn = sqlite3.connect(path)
+    try:
+        return sorted(conn.execute('SELECT user_id, effect_type, effect_value, expires_at FROM user_effects'))
+    finally:
+        conn.close()
+
+def test_sweep_deletes_due_rows_in_batches(indexed_db, monkeypatch):
+    monkeypatch.setattr(db, 'EFFECT_SWEEP_BATCH', 2)
+    for user_id in range(5):
+        db.put_effect(user_id, 'boost', '2', 10.0 + user_id)
+    db.put_effect(9, 'boost', '2', 100.0)
+    assert db.next_effect_expiry() == 10.0
+    assert db.sweep_expired_effects(now=50.0) == 5
+    assert _table(indexed_db) == [(9, 'boost', '2', 100.0)]
+    assert db.pop_expired_effects(3, 50.0) == ['boost']
+    assert db.pop_expired_effects(3, 50.0) == []
+    assert db.next_effect_expiry() == 100.0
+    assert db.effect_stats()['sweeps'] == 3
+
+def test_sweep_keeps_an_effect_set_again_meanwhile(indexed_db):
+    db.put_effect(1, 'boost', '2', 10.0)
+    db.put_effect(1, 'boost', '3', 90.0)
+    assert db.sweep_expired_effects(now=50.0) == 0
+    assert _table(indexed_db) == [(1, 'boost', '3', 90.0)]
+    assert db.get_effect_row(1, 'boost') == ('3', 90.0)
+
+def test_index_only_holds_committed_effects(indexed_db):
+    seen = {}
+
+    def read():
+        seen['row'] = db.get_effect_row(1, 'boost')
+
+    with db.unit_of_work():
+        db.put_effect(1, 'boost', '2', 10.0)
+        assert db.get_effect_row(1, 'boost') == ('2', 10.0)
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join()
+        # Not due for the sweeper either until it commits
+        assert db.next_effect_expiry() is None
+    assert seen['row'] is None
+    assert db.get_effect_row(1, 'boost') == ('2', 10.0)
+    assert db.next_effect_expiry() == 10.0
+
+def test_rolled_back_effects_never_reach_the_index(indexed_db):
+    db.put_effect(1, 'boost', '2', 10.0)
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.delete_effect(1, 'boost')
+            db.put_effect(2, 'discount', '1', 20.0)
+            raise RuntimeError
+    assert db.get_effect_row(1, 'boost') == ('2', 10.0)
+    assert db.get_effect_row(2, 'discount') is None
+    assert _table(indexed_db) == [(1, 'boost', '2', 10.0)]
+    assert db.sweep_expired_effects(now=30.0) == 1
+
+# ---------------------------------------------------------------------------
+# Sweep scheduling
+# The sweep job runs when the head of the heap comes due, not on a fixed
+# interval: wake_at() brings it forward, also from inside the running job.
+# ---------------------------------------------------------------------------
+
+def test_wake_at_brings_the_sweep_forward():
+    jobs = Scheduler()
+    runs = []
+    jobs.add_job('effects', 60, lambda: runs.append(time.time()), next_run=time.time() + 60)
+    jobs.wake_at('effects', time.time() - 1)
+    jobs.run_pending()
+    assert len(runs) == 1
+    assert jobs.next_run('effects') > time.time() + 50
+
+def test_wake_requested_by_the_running_sweep_counts_for_its_next_run():
+    jobs = Scheduler()
+
+    def sweep():
+        jobs.wake_at('effects', time.time() + 5)
+
+    jobs.add_job('effects', 60, sweep)
+    jobs.run_pending()
+    assert jobs.next_run('effects') <= time.time() + 5
@@ -0,0 +1,134 @@
+import os
+import sqlite3
+
+import pytest
+
+import db
+from memstore import MemoryStore
+
+# ---------------------------------------------------------------------------
+# Memory store persistence
+# Everything that reached the op log has to come back on the next load,
+# whether or not a snapshot ran (or failed halfway) in between.
+# ---------------------------------------------------------------------------
+
+def _open(fresh_db):
+    store = MemoryStore(fresh_db + '.oplog')
+    conn = db.open_standalone_conn()
+    try:
+        store.load(conn)
+    finally:
+        conn.close()
+    return store
+
+def _no_undo(revert):
+    pass
+
+def _state(store):
+    return (
+        {uid: store.get_user(uid) for uid in store.user_ids()},
+        {uid: store.list_items(uid) for uid in store.user_ids()},
+        sorted(store.effect_rows())
+    )
+
+def _fill(store):
+    store.create_user(1, 'alice', 10.0, _no_undo)
+    store.create_user(2, 'bob', 20.0, _no_undo)
+    store.update_user(1, _no_undo, money_delta=40, legendary=True)
+    store.update_user(2, _no_undo, username='robert')
+    store.add_item(1, 'shop_discount', 3, _no_undo)
+    store.consume_item(1, 'shop_discount', 1, _no_undo)
+    store.put_effect(1, 'item_drop_boost', '2', 500.0, _no_undo)
+    store.put_effect(2, 'guarantee_rare', '1', None, _no_undo)
+    store.delete_effect(2, 'guarantee_rare', _no_undo)
+
+def test_oplog_replay_restores_everything(fresh_db):
+    store = _open(fresh_db)
+    _fill(store)
+    expected = _state(store)
+    # No snapshot: the next process only has the tables (empty) and the log
+    reloaded = _open(fresh_db)
+    assert _state(reloaded) == expected
+    assert reloaded.stats['replayed'] == store.stats['ops']
+    assert reloaded.user_id_by_username('robert') == 2
+    assert reloaded.user_id_by_username('bob') is None
+
+def test_torn_last_record_is_ignored(fresh_db):
+    store = _open(fresh_db)
+    _fill(store)
+    expected = _state(store)
+    with open(fresh_db + '.oplog', 'a', encoding='utf-8') as f:
+        f.write('["user", 3, ["half')
+    assert _state(_open(fresh_db)) == expected
+
+def test_snapshot_writes_tables_and_starts_a_fresh_log(fresh_db):
+    store = _open(fresh_db)
+    _fill(store)
+    expected = _state(store)
+    conn = db.open_standalone_conn()
+    store.snapshot(conn)
+    conn.close()
+    assert os.path.getsize(fresh_db + '.oplog') == 0
+    assert not os.path.exists(fresh_db + '.oplog.old')
+    check = sqlite3.connect(fresh_db)
+    assert check.execute('SELECT money, legendary FROM users WHERE user_id = 1').fetchone() == (40, 1)
+    assert check.execute('SELECT qty FROM user_items WHERE user_id = 1').fetchone() == (2,)
+    check.close()
+    reloaded = _open(fresh_db)
+    assert reloaded.stats['replayed'] == 0
+    assert _state(reloaded) == expected
+
+def test_failed_snapshots_keep_every_op_in_order(fresh_db):
+    store = _open(fresh_db)
+    broken = sqlite3.connect(':memory:')
+    broken.close()
+    store.create_user(1, 'alice', 10.0, _no_undo)
+    store.update_user(1, _no_undo, money_delta=5)
+    with pytest.raises(sqlite3.ProgrammingError):
+        store.snapshot(broken)
+    store.update_user(1, _no_undo, money_delta=7)
+    with pytest.raises(sqlite3.ProgrammingError):
+        store.snapshot(broken)
+    # The second failure must add to the first one's .old, not replace it
+    store.update_user(1, _no_undo, money_delta=100)
+    assert _open(fresh_db).get_user(1)['money'] == 112
+    conn = db.open_standalone_conn()
+    store.snapshot(conn)
+    conn.close()
+    assert not os.path.exists(fresh_db + '.oplog.old')
+    assert _open(fresh_db).get_user(1)['money'] == 112
+
+def test_undo_restores_the_state_and_logs_it(fresh_db):
+    store = _open(fresh_db)
+    store.create_user(1, 'alice', 10.0, _no_undo)
+    store.add_item(1, 'shop_discount', 1, _no_undo)
+    store.put_effect(1, 'item_drop_boost', '2', 500.0, _no_undo)
+    before = _state(store)
+    undo = []
+    store.create_user(2, 'bob', 20.0, undo.append)
+    store.update_user(1, undo.append, money_delta=50, username='al')
+    store.add_item(1, 'shop_discount', 2, undo.append)
+    store.put_effect(1, 'item_drop_boost', '3', 900.0, undo.append)
+    store.put_effect(1, 'guarantee_rare', '1', None, undo.append)
+    store.delete_effect(1, 'item_drop_boost', undo.append)
+    for revert in reversed(undo):
+        revert()
+    assert _state(store) == before
+    assert store.user_id_by_username('alice') == 1
+    assert _state(_open(fresh_db))[1:] == before[1:]
+    assert _open(fresh_db).get_user(1) == before[0][1]
+
+def test_memory_engine_rolls_back_with_the_unit_of_work(fresh_db, monkeypatch):
+    monkeypatch.setattr(db, 'STORAGE_ENGINE', 'sqlite')
+    store = db.init_storage('memory')
+    db.get_or_create_user(1, 'alice')
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.update_user_money(1, 50)
+            db.add_item(1, 'shop_discount', 1)
+            raise RuntimeError
+    assert db.get_user_money(1) == 0
+    assert db.get_item_qty(1, 'shop_discount') == 0
+    with db.unit_of_work():
+        db.update_user_money(1, 50)
+    assert store.get_user(1)['money'] == 50
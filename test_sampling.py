@@ -0,0 +1,62 @@
+import os
+import random
+from collections import Counter
+
+import numpy as np
+import pytest
+
+# bot.py builds its TeleBot on import; any well-formed token will do here
+os.environ.setdefault('ISOPOD_TOKEN', '123456:test')
+
+import bot
+import utils
+from sampling import AliasTable, chi_square, _chi2_critical
+
+# ---------------------------------------------------------------------------
+# Alias tables vs. the weights they were built from
+# The tables come straight from bot.py / utils.py, so a changed weight is
+# tested as it ships. Draws are seeded, so a pass or fail is the same on
+# every run; the limit is the chi-square 0.999 quantile.
+# ---------------------------------------------------------------------------
+
+DRAWS = 200000
+SEED = 20240611
+
+TABLES = {
+    'market status': (utils.STATUS_TABLE, utils.status_weights),
+    'item drops': (bot.ITEM_DROP_TABLE, [1] * len(bot.ITEM_DEFS)),
+}
+for _tier, _weights in bot.FISH_TIER_WEIGHTS.items():
+    TABLES[f'fish tier {_tier}'] = (bot.FISH_TIER_TABLES[_tier], _weights)
+
+def _limit(table):
+    return _chi2_critical(max(1, sum(1 for w in table.weights if w) - 1))
+
+@pytest.mark.parametrize('name', sorted(TABLES))
+def test_table_encodes_weights(name):
+    table, weights = TABLES[name]
+    total = sum(weights)
+    assert list(table.weights) == [float(w) for w in weights]
+    for p, w in zip(table.probabilities(), weights):
+        assert p == pytest.approx(w / total, abs=1e-12)
+
+@pytest.mark.parametrize('name', sorted(TABLES))
+def test_draw_matches_weights(name):
+    table, _ = TABLES[name]
+    rng = random.Random(SEED)
+    counts = Counter(table.draw(rng) for _ in range(DRAWS))
+    assert chi_square(table, counts, DRAWS) < _limit(table)
+
+@pytest.mark.parametrize('name', sorted(TABLES))
+def test_draw_many_matches_weights(name):
+    table, _ = TABLES[name]
+    counts = Counter(table.draw_many(DRAWS, np.random.default_rng(SEED)))
+    assert sum(counts.values()) == DRAWS
+    assert chi_square(table, counts, DRAWS) < _limit(table)
+
+def test_chi_square_rejects_wrong_weights():
+    # Same outcomes, uniform draws: the check has to notice
+    table = bot.FISH_TIER_TABLES[1]
+    uniform = AliasTable(table.outcomes, [1] * len(table.outcomes))
+    counts = Counter(uniform.draw_many(DRAWS, np.random.default_rng(SEED)))
+    assert chi_square(table, counts, DRAWS) > _limit(table)
@@ -1,16 +1,27 @@
 import os
+import io
 import time
 import random
 import math
 import json
-from PIL import Image, ImageOps, ImageDraw
-from db import get_conn
+import threading
+import logging
+import hashlib
+import numpy as np
+from PIL import Image, ImageDraw
+from db import get_conn, open_standalone_conn, in_write_transaction, after_commit, forget_photo_file_id, MARKET_TABLES_SQL, MARKET_INDEXES_SQL
+from render_cache import RenderCache, digest_of
+import compositor
+from sampling import AliasTable
+from rng import get_stream
 
 BASE_DIR = os.path.dirname(__file__)
 ASSETS_DIR = os.path.join(BASE_DIR, 'Assets')
 TXTS_DIR = os.path.join(ASSETS_DIR, 'TXTS')
 GRAPHICS_DIR = os.path.join(ASSETS_DIR, 'Graphics')
 
+logger = logging.getLogger(__name__)
+
 # ---------------------------------------------------------------------------
 # Utils: graphics, market generation, and file helpers
 #
@@ -50,6 +61,11 @@ status_ranges = {
 }
 
 status_weights = [92, 6, 1.5, 0.5]  # %
+STATUS_TABLE = AliasTable(list(status_ranges.keys()), status_weights)
+
+market_rng = get_stream('market')
+roll_rng = get_stream('roll')
+streaks_rng = get_stream('streaks')
 
 def load_lists():
     with open(get_txt_path('colors.txt'), 'r') as f:
@@ -58,83 +74,440 @@ def load_lists():
         words = [l.strip() for l in f if l.strip()]
     return colors, words
 
-def needs_regen():
+def last_market_regen():
     conn = get_conn()
     c = conn.cursor()
     c.execute('SELECT value FROM global_state WHERE key = ?', ('last_regen',))
     res = c.fetchone()
     conn.close()
-    if not res:
+    return res[0] if res else None
+
+def needs_regen():
+    last_regen = last_market_regen()
+    if not last_regen:
         return True
-    return time.time() - res[0] > 3 * 3600
+    return time.time() - last_regen > 3 * 3600
+
+MOVE_POOL = [
+    'Shell Bash', 'Dust Kick', 'Claw Snap', 'Roll Tackle',
+    'Antenna Jab', 'Mud Splash', 'Spore Puff', 'Stink Spray'
+]
+
+def market_full_name(status, color, word):
+    return f"{status.capitalize()} {color.capitalize()} {word} isopod"
+
+def roll_market_entry(rng, color, word, status=None):
+    """Roll one marketplace isopod. Returns (full_name, status, price, hp,
+    attack, moves_json). rng is anything with the random.Random API; status
+    is rolled from status_weights unless given (batched by the caller)."""
+    if status is None:
+        statuses = list(status_ranges.keys())
+        status = rng.choices(statuses, weights=status_weights)[0]
+    min_p, max_p = status_ranges[status]
+    price = rng.randint(min_p, max_p)
+    full_name = market_full_name(status, color, word)
+    if status == 'common':
+        hp = rng.randint(20, 35)
+        attack = rng.randint(5, 10)
+        moves_count = 2
+    elif status == 'rare':
+        hp = rng.randint(30, 50)
+        attack = rng.randint(8, 14)
+        moves_count = 3
+    elif status == 'epic':
+        hp = rng.randint(45, 70)
+        attack = rng.randint(12, 20)
+        moves_count = 3
+    else:
+        hp = rng.randint(70, 100)
+        attack = rng.randint(18, 28)
+        moves_count = 4
+    moves = rng.sample(MOVE_POOL, k=moves_count)
+    move_defs = []
+    for mv in moves:
+        power = attack + rng.randint(-2, 4)
+        move_defs.append({'name': mv, 'power': max(1, power)})
+    return full_name, status, price, hp, attack, json.dumps(move_defs)
+
+# ---------------------------------------------------------------------------
+# Market regeneration
+# The market is either 'materialized' (every color x word row written to
+# marketplace / isopod_stats, the original way) or 'procedural'.
+#
+# materialized: the new market is written into marketplace_next /
+# isopod_stats_next and then swapped in by renaming, all in one short
+# transaction. In WAL mode readers keep seeing the old market until that
+# commit and the full new one after it: /roll and /market never wait on a
+# rebuild or catch it half-empty. New ids continue after the old ones so
+# inventory.market_id never ends up pointing at a different isopod.
+#
+# procedural: a generation is just a seed in global_state. Any entry is
+# rebuilt on demand from (seed, cell), cell = color index * len(words) + word
+# index, so it's the same isopod every time:
+# - status and base price come from a counter-based hash of (seed, cell),
+#   which NumPy evaluates for the whole catalog at once (the /market views,
+#   the per-rarity cell lists for guaranteed rolls) or for one cell;
+# - hp, attack and moves come from roll_market_entry with a Random seeded
+#   by (seed, cell), only for the cell actually rolled.
+# Only the /market top/bottom lists are stored (market_price_index), with
+# base prices. Market Sabotage changes nothing but the price factor in
+# global_state, which scaled_price() applies on the way out, so stacked
+# sabotages don't compound rounding and the views never need rewriting.
+# Rolled procedural isopods get a negative market_id made from (seed, cell):
+# never a marketplace row, and told apart from fusions (NULL).
+# ---------------------------------------------------------------------------
+
+MARKET_MODE = 'materialized'
+MARKET_VIEW_SIZE = 10
+
+def _market_write_conn():
+    # If this thread is already inside a write transaction (a command that
+    # regenerates mid-way), a second connection would just wait on our own
+    # lock, so join that transaction and let it do the commit
+    joined = in_write_transaction()
+    return (get_conn() if joined else open_standalone_conn()), joined
+
+def _publish_market_index(conn, joined):
+    # A joined write isn't committed yet: other threads mustn't roll against
+    # it, and if the command rolls back the old index has to stay
+    if joined:
+        after_commit(rebuild_market_index)
+    else:
+        rebuild_market_index(conn)
 
 def generate_marketplace():
-    print("Generating marketplace...")
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute('DELETE FROM marketplace')
-    c.execute('DELETE FROM isopod_stats')
+    if MARKET_MODE == 'procedural':
+        _generate_procedural_market()
+    else:
+        _generate_materialized_market()
+
+def _generate_materialized_market():
+    logger.info("Generating marketplace...")
+    start = time.perf_counter()
     colors, words = load_lists()
-    statuses = list(status_ranges.keys())
-    move_pool = [
-        'Shell Bash', 'Dust Kick', 'Claw Snap', 'Roll Tackle',
-        'Antenna Jab', 'Mud Splash', 'Spore Puff', 'Stink Spray'
-    ]
+    conn, joined = _market_write_conn()
+    c = conn.cursor()
+    c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'marketplace'")
+    row = c.fetchone()
+    c.execute('SELECT MAX(id) FROM marketplace')
+    next_id = max(row[0] if row else 0, c.fetchone()[0] or 0) + 1
+    market_rows = []
+    stats_rows = []
+    statuses = iter(STATUS_TABLE.draw_many(len(colors) * len(words), market_rng.gen))
     for color in colors:
         for word in words:
-            status = random.choices(statuses, weights=status_weights)[0]
-            min_p, max_p = status_ranges[status]
-            price = random.randint(min_p, max_p)
-            full_name = f"{status.capitalize()} {color.capitalize()} {word} isopod"
-            c.execute('INSERT INTO marketplace (color, word, full_name, status, price) VALUES (?, ?, ?, ?, ?)',
-                      (color, word, full_name, status, price))
-            market_id = c.lastrowid
-            if status == 'common':
-                hp = random.randint(20, 35)
-                attack = random.randint(5, 10)
-                moves_count = 2
-            elif status == 'rare':
-                hp = random.randint(30, 50)
-                attack = random.randint(8, 14)
-                moves_count = 3
-            elif status == 'epic':
-                hp = random.randint(45, 70)
-                attack = random.randint(12, 20)
-                moves_count = 3
-            else:
-                hp = random.randint(70, 100)
-                attack = random.randint(18, 28)
-                moves_count = 4
-            moves = random.sample(move_pool, k=moves_count)
-            move_defs = []
-            for mv in moves:
-                power = attack + random.randint(-2, 4)
-                move_defs.append({'name': mv, 'power': max(1, power)})
-            c.execute('INSERT INTO isopod_stats (market_id, hp, attack, moves_json) VALUES (?, ?, ?, ?)',
-                      (market_id, hp, attack, json.dumps(move_defs)))
-    conn.commit()
-    c.execute('INSERT OR REPLACE INTO global_state (key, value) VALUES (?, ?)', ('last_regen', time.time()))
-    conn.commit()
+            full_name, status, price, hp, attack, moves_json = roll_market_entry(market_rng, color, word, next(statuses))
+            market_rows.append((next_id, color, word, full_name, status, price))
+            stats_rows.append((next_id, hp, attack, moves_json))
+            next_id += 1
+    try:
+        if not joined:
+            c.execute('BEGIN')
+        for table, ddl in MARKET_TABLES_SQL.items():
+            c.execute(f'DROP TABLE IF EXISTS {table}_next')
+            c.execute(ddl.format(name=f'{table}_next'))
+        c.executemany('INSERT INTO marketplace_next (id, color, word, full_name, status, price) VALUES (?, ?, ?, ?, ?, ?)', market_rows)
+        c.executemany('INSERT INTO isopod_stats_next (market_id, hp, attack, moves_json) VALUES (?, ?, ?, ?)', stats_rows)
+        if not joined:
+            c.execute('COMMIT')
+        build_done = time.perf_counter()
+        if not joined:
+            c.execute('BEGIN IMMEDIATE')
+        for table in MARKET_TABLES_SQL:
+            c.execute(f'DROP TABLE IF EXISTS {table}')
+            c.execute(f'ALTER TABLE {table}_next RENAME TO {table}')
+        for ddl in MARKET_INDEXES_SQL:
+            c.execute(ddl)
+        c.execute('INSERT OR REPLACE INTO global_state (key, value) VALUES (?, ?)', ('last_regen', time.time()))
+        if not joined:
+            c.execute('COMMIT')
+    except Exception:
+        if not joined and conn.in_transaction:
+            c.execute('ROLLBACK')
+        conn.close()
+        raise
+    swap_done = time.perf_counter()
+    _publish_market_index(conn, joined)
     conn.close()
-    print(f"Generated {len(colors)*len(words)} isopods")
+    elapsed = swap_done - start
+    logger.info(
+        f"Generated {len(market_rows)} isopods in {elapsed:.3f}s "
+        f"({len(market_rows) / max(elapsed, 1e-9):.0f} rows/s, swap {(swap_done - build_done) * 1000:.1f} ms)"
+    )
+
+_STATUS_MIN = np.array([status_ranges[st][0] for st in STATUS_TABLE.outcomes], dtype=np.int64)
+_STATUS_SPAN = np.array([status_ranges[st][1] - status_ranges[st][0] + 1 for st in STATUS_TABLE.outcomes], dtype=np.int64)
+
+def _mix64(x):
+    # splitmix64 finalizer; uint64 arithmetic wraps, which is the point
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def procedural_cells(seed, cells):
+    """(status index into STATUS_TABLE.outcomes, base price) arrays for an
+    array of cell numbers of the procedural market for seed."""
+    with np.errstate(over='ignore'):
+        key = np.uint64(int(seed) & 0xFFFFFFFFFFFFFFFF) * np.uint64(0x9E3779B97F4A7C15)
+        h1 = _mix64(np.asarray(cells, dtype=np.uint64) + key)
+        h2 = _mix64(h1 ^ np.uint64(0xD1B54A32D192ED03))
+    scale = 1.0 / (1 << 53)
+    status = STATUS_TABLE.pick((h1 >> np.uint64(11)).astype(np.float64) * scale)
+    price_u = (h2 >> np.uint64(11)).astype(np.float64) * scale
+    price = _STATUS_MIN[status] + (price_u * _STATUS_SPAN[status]).astype(np.int64)
+    return status, price
+
+def scaled_price(base_price, factor):
+    """Procedural market price after Market Sabotage. Views and rolls both
+    come through here, so the factor is applied in exactly one place."""
+    if factor == 1.0:
+        return int(base_price)
+    return max(1, int(base_price * factor))
+
+def procedural_market_id(seed, cell):
+    """Negative, so it can't match a marketplace row; unique per (generation, cell)."""
+    return -(((int(seed) & ((1 << 42) - 1)) << 20) + cell + 1)
+
+def procedural_entry(seed, colors, words, color_index, word_index, price_factor=1.0):
+    """Entry (color_index, word_index) of the procedural market for seed, in
+    the same tuple shape as sample_market()."""
+    cell = color_index * len(words) + word_index
+    status, base = procedural_cells(seed, [cell])
+    color = colors[color_index]
+    rng = random.Random(f"{int(seed)}:{color_index}:{word_index}")
+    full_name, status, _, hp, attack, moves_json = roll_market_entry(rng, color, words[word_index], STATUS_TABLE.outcomes[status[0]])
+    price = scaled_price(base[0], price_factor)
+    return (procedural_market_id(seed, cell), full_name, status, price, color, hp, attack, moves_json)
+
+def _top_cells(keys, limit):
+    if len(keys) > limit:
+        cells = np.argpartition(keys, limit - 1)[:limit]
+    else:
+        cells = np.arange(len(keys))
+    return cells[np.lexsort((cells, keys[cells]))]
+
+def _procedural_price_views(seed, colors, words, limit=MARKET_VIEW_SIZE):
+    """Top and bottom limit entries by base price, as (price, full_name, status)."""
+    status, price = procedural_cells(seed, np.arange(len(colors) * len(words)))
+    views = []
+    for keys in (-price, price):
+        items = []
+        for cell in _top_cells(keys, limit).tolist():
+            ci, wi = divmod(cell, len(words))
+            name = STATUS_TABLE.outcomes[status[cell]]
+            items.append((int(price[cell]), market_full_name(name, colors[ci], words[wi]), name))
+        views.append(items)
+    return views[0], views[1]
+
+def _generate_procedural_market():
+    logger.info("Generating procedural marketplace...")
+    start = time.perf_counter()
+    colors, words = load_lists()
+    seed = market_rng.getrandbits(48)
+    # The only catalog-sized work left: find the /market top and bottom ten.
+    # It's CPU only and happens before we take the write lock.
+    high, low = _procedural_price_views(seed, colors, words)
+    views_done = time.perf_counter()
+    view_rows = []
+    for kind, items in (('high', high), ('low', low)):
+        for rank, (price, full_name, status) in enumerate(items):
+            view_rows.append((seed, kind, rank, full_name, price, status))
+    conn, joined = _market_write_conn()
+    c = conn.cursor()
+    try:
+        if not joined:
+            c.execute('BEGIN IMMEDIATE')
+        c.executemany('INSERT OR REPLACE INTO global_state (key, value) VALUES (?, ?)', [
+            ('market_seed', seed),
+            ('market_price_factor', 1.0),
+            ('last_regen', time.time())
+        ])
+        c.execute('DELETE FROM market_price_index')
+        c.executemany('INSERT INTO market_price_index (seed, kind, rank, full_name, price, status) VALUES (?, ?, ?, ?, ?, ?)', view_rows)
+        if not joined:
+            c.execute('COMMIT')
+    except Exception:
+        if not joined and conn.in_transaction:
+            c.execute('ROLLBACK')
+        conn.close()
+        raise
+    _publish_market_index(conn, joined)
+    conn.close()
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Seeded procedural market of {len(colors) * len(words)} isopods in {elapsed:.3f}s "
+        f"(price views {(views_done - start) * 1000:.1f} ms)"
+    )
+
+def market_price_views(conn, limit=MARKET_VIEW_SIZE):
+    """(high, low) lists of (full_name, price, status) for /market."""
+    c = conn.cursor()
+    if MARKET_MODE == 'procedural':
+        index = _get_market_index()
+        factor = index['price_factor']
+        views = []
+        for kind in ('high', 'low'):
+            c.execute(
+                'SELECT full_name, price, status FROM market_price_index WHERE seed = ? AND kind = ? ORDER BY rank LIMIT ?',
+                (index['seed'], kind, limit)
+            )
+            views.append([(name, scaled_price(price, factor), status) for name, price, status in c.fetchall()])
+        return views[0], views[1]
+    c.execute('SELECT full_name, price, status FROM marketplace ORDER BY price DESC LIMIT ?', (limit,))
+    high = c.fetchall()
+    c.execute('SELECT full_name, price, status FROM marketplace ORDER BY price ASC LIMIT ?', (limit,))
+    low = c.fetchall()
+    return high, low
+
+def discount_market(conn, factor):
+    """Scale every current market price by factor (Market Sabotage)."""
+    c = conn.cursor()
+    if MARKET_MODE == 'procedural':
+        # Views keep base prices; scaled_price() applies the combined factor.
+        # Stacked on the stored factor, not the published index, which only
+        # catches up once this commits.
+        c.execute('''
+            INSERT OR REPLACE INTO global_state (key, value) VALUES ('market_price_factor',
+                COALESCE((SELECT value FROM global_state WHERE key = 'market_price_factor'), 1.0) * ?)
+        ''', (factor,))
+    else:
+        c.execute('UPDATE marketplace SET price = MAX(1, CAST(price * ? AS INT))', (factor,))
+    conn.commit()
+    # Outside a unit of work that commit was real and this runs right away
+    after_commit(rebuild_market_index)
+
+# ---------------------------------------------------------------------------
+# Market sampling index
+# Rolls used to run ORDER BY RANDOM() over the whole marketplace (a full sort)
+# and then hit isopod_stats for the picked row. The market only changes when
+# it's regenerated, so keep it in memory as flat per-rarity lists and pick
+# with random.choice. Anything that rewrites marketplace rows must rebuild
+# the index once those rows are committed (generate_marketplace and
+# discount_market do, through after_commit inside a unit of work).
+# In procedural mode the index is the seed, the catalog lists and the cells
+# of each guaranteed rarity, so a guaranteed roll is one choice too.
+# ---------------------------------------------------------------------------
+
+_market_index = None
+_market_index_lock = threading.Lock()
+
+def rebuild_market_index(conn=None):
+    global _market_index
+    own_conn = conn is None
+    if own_conn:
+        conn = get_conn()
+    c = conn.cursor()
+    if MARKET_MODE == 'procedural':
+        c.execute("SELECT key, value FROM global_state WHERE key IN ('market_seed', 'market_price_factor')")
+        state = dict(c.fetchall())
+        if own_conn:
+            conn.close()
+        colors, words = load_lists()
+        seed = state.get('market_seed')
+        index = {
+            'seed': seed,
+            'price_factor': state.get('market_price_factor') or 1.0,
+            'colors': colors,
+            'words': words,
+            'cells': {}
+        }
+        if seed is not None and colors and words:
+            status, _ = procedural_cells(seed, np.arange(len(colors) * len(words)))
+            for guarantee, wanted in GUARANTEE_STATUSES.items():
+                codes = [STATUS_TABLE.outcomes.index(st) for st in wanted]
+                index['cells'][guarantee] = np.flatnonzero(np.isin(status, codes)).tolist()
+        with _market_index_lock:
+            _market_index = index
+        return index
+    c.execute('''
+        SELECT m.id, m.full_name, m.status, m.price, m.color, s.hp, s.attack, s.moves_json
+        FROM marketplace m LEFT JOIN isopod_stats s ON s.market_id = m.id
+    ''')
+    rows = c.fetchall()
+    if own_conn:
+        conn.close()
+    by_status = {status: [] for status in status_ranges}
+    entries = []
+    for market_id, full_name, status, price, color, hp, attack, moves_json in rows:
+        if hp is None:
+            hp, attack, moves_json = 20, 5, '[]'
+        entry = (market_id, full_name, status, price, color, hp, attack, moves_json)
+        entries.append(entry)
+        by_status.setdefault(status, []).append(entry)
+    index = {
+        None: entries,
+        'rare': by_status['rare'] + by_status['epic'] + by_status['legendary'],
+        'legendary': by_status['legendary']
+    }
+    with _market_index_lock:
+        _market_index = index
+    return index
+
+def _get_market_index():
+    index = _market_index
+    if index is None:
+        with _market_index_lock:
+            index = _market_index
+        if index is None:
+            index = rebuild_market_index()
+    return index
+
+GUARANTEE_STATUSES = {
+    'rare': ('rare', 'epic', 'legendary'),
+    'legendary': ('legendary',)
+}
+
+def _sample_procedural(index, guarantee):
+    seed = index['seed']
+    colors = index['colors']
+    words = index['words']
+    if seed is None or not colors or not words:
+        return None
+    if guarantee is None:
+        cell = roll_rng.randrange(len(colors) * len(words))
+    else:
+        cells = index['cells'].get(guarantee)
+        if not cells:
+            return None
+        cell = roll_rng.choice(cells)
+    ci, wi = divmod(cell, len(words))
+    return procedural_entry(seed, colors, words, ci, wi, index['price_factor'])
+
+def sample_market(guarantee=None):
+    """Random market entry as (market_id, full_name, status, price, color,
+    hp, attack, moves_json). guarantee is None, 'rare' (rare or better) or
+    'legendary'. Returns None if nothing qualifies."""
+    index = _get_market_index()
+    if MARKET_MODE == 'procedural':
+        return _sample_procedural(index, guarantee)
+    pool = index.get(guarantee)
+    if not pool:
+        return None
+    return roll_rng.choice(pool)
+
+def sample_market_many(n, guarantee=None):
+    """n entries like sample_market(); guarantee only applies to the first.
+    Entries that can't be found come back as None."""
+    if n <= 0:
+        return []
+    index = _get_market_index()
+    if MARKET_MODE == 'procedural':
+        return [_sample_procedural(index, guarantee if i == 0 else None) for i in range(n)]
+    first = index.get(guarantee)
+    rows = [roll_rng.choice(first) if first else None]
+    pool = index.get(None)
+    if n > 1:
+        rows.extend(roll_rng.choices(pool, k=n - 1) if pool else [None] * (n - 1))
+    return rows
 
 def hex_to_rgb(hex_str):
     hex_str = hex_str.lstrip('#')
     return tuple(int(hex_str[i:i+2], 16) for i in range(0, 6, 2))
 
 def create_vertical_gradient(size, start_rgb, end_rgb):
-    width, height = size
-    gradient = Image.new('RGBA', size)
-    draw = ImageDraw.Draw(gradient)
-    for y in range(height):
-        ratio = y / height
-        r = int(start_rgb[0] * (1 - ratio) + end_rgb[0] * ratio)
-        g = int(start_rgb[1] * (1 - ratio) + end_rgb[1] * ratio)
-        b = int(start_rgb[2] * (1 - ratio) + end_rgb[2] * ratio)
-        draw.line((0, y, width, y), fill=(r, g, b, 255))
-    return gradient
-
-def add_streaks(canvas, base_rgb, num_streaks=25):
+    return compositor.to_image(compositor.linear_gradient(size, start_rgb, end_rgb))
+
+def add_streaks(canvas, base_rgb, num_streaks=25, rng=streaks_rng):
     draw = ImageDraw.Draw(canvas)
     width, height = canvas.size
     cx, cy = width // 2, height // 2
@@ -142,74 +515,319 @@ def add_streaks(canvas, base_rgb, num_streaks=25):
     streak_color = streak_rgb + (200,)
     max_radius = max(width, height) * 0.45
     for _ in range(num_streaks):
-        angle = math.pi * 2 * random.random()
-        start_radius = max_radius * random.uniform(0.6, 1.0)
-        end_radius = max_radius * random.uniform(0.0, 0.3)
+        angle = math.pi * 2 * rng.random()
+        start_radius = max_radius * rng.uniform(0.6, 1.0)
+        end_radius = max_radius * rng.uniform(0.0, 0.3)
         sx = cx + int(start_radius * math.cos(angle))
         sy = cy + int(start_radius * math.sin(angle))
         ex = cx + int(end_radius * math.cos(angle))
         ey = cy + int(end_radius * math.sin(angle))
-        line_width = random.randint(1, 4)
+        line_width = rng.randint(1, 4)
         draw.line((sx, sy, ex, ey), fill=streak_color, width=line_width)
 
-def generate_isopod_image(color_name: str, output_path: str = 'tempbug.png'):
-    if color_name not in hex_colors:
-        raise ValueError(f"Unknown color: {color_name}")
-    base_img = get_graphics_path('isopod.png')
-    if not os.path.exists(base_img):
-        raise FileNotFoundError("isopod.png not found!")
-    img = Image.open(base_img).convert('RGBA')
-    rgb_img = img.convert('RGB')
-    gray = rgb_img.convert('L')
-    alpha = img.split()[-1]
-    color_hex = hex_colors[color_name]
-    tinted_rgb = ImageOps.colorize(gray, '#000000', color_hex)
-    tinted = Image.merge('RGBA', tinted_rgb.split()[:3] + (alpha,))
-    rgb = hex_to_rgb(color_hex)
+# --------------------------------------------------------------------------------
+# Rendered sprites
+# A render is fully determined by (sprite, color, variant): the variant seeds
+# the streak pattern, so each color has RENDER_VARIANTS looks and a roll picks
+# one at random. That makes renders cacheable (see render_cache.py). Bump
+# RENDER_VERSION when the drawing code changes so old disk entries are ignored.
+# RENDER_CACHE_DIR = None keeps the cache in memory only.
+#
+# Base sprites are decoded once into gray + alpha planes (SpriteRegistry),
+# and every hex_colors entry has its 256-entry color lookup ready, so tinting
+# is one table lookup per pixel. Adding a sprite is one register() call;
+# render_sprite() works for any registered name.
+# --------------------------------------------------------------------------------
+
+RENDER_VARIANTS = 4
+RENDER_VERSION = 1
+# rainbowpillbug.png (drawn by build_assets.py)
+RAINBOW_STREAKS = 35
+RAINBOW_STREAK_COLOR = (255, 240, 100, 220)
+RENDER_CACHE_SIZE = 256
+RENDER_CACHE_DIR = os.path.join(BASE_DIR, '.render_cache')
+
+class Sprite:
+    def __init__(self, name, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{os.path.basename(path)} not found!")
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.name = name
+        self.path = path
+        self.digest = digest_of(data)
+        self.gray, self.alpha = compositor.sprite_planes(Image.open(io.BytesIO(data)))
+        self.height, self.width = self.gray.shape
+
+class SpriteRegistry:
+    def __init__(self, palette):
+        self._files = {}
+        self._sprites = {}
+        self._lock = threading.Lock()
+        self.luts = {name: compositor.color_lut(hex_to_rgb(hex_str)) for name, hex_str in palette.items()}
+
+    def register(self, name, filename):
+        """Make name renderable from Assets/Graphics/filename (loaded on first use)."""
+        with self._lock:
+            self._files[name] = filename
+            self._sprites.pop(name, None)
+
+    def get(self, name):
+        sprite = self._sprites.get(name)
+        if sprite is not None:
+            return sprite
+        with self._lock:
+            sprite = self._sprites.get(name)
+            if sprite is None:
+                if name not in self._files:
+                    raise ValueError(f"Unknown sprite: {name}")
+                sprite = Sprite(name, get_graphics_path(self._files[name]))
+                self._sprites[name] = sprite
+        return sprite
+
+    def names(self):
+        with self._lock:
+            return list(self._files)
+
+    def load_all(self):
+        for name in self.names():
+            self.get(name)
+
+sprites = SpriteRegistry(hex_colors)
+sprites.register('isopod', 'isopod.png')
+sprites.register('isofish', 'isofish.png')
+
+_render_cache = RenderCache(RENDER_CACHE_SIZE, RENDER_CACHE_DIR)
+
+# --------------------------------------------------------------------------------
+# Output profiles
+# How a finished canvas is encoded for sending. Pick one per deployment with
+# OUTPUT_PROFILE (or ISOPOD_OUTPUT_PROFILE). max_side caps the longer edge,
+# colors quantizes PNGs to a palette, quality applies to WEBP/JPEG. The
+# profile is part of every cache key, so switching it never serves stale
+# bytes. 'lossless' is what we always sent, and what build_assets.py writes.
+# --------------------------------------------------------------------------------
+
+OUTPUT_PROFILES = {
+    'lossless': {'format': 'PNG'},
+    'png_small': {'format': 'PNG', 'max_side': 720, 'colors': 256, 'compress_level': 9},
+    'webp': {'format': 'WEBP', 'max_side': 960, 'quality': 85},
+    'jpeg': {'format': 'JPEG', 'max_side': 960, 'quality': 85},
+}
+OUTPUT_PROFILE = os.environ.get('ISOPOD_OUTPUT_PROFILE', 'lossless')
+
+def encode_image(canvas, profile=None):
+    """Encode an image with an output profile (default OUTPUT_PROFILE)."""
+    settings = OUTPUT_PROFILES[profile or OUTPUT_PROFILE]
+    max_side = settings.get('max_side')
+    if max_side and max(canvas.size) > max_side:
+        scale = max_side / max(canvas.size)
+        canvas = canvas.resize((max(1, round(canvas.width * scale)), max(1, round(canvas.height * scale))), Image.LANCZOS)
+    fmt = settings['format']
+    options = {}
+    if fmt == 'PNG':
+        if settings.get('colors'):
+            canvas = canvas.quantize(settings['colors'], method=Image.Quantize.FASTOCTREE)
+        if 'compress_level' in settings:
+            options['compress_level'] = settings['compress_level']
+    else:
+        options['quality'] = settings.get('quality', 85)
+        if fmt == 'JPEG':
+            canvas = canvas.convert('RGB')
+            options['optimize'] = True
+    buf = io.BytesIO()
+    canvas.save(buf, fmt, **options)
+    return buf.getvalue()
+
+def _profile_digest(profile=None):
+    name = profile or OUTPUT_PROFILE
+    return digest_of(name, json.dumps(OUTPUT_PROFILES[name], sort_keys=True))
+
+def _render_sprite(sprite, color_name, variant, profile=None):
+    base = sprites.get(sprite)
+    gray, alpha = base.gray, base.alpha
+    rgb = hex_to_rgb(hex_colors[color_name])
     dark_rgb = tuple(int(c * 0.25) for c in rgb)
     light_rgb = rgb
-    w, h = img.size
+    h, w = gray.shape
     canvas_side = max(w, h) * 2
     canvas_size = (canvas_side, canvas_side)
     canvas = create_vertical_gradient(canvas_size, dark_rgb, light_rgb)
-    add_streaks(canvas, light_rgb)
+    add_streaks(canvas, light_rgb, rng=random.Random(f'{sprite}:{color_name}:{variant}'))
     paste_x = (canvas_side - w) // 2
     paste_y = (canvas_side - h) // 2
-    canvas.paste(tinted, (paste_x, paste_y), tinted)
-    canvas.save(output_path, 'PNG')
-    return output_path
+    compositor.composite(canvas, compositor.apply_lut(gray, sprites.luts[color_name], alpha), (paste_x, paste_y))
+    return encode_image(canvas, profile)
 
-def generate_isofish_image(color_name: str, output_path: str = 'tempfish.png'):
+def render_sprite(sprite, color_name, variant=None):
+    """Encoded bytes of sprite tinted color_name. variant None draws from the
+    variant pool, or a random cached variant if the pool is still empty."""
     if color_name not in hex_colors:
         raise ValueError(f"Unknown color: {color_name}")
-    base_img = get_graphics_path('isofish.png')
-    if not os.path.exists(base_img):
-        raise FileNotFoundError("isofish.png not found!")
-    img = Image.open(base_img).convert('RGBA')
-    rgb_img = img.convert('RGB')
-    gray = rgb_img.convert('L')
-    alpha = img.split()[-1]
-    color_hex = hex_colors[color_name]
-    tinted_rgb = ImageOps.colorize(gray, '#000000', color_hex)
-    tinted = Image.merge('RGBA', tinted_rgb.split()[:3] + (alpha,))
-    rgb = hex_to_rgb(color_hex)
-    dark_rgb = tuple(int(c * 0.25) for c in rgb)
-    light_rgb = rgb
-    w, h = img.size
-    canvas_side = max(w, h) * 2
-    canvas_size = (canvas_side, canvas_side)
-    canvas = create_vertical_gradient(canvas_size, dark_rgb, light_rgb)
-    add_streaks(canvas, light_rgb)
-    paste_x = (canvas_side - w) // 2
-    paste_y = (canvas_side - h) // 2
-    canvas.paste(tinted, (paste_x, paste_y), tinted)
-    canvas.save(output_path, 'PNG')
-    return output_path
-
-def cleanup_temp():
-    temp = 'tempbug.png'
-    if os.path.exists(temp):
-        os.remove(temp)
-    temp_fish = 'tempfish.png'
-    if os.path.exists(temp_fish):
-        os.remove(temp_fish)
+    if variant is None:
+        data = variant_pool.draw(sprite, color_name)
+        if data is not None:
+            return data
+        variant = streaks_rng.randrange(RENDER_VARIANTS)
+    digest = digest_of(sprites.get(sprite).digest, hex_colors[color_name], str(variant), str(RENDER_VERSION), _profile_digest())
+    return _render_cache.get(
+        (sprite, color_name, variant, OUTPUT_PROFILE), digest,
+        lambda: _render_sprite(sprite, color_name, variant)
+    )
+
+def render_cache_stats():
+    return _render_cache.snapshot()
+
+# --------------------------------------------------------------------------------
+# Variant pool
+# Rolls draw from VARIANT_POOL_SIZE ready-made PNGs per (sprite, color)
+# instead of rendering. The pool starts from the cached variants 0..N-1 (fast
+# after a restart thanks to the disk cache), then a background thread swaps
+# the oldest variant of every pool for a freshly seeded one every
+# VARIANT_REFRESH seconds, so the streaks keep changing.
+#
+# A draw that finds its pool empty counts as starved and falls back to the
+# render cache; watch 'starved' in variant_pool_stats().
+#
+# A rotated-out variant is never drawn again, so its photo_file_ids row is
+# dropped with it. The fixed variants 0..N-1 keep theirs: they come back
+# after every restart.
+# --------------------------------------------------------------------------------
+
+VARIANT_POOL_SIZE = RENDER_VARIANTS
+VARIANT_REFRESH = 600
+
+class VariantPool:
+    def __init__(self, size=VARIANT_POOL_SIZE, refresh=VARIANT_REFRESH):
+        self.size = size
+        self.refresh = refresh
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {'draws': 0, 'starved': 0, 'rendered': 0, 'rotations': 0, 'render_seconds': 0.0, 'pruned': 0}
+
+    def draw(self, sprite, color_name):
+        with self._lock:
+            pool = self._pools.get((sprite, color_name))
+            if not pool:
+                self.stats['starved'] += 1
+                return None
+            self.stats['draws'] += 1
+            return streaks_rng.choice(pool)[1]
+
+    def _keys(self):
+        return [(sprite, color_name) for sprite in sprites.names() for color_name in hex_colors]
+
+    def _render(self, sprite, color_name, variant):
+        start = time.perf_counter()
+        if isinstance(variant, int) and variant < RENDER_VARIANTS:
+            data = render_sprite(sprite, color_name, variant)
+        else:
+            data = _render_sprite(sprite, color_name, variant)
+        with self._lock:
+            self.stats['rendered'] += 1
+            self.stats['render_seconds'] += time.perf_counter() - start
+        return data
+
+    def fill(self):
+        """Top every pool up to size."""
+        for key in self._keys():
+            with self._lock:
+                have = len(self._pools.get(key, ()))
+            for variant in range(have, self.size):
+                data = self._render(*key, variant)
+                with self._lock:
+                    self._pools.setdefault(key, []).append((variant, data))
+
+    def rotate(self):
+        """Replace the oldest variant in every pool with a new random one."""
+        for key in self._keys():
+            variant = f'r{streaks_rng.getrandbits(48)}'
+            data = self._render(*key, variant)
+            evicted = None
+            with self._lock:
+                pool = self._pools.setdefault(key, [])
+                pool.append((variant, data))
+                if len(pool) > self.size:
+                    evicted = pool.pop(0)
+                self.stats['rotations'] += 1
+            if evicted is not None and isinstance(evicted[0], str):
+                forget_photo_file_id(hashlib.sha256(evicted[1]).hexdigest())
+                with self._lock:
+                    self.stats['pruned'] += 1
+
+    def _loop(self):
+        start = time.perf_counter()
+        try:
+            sprites.load_all()
+            self.fill()
+            logger.info(f"Variant pool filled in {time.perf_counter() - start:.2f}s")
+        except Exception:
+            # Draws fall back to the render cache; rotate() below keeps trying
+            logger.exception("Variant pool fill failed")
+        while True:
+            time.sleep(self.refresh)
+            try:
+                self.rotate()
+            except Exception:
+                logger.exception("Variant pool rotation failed")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='variant-pool', daemon=True)
+        self._thread.start()
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+            sizes = [len(pool) for pool in self._pools.values()]
+        data['pools'] = len(sizes)
+        data['min_size'] = min(sizes) if sizes else 0
+        draws = data['draws'] + data['starved']
+        data['starved_rate'] = data['starved'] / draws if draws else 0.0
+        return data
+
+variant_pool = VariantPool()
+
+def variant_pool_stats():
+    return variant_pool.snapshot()
+
+def generate_isopod_image(color_name: str) -> bytes:
+    """Image bytes in OUTPUT_PROFILE, ready for send_photo. Rendered in memory;
+    the only file written is the render cache's copy under .render_cache/."""
+    return render_sprite('isopod', color_name)
+
+def generate_isofish_image(color_name: str) -> bytes:
+    return render_sprite('isofish', color_name)
+
+def rainbow_digest():
+    """Hash of the parameters rainbowpillbug.png is drawn with."""
+    return digest_of('rainbow', str(RAINBOW_STREAKS), json.dumps(RAINBOW_STREAK_COLOR))
+
+# (profile, file mtime) -> encoded bytes, so a rainbow roll doesn't re-read the file
+_rainbow_bytes = {}
+
+def rainbow_image():
+    """rainbowpillbug.png re-encoded with OUTPUT_PROFILE, or None if the asset is missing."""
+    path = get_graphics_path('rainbowpillbug.png')
+    try:
+        key = (OUTPUT_PROFILE, os.stat(path).st_mtime_ns)
+    except OSError:
+        return None
+    data = _rainbow_bytes.get(key)
+    if data is not None:
+        return data
+    try:
+        with open(path, 'rb') as f:
+            source = f.read()
+    except OSError:
+        return None
+    digest = digest_of(source, rainbow_digest(), _profile_digest())
+    data = _render_cache.get(
+        ('rainbow', OUTPUT_PROFILE), digest,
+        lambda: encode_image(Image.open(io.BytesIO(source)))
+    )
+    _rainbow_bytes.clear()
+    _rainbow_bytes[key] = data
+    return data